@@ -13,6 +13,7 @@ from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
 
 from embdgen.core.utils.class_factory import Config
 from embdgen.core.content.BinaryContent import BinaryContent
+from embdgen.core.content.ResourceEstimate import ResourceEstimate
 from embdgen.core.utils.SizeType import SizeType
 
 
@@ -113,8 +114,17 @@ class CominitContent(BinaryContent):
                 raise Exception("Verity requires a metadata file")
 
         self.content.prepare()
+        self.content.acquire()
         self.size = self.content.size + self.METADATA_SIZE
 
+    def estimate(self) -> ResourceEstimate:
+        content = self.content.estimate()
+        return ResourceEstimate(self.size.bytes, content.temp_files, content.temp_other)
+
+    def do_materialize(self) -> None:
+        # The verity metadata might be generated, while materializing the content
+        self.content.materialize()
+
         if self.dm_type == 'verity':
             if not self.metadata.exists(): # type: ignore[union-attr]
                 raise Exception(f"Metadata file {self.metadata} does not exist")
@@ -152,6 +162,10 @@ class CominitContent(BinaryContent):
 
         return data
 
+    def do_release(self) -> None:
+        super().do_release()
+        self.content.release()
+
     def do_write(self, file: BufferedIOBase):
         self.content.write(file)
         file.write(self._create_metadata())
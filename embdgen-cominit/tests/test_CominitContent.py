@@ -128,14 +128,15 @@ class TestCominitContent:
             obj.prepare()
 
         obj.metadata = Path("i-do-not-exist")
+        obj.prepare()
         with pytest.raises(Exception, match=r"Metadata file .* does not exist"):
-            obj.prepare()
+            obj.materialize()
 
         meta_file = tmp_path / "file"
         meta_file.write_text("")
         obj.metadata = meta_file
         with pytest.raises(KeyError):
-            obj.prepare()
+            obj.materialize()
 
     def test_verity_writable(self):
         obj = CominitContent()
@@ -1,10 +1,14 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
+from typing import List
+
 import strictyaml as y
 
 from embdgen.plugins.config.yaml.ContentRegistry import ContentRegistry
 from embdgen.core.content import BaseContent, Factory
+from embdgen.core.content.FilesContentProvider import FilesContentProvider
 
+from .ListBase import ListBase
 from .ObjectBase import ObjectBase
 
 class Content(ObjectBase):
@@ -17,3 +21,9 @@ class Content(ObjectBase):
             result._value = ContentRegistry.instance().find(result.value)
             return result
         return super().__call__(chunk)
+
+class FilesContentList(ListBase):
+    RESULT_TYPE = List[FilesContentProvider]
+
+    def __init__(self):
+        super().__init__(Content.create(FilesContentProvider))
@@ -1,20 +1,49 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
+import logging
+import os
+import stat
 import sys
-from typing import Optional, Sequence, NoReturn
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, List, Optional, Sequence, NoReturn
 from pathlib import Path
 from dataclasses import dataclass
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 
 from ..config.Factory import Factory
-from ..utils.image import BuildLocation
+from ..sink import BaseSink, Factory as SinkFactory
+from ..utils.image import BuildLocation, CacheDropper
+from ..utils.SizeType import SizeType
+from ..utils.delta import create_delta, fingerprint_file, write_fingerprints
+from ..utils.preflight import Preflight
+
+
+def size_argument(text: str) -> SizeType:
+    """Parse a size argument (see ``SizeType.parse``)"""
+    try:
+        return SizeType.parse(text)
+    except Exception as e: # pylint: disable=broad-exception-caught
+        raise ArgumentTypeError(str(e)) from e
 
 
 @dataclass(init=False)
 class Arguments:
     format: Optional[str]
-    output: Path
+    output: List[Path]
     tempdir: Optional[Path]
+    ram_budget: Optional[SizeType]
+    ram_threshold: Optional[SizeType]
+    verbose: bool
+    no_preflight: bool
+    sync_cleanup: bool
+    drop_caches: bool
+    delta_from: Optional[Path]
+    delta_output: Optional[Path]
+    write_fingerprints: bool
+    export_partitions: Optional[Path]
+    update_in_place: bool
+    jobs: int
+    sink: Optional[List[str]]
     filename: Path
 
 
@@ -33,11 +62,71 @@ class CLI:
             description = "embdgen - EMBedded Disk GENerator"
         )
         self.register_config_loaders(parser)
-        parser.add_argument("-o", "--output", default="image.raw", type=Path,
-                            help="Output file name (default: image.raw)")
+        parser.add_argument("-o", "--output", action="append", type=Path,
+                            help=("Output file name or block device, - to stream the image to stdout "
+                                  "(default: image.raw). Can be used multiple times to write the image "
+                                  "to multiple files or devices in parallel"))
         parser.add_argument(
             "-t", "--tempdir", type=Path, help="Specify another temporary directory"
         )
+        parser.add_argument(
+            "--sync-cleanup", action="store_true",
+            help=("Remove the temporary directory before exiting "
+                  "(by default it is removed by a background process)")
+        )
+        parser.add_argument(
+            "--drop-caches", action="store_true",
+            help=("Drop copied and hashed data from the page cache, to keep the memory footprint flat "
+                  "(e.g. on shared build servers)")
+        )
+        parser.add_argument(
+            "--ram-budget", type=size_argument, metavar="SIZE",
+            help=("Place temporary files in RAM (/dev/shm), as long as their total size does not exceed SIZE "
+                  "(e.g. 512MB). Larger files are placed in the temporary directory")
+        )
+        parser.add_argument(
+            "--ram-threshold", type=size_argument, metavar="SIZE",
+            help="Only place temporary files up to SIZE in RAM (default: --ram-budget)"
+        )
+        parser.add_argument(
+            "-v", "--verbose", action="store_true",
+            help="Log details, e.g. where temporary files are placed"
+        )
+        parser.add_argument(
+            "--no-preflight", action="store_true",
+            help="Do not check, if there is enough space for the temporary files and the outputs before starting"
+        )
+        parser.add_argument(
+            "--delta-from", type=Path, metavar="IMAGE",
+            help="Additionally create a block level delta from a previous image to the generated image"
+        )
+        parser.add_argument(
+            "--delta-output", type=Path, metavar="DELTA",
+            help="Output file name of the delta (default: <output>.delta)"
+        )
+        parser.add_argument(
+            "--write-fingerprints", action="store_true",
+            help=("Write <output>.fingerprints, so that later deltas from this image do not need to read "
+                  "its unchanged regions (always written with --delta-from)")
+        )
+        parser.add_argument(
+            "--export-partitions", type=Path, metavar="DIR",
+            help="Additionally write the content of each partition to DIR/<name>.img"
+        )
+        parser.add_argument(
+            "--update-in-place", action="store_true",
+            help="Only write the blocks, that differ from the existing content of the output file or device"
+        )
+        parser.add_argument(
+            "-j", "--jobs", type=int, default=1,
+            help=("Number of regions written concurrently, if all outputs support random access "
+                  "(i.e. regular files, default: 1)")
+        )
+        parser.add_argument(
+            "-s", "--sink", action="append", metavar="TYPE:FILE",
+            help=("Additionally write the image to FILE in the format TYPE, while writing the image "
+                  f"(can be used multiple times, available types: {', '.join(SinkFactory.class_map().keys())})")
+        )
         parser.add_argument("filename", type=Path, help="Config file name")
         return parser
 
@@ -51,8 +140,42 @@ class CLI:
             if options.format is None:
                 self.fatal("Unable to detect the format of the config file")
 
+        if options.verbose:
+            logging.basicConfig(format="%(message)s", stream=sys.stderr)
+            logging.getLogger("embdgen").setLevel(logging.INFO)
+
+        if options.ram_threshold and not options.ram_budget:
+            self.fatal("--ram-threshold requires --ram-budget")
+
+        if options.jobs < 1:
+            self.fatal("The number of jobs must be at least 1")
+
+        if options.delta_from and not options.delta_from.exists():
+            self.fatal(f"The delta base image {options.delta_from} does not exist")
+
+        sinks = self.create_sinks(options.sink or [])
+
+        outputs = options.output or [Path("image.raw")]
+        if Path("-") in outputs:
+            if len(outputs) > 1 or options.delta_from or options.write_fingerprints or options.export_partitions \
+                    or options.update_in_place:
+                self.fatal("Streaming to stdout cannot be combined with other outputs, --delta-from, "
+                           "--write-fingerprints, --export-partitions or --update-in-place")
+            with self.redirect_stdout() as stream:
+                stream_sink = SinkFactory.by_type("stream")(Path("-"), stream) # type: ignore
+                self.generate(options, [], [stream_sink, *sinks])
+        else:
+            self.generate(options, outputs, sinks)
+
+    def generate(self, options: Arguments, outputs: List[Path], sinks: List[BaseSink]) -> None:
         if options.tempdir:
             BuildLocation().set_path(options.tempdir)
+        CacheDropper.enabled = options.drop_caches
+        if options.ram_budget:
+            BuildLocation().set_ram_budget(
+                options.ram_budget.bytes,
+                options.ram_threshold.bytes if options.ram_threshold else None
+            )
         label = self.factory.by_type(options.format)().load(options.filename) # type: ignore
 
         print("Preparing...")
@@ -61,10 +184,80 @@ class CLI:
         print("\nThe final layout:")
         print(label)
 
-        print(f"\nWriting image to {options.output}")
-        label.create(options.output)
+        output_sinks = [label.output_sink(output, options.update_in_place) for output in outputs]
+        if not options.no_preflight:
+            preflight = Preflight(label, outputs, options.jobs, output_sinks + sinks)
+            print("\nEstimated resources:")
+            print(preflight.report())
+            if preflight.problems:
+                self.fatal("\n".join(preflight.problems))
+
+        if not outputs:
+            print("\nWriting image to stdout")
+            label.create(None, None, sinks)
+        else:
+            print(f"\nWriting image to {', '.join(map(str, outputs))}")
+            label.create(outputs[0], options.export_partitions, output_sinks[1:] + sinks,
+                         options.update_in_place, options.jobs, filename_sink=output_sinks[0])
+
+        if options.delta_from:
+            delta_output = options.delta_output or outputs[0].with_name(outputs[0].name + ".delta")
+            print(f"Writing delta from {options.delta_from} to {delta_output}")
+            create_delta(label.parts, outputs[0], options.delta_from, delta_output)
+        elif options.write_fingerprints:
+            print(f"Writing fingerprints to {fingerprint_file(outputs[0])}")
+            write_fingerprints(label.parts, outputs[0])
+
+        BuildLocation().remove(background=not options.sync_cleanup)
+
+    def create_sinks(self, sink_args: List[str]) -> List[BaseSink]:
+        sinks = []
+        for arg in sink_args:
+            parts = arg.split(":", 1)
+            if len(parts) != 2 or not parts[1]:
+                self.fatal(f"Invalid sink '{arg}', expected TYPE:FILE")
+            sink_class = SinkFactory.by_type(parts[0])
+            if sink_class is None:
+                self.fatal(f"Unknown sink type '{parts[0]}'")
+            if not sink_class.STREAMABLE and not self.is_seekable(Path(parts[1])):
+                self.fatal(f"The {parts[0]} sink cannot write to {parts[1]}, it requires a seekable file "
+                           "(not a pipe or stdout)")
+            sinks.append(sink_class(Path(parts[1])))
+        return sinks
+
+    @staticmethod
+    def is_seekable(filename: Path) -> bool:
+        """Check, if filename is not stdout (-), a pipe, a socket or a character device"""
+        if str(filename) == "-":
+            return False
+        try:
+            mode = filename.stat().st_mode
+        except FileNotFoundError:
+            return True
+        return not (stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or stat.S_ISCHR(mode))
+
+    @contextmanager
+    def redirect_stdout(self) -> Iterator[BinaryIO]:
+        """
+        Redirect stdout to stderr and yield a stream to the original stdout
 
-        BuildLocation().remove()
+        This ensures, that only the image is written to stdout, even if
+        some external tool writes to its stdout.
+        """
+        sys.stdout.flush()
+        saved_fd = os.dup(1)
+        saved_stdout = sys.stdout
+        stream = os.fdopen(os.dup(1), "wb")
+        os.dup2(2, 1)
+        sys.stdout = sys.stderr
+        try:
+            yield stream
+        finally:
+            stream.close()
+            sys.stdout.flush()
+            sys.stdout = saved_stdout
+            os.dup2(saved_fd, 1)
+            os.close(saved_fd)
 
     def probe_format(self, filename: Path) -> Optional[str]:
         for name, typ in self.factory.class_map().items():
@@ -1,8 +1,12 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 import abc
+import threading
 
 from ..utils.SizeType import SizeType
+from .ResourceEstimate import ResourceEstimate
+
+_users_lock = threading.Lock()
 
 class BaseContent(abc.ABC):
     """Base class for content (i.e. region content)
@@ -10,9 +14,14 @@ class BaseContent(abc.ABC):
 
     size: SizeType
 
+    _materialized: bool = False
+    _materialize_lock: threading.Lock
+    _users: int = 0
+
     def __init__(self) -> None:
         "Create a new empty content"
         self.size = SizeType()
+        self._materialize_lock = threading.Lock()
 
     def prepare(self) -> None:
         """Prepare content
@@ -20,4 +29,58 @@ class BaseContent(abc.ABC):
         This should calculate the size of the content
         and generate any files / information required by
         the owning class.
+        Expensive operations, that are not required to determine the size,
+        should be done in ``do_materialize`` instead.
+        """
+
+    def estimate(self) -> ResourceEstimate:
+        """Estimate the resources required for materializing and writing this content
+
+        This is called after ``prepare`` and must not do any expensive work.
+        The estimate includes the resources of all contents used by this content.
+        """
+        return ResourceEstimate(data=self.size.bytes or 0)
+
+    def materialize(self) -> None:
+        """Generate the data of the content
+
+        This is called after ``prepare``, when the layout of the image is known.
+        It can run concurrently with writing other regions of the image.
+        Calling it multiple times (also concurrently, e.g. for a content shared by
+        multiple regions) only generates the data once.
         """
+        with self._materialize_lock:
+            if not self._materialized:
+                self.do_materialize()
+                self._materialized = True
+
+    def do_materialize(self) -> None:
+        """Generate the data of the content (see ``materialize``)"""
+
+    def acquire(self) -> None:
+        """Register a consumer of this content
+
+        Every content or region, that uses the data of this content,
+        acquires it in ``prepare`` and releases it, when the data is not required anymore.
+        """
+        with _users_lock:
+            self._users += 1
+
+    def release(self) -> None:
+        """Unregister a consumer of this content (see ``acquire``)
+
+        When the last consumer released the content, all intermediate data is
+        removed (see ``do_release``). The data is generated again, if the content
+        is materialized again later.
+        """
+        with _users_lock:
+            self._users -= 1
+            if self._users > 0:
+                return
+            self._users = 0
+        with self._materialize_lock:
+            self.do_release()
+            self._materialized = False
+
+    def do_release(self) -> None:
+        """Remove all intermediate files and directories of the content (see ``release``)"""
@@ -1,7 +1,7 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 import io
 import abc
 
@@ -19,18 +19,41 @@ class BinaryContent(BaseContent):
 
     @property
     def result_file(self) -> Path:
+        self._materialize_result()
+        return self._result_file # type: ignore[return-value]
+
+    @property
+    def source(self) -> Optional[Tuple[Path, int]]:
+        """File and offset containing the materialized content, if it is backed by a file
+
+        This allows consumers to copy (or reflink) the content without writing it through python.
+        """
+        if self._result_file:
+            return self._result_file, 0
+        return None
+
+    def _materialize_result(self) -> None:
+        """Generate the result file, if it does not exist yet"""
         if not self._result_file:
-            self._result_file = get_temp_file(ext=f".{self.__class__.__name__}")
+            self._result_file = get_temp_file(
+                ext=f".{self.__class__.__name__}",
+                size_hint=None if self.size.is_undefined else self.size.bytes
+            )
             self._prepare_result()
-        return self._result_file
 
     def write(self, file: io.BufferedIOBase) -> None:
+        self.materialize()
         if self._result_file:
             with self.result_file.open("rb") as in_file:
                 copy_sparse(file, in_file)
         else:
             self.do_write(file)
 
+    def do_release(self) -> None:
+        if self._result_file:
+            self._result_file.unlink(missing_ok=True)
+            self._result_file = None
+
     def _prepare_result(self):
         with self._result_file.open("wb") as f:
             self.do_write(f)
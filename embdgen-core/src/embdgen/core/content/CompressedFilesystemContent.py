@@ -0,0 +1,111 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import abc
+import io
+import math
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import List, Optional, Union
+
+from ..utils.class_factory import Config
+from ..utils.image import BuildLocation, copy_sparse
+from ..utils.SizeType import SizeType
+from .BinaryContent import BinaryContent
+from .FilesContentProvider import FilesContentProvider
+from .ResourceEstimate import ResourceEstimate
+
+
+@Config("content")
+@Config("size", optional=True)
+@Config("compression", optional=True)
+@Config("threads", optional=True)
+class CompressedFilesystemContent(BinaryContent, abc.ABC):
+    """Base class for compressed read-only filesystems
+
+    The filesystem is created from the files of the content under fakeroot,
+    so the ownership and device nodes recorded by the content provider are preserved.
+
+    The size of a compressed filesystem is only known after creating it, so the filesystem
+    is already created, when the layout of the image is prepared. If no size is set,
+    the size of the filesystem (aligned to ``ALIGNMENT``) is used. This allows using
+    the content e.g. as content of a ``VerityContent``.
+    """
+    ALIGNMENT = 4096
+    COMPRESSIONS: List[str] = []
+
+    content: FilesContentProvider
+    """Files, that are added to the filesystem"""
+
+    _compression: Optional[str] = None
+    _threads: int = 0
+    _auto_size: bool = False
+
+    @property
+    def compression(self) -> Optional[str]:
+        """Compression algorithm (the default of the filesystem tool is used, if not set)"""
+        return self._compression
+
+    @compression.setter
+    def compression(self, value: Optional[str]) -> None:
+        if value is not None and value.split(",")[0] not in self.COMPRESSIONS:
+            raise Exception(f"Invalid compression '{value}' (allowed: {', '.join(self.COMPRESSIONS)})")
+        self._compression = value
+
+    @property
+    def threads(self) -> int:
+        """Number of threads used for compressing (defaults to the number of CPUs)"""
+        return self._threads or os.cpu_count() or 1
+
+    @threads.setter
+    def threads(self, value: int) -> None:
+        if value < 0:
+            raise Exception("The number of threads must not be negative")
+        self._threads = value
+
+    def prepare(self) -> None:
+        self.content.acquire()
+        self._auto_size = self.size.is_undefined
+        # The size of the filesystem is only known after creating it
+        self.materialize()
+
+    def estimate(self) -> ResourceEstimate:
+        # The files are hardlinked into the staging directory, if possible
+        return ResourceEstimate(
+            data=self.size.bytes,
+            temp_files=[self.size.bytes],
+            temp_other=self.content.estimate().temp
+        )
+
+    def do_materialize(self) -> None:
+        self.content.prepare()
+        self.content.materialize()
+        self._materialize_result()
+        # The files are part of the filesystem now
+        self.content.release()
+
+    def _prepare_result(self):
+        with TemporaryDirectory(dir=BuildLocation().path) as diro:
+            tmp_dir = Path(diro)
+            fr = self.content.stage(tmp_dir)
+            # The tools read the ownership of the files from the fakeroot state
+            fr.run(self._mkfs_command(tmp_dir, self.result_file))
+            fr.savefile.unlink(missing_ok=True)
+
+        fs_size = self.result_file.stat().st_size
+        if self._auto_size:
+            self.size = SizeType(math.ceil(fs_size / self.ALIGNMENT) * self.ALIGNMENT)
+        elif fs_size > self.size.bytes:
+            raise Exception(f"The filesystem ({fs_size} B) does not fit into the content ({self.size.bytes} B)")
+        os.truncate(self.result_file, self.size.bytes)
+
+    @abc.abstractmethod
+    def _mkfs_command(self, directory: Path, image: Path) -> List[Union[str, Path]]:
+        """Command line for creating a filesystem in image containing the files in directory"""
+
+    def do_write(self, file: io.BufferedIOBase):
+        with open(self.result_file, "rb") as in_file:
+            copy_sparse(file, in_file, self.size.bytes)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.content})"
@@ -7,6 +7,7 @@ from pathlib import Path
 from ..utils.FakeRoot import FakeRoot
 from ..utils.image import get_temp_file
 from .BaseContent import BaseContent
+from .ResourceEstimate import ResourceEstimate
 
 class FilesContentProvider(BaseContent, abc.ABC):
     """Base class for all content providers, that provide a list of files
@@ -22,7 +23,22 @@ class FilesContentProvider(BaseContent, abc.ABC):
     def fakeroot(self) -> FakeRoot:
         return self._fakeroot
 
+    def estimate(self) -> ResourceEstimate:
+        # The files are not written to the image directly
+        return ResourceEstimate()
+
     @property
     @abc.abstractmethod
     def files(self) -> List[Path]:
         pass
+
+    def stage(self, directory: Path) -> FakeRoot:
+        """Copy all files into directory, preserving their attributes
+
+        Returns a new fakeroot, that contains the state of the copied files.
+        The caller is responsible for removing its savefile.
+        """
+        fr = FakeRoot(get_temp_file(), self.fakeroot)
+        for file in self.files:
+            fr.copy(file, directory)
+        return fr
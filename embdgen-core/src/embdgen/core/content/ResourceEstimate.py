@@ -0,0 +1,26 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from dataclasses import dataclass, field
+from typing import List
+
+
+@dataclass
+class ResourceEstimate:
+    """Estimated resources required for generating a content (see ``BaseContent.estimate``)"""
+
+    data: int = 0
+    """Number of bytes with data written to the image (an upper bound of the allocated size)"""
+
+    temp_files: List[int] = field(default_factory=list)
+    """Sizes of the temporary files with a known size (these can be placed in RAM, see ``BuildLocation``)"""
+
+    temp_other: int = 0
+    """Size of other temporary data (e.g. unpacked archives)"""
+
+    memory: int = 0
+    """Memory used while materializing the content, besides temporary files (e.g. buffers)"""
+
+    @property
+    def temp(self) -> int:
+        """Total size of all temporary data"""
+        return sum(self.temp_files) + self.temp_other
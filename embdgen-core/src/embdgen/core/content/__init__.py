@@ -3,3 +3,4 @@
 from .BaseContent import BaseContent
 from .BinaryContent import BinaryContent
 from .Factory import Factory
+from .ResourceEstimate import ResourceEstimate
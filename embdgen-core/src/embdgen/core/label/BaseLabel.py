@@ -1,17 +1,25 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 import abc
-from typing import List, Optional
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from typing import Deque, List, Optional, Sequence, Tuple, Union
 from pathlib import Path
 import parted # type: ignore
 from typing_extensions import TypeGuard
 
 from embdgen.plugins.region.PartitionRegion import PartitionRegion
+from embdgen.plugins.sink.BlockDeviceSink import BlockDeviceSink
+from embdgen.plugins.sink.RawSink import RawSink
+from embdgen.plugins.sink.UpdateSink import UpdateSink
 
-from embdgen.core.utils.SizeType import SizeType
-from embdgen.core.utils.image import create_empty_image
+from embdgen.core.utils.SizeType import SizeType, BYTES_PER_SECTOR
+from embdgen.core.utils.image import create_empty_image, copy_range_sparse, data_ranges, get_temp_file
 from ..utils.class_factory import Config
 from ..region import BaseRegion
+from ..region.BaseContentRegion import BaseContentRegion
+from ..sink import BaseSink, PositionalSinks, PositionalWriter, TeeWriter
 
 # pyparted built against libparted 3.4 has a bug and does not export PARTITION_ESP
 # If pyparted is built against libparted 3.5.28, it should be defined
@@ -128,15 +136,187 @@ class BaseLabel(abc.ABC):
                     boot_partition=part.name == self.boot_partition
                 )
 
-    def create(self, filename: Path) -> None:
-        size = self.parts[-1].start + self.parts[-1].size
-        create_empty_image(filename, size.bytes)
+    def _partition_table_data(self, size: int) -> List[Tuple[int, bytes]]:
+        """Create the partition table in memory
 
-        self.create_partition_table(filename)
+        The partition table is created in a temporary sparse file and all sectors
+        containing data are returned as (offset, data) tuples.
+        Parts of the sectors, that are overwritten by content regions, are cut out.
+        """
+        table_file = get_temp_file(ext=".table")
+        create_empty_image(table_file, size)
+        self.create_partition_table(table_file)
 
-        with filename.open("rb+") as f:
+        segments: List[Tuple[int, bytes]] = []
+        with table_file.open("rb+") as f:
             for part in self.parts:
-                part.write(f)
+                if not isinstance(part, BaseContentRegion):
+                    part.write(f)
+            f.flush()
+            for start, end in data_ranges(f.fileno(), 0, size):
+                f.seek(start)
+                data = f.read(end - start)
+                for sector in range(0, len(data), BYTES_PER_SECTOR):
+                    sector_data = data[sector:sector + BYTES_PER_SECTOR]
+                    if not any(sector_data):
+                        continue
+                    if segments and segments[-1][0] + len(segments[-1][1]) == start + sector:
+                        segments[-1] = (segments[-1][0], segments[-1][1] + sector_data)
+                    else:
+                        segments.append((start + sector, sector_data))
+        table_file.unlink()
+
+        for part in self.parts:
+            if isinstance(part, BaseContentRegion):
+                segments = self._clip_segments(segments, part.start.bytes, part.start.bytes + part.size.bytes)
+        return segments
+
+    @staticmethod
+    def _clip_segments(segments: List[Tuple[int, bytes]], start: int, end: int) -> List[Tuple[int, bytes]]:
+        """Remove the range from start to end from all segments"""
+        clipped = []
+        for offset, data in segments:
+            data_end = offset + len(data)
+            if data_end <= start or offset >= end:
+                clipped.append((offset, data))
+                continue
+            if offset < start:
+                clipped.append((offset, data[:start - offset]))
+            if data_end > end:
+                clipped.append((end, data[end - offset:]))
+        return clipped
+
+    def create(self, filename: Optional[Path], partition_dir: Optional[Path] = None, # pylint: disable=too-many-arguments
+               sinks: Optional[List[BaseSink]] = None, update_in_place: bool = False, jobs: int = 1, *,
+               filename_sink: Optional[BaseSink] = None) -> None:
+        """Create the image
+
+        The image is written to filename and to all additional sinks in a single pass
+        (see ``output_sink`` for how filename is written). If the sink for filename was
+        already created with ``output_sink``, it can be passed as filename_sink.
+        If filename is None, the image is only written to the sinks (e.g. streamed to stdout).
+
+        The regions are materialized (see ``BaseRegion.materialize``) by up to jobs threads,
+        while the already materialized regions are written to the image.
+        Each region is released (see ``BaseRegion.release``) right after it was written,
+        so intermediate files are removed as early as possible.
+        At most jobs regions are materialized and not yet released at the same time
+        (i.e. the region being written and up to jobs - 1 following regions).
+        If all sinks support random access, up to jobs regions are also written concurrently
+        (see ``PositionalWriter``).
+        If partition_dir is set, the content of each partition is additionally
+        written to ``<partition_dir>/<name>.img``.
+        """
+        if filename is None and partition_dir:
+            raise Exception("Exporting partitions requires an image file")
+        size = (self.parts[-1].start + self.parts[-1].size).bytes
+
+        segments = self._partition_table_data(size)
+        regions = [part for part in self.parts if isinstance(part, BaseContentRegion)]
+
+        all_sinks = [filename_sink or self.output_sink(filename, update_in_place)] if filename else []
+        all_sinks += sinks or []
+        if jobs > 1 and not any(sink.SEQUENTIAL for sink in all_sinks):
+            self._write_parallel(all_sinks, size, segments, regions, jobs)
+        else:
+            self._write_pipelined(all_sinks, size, segments, regions, jobs)
+
+        if filename and partition_dir:
+            self.export_partitions(filename, partition_dir)
+
+    @staticmethod
+    def _write_pipelined(sinks: List[BaseSink], size: int, segments: List[Tuple[int, bytes]],
+                         regions: Sequence[BaseRegion], jobs: int) -> None:
+        """Write all regions in ascending order, while the following regions are materialized"""
+        items: List[Tuple[int, Union[bytes, BaseRegion]]] = list(segments)
+        items += [(region.start.bytes, region) for region in regions]
+        items.sort(key=lambda x: x[0])
+
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        try:
+            # Region n + jobs is only materialized after region n was written and released
+            upcoming = iter([item for _, item in items if isinstance(item, BaseRegion)])
+            materialized: Deque[Future] = deque(
+                executor.submit(region.materialize) for region in islice(upcoming, jobs)
+            )
+            with TeeWriter(sinks, size) as writer:
+                for offset, item in items:
+                    if isinstance(item, bytes):
+                        writer.seek(offset)
+                        writer.write(item)
+                    else:
+                        materialized.popleft().result()
+                        item.write(writer)
+                        item.release()
+                        for region in islice(upcoming, 1):
+                            materialized.append(executor.submit(region.materialize))
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    @staticmethod
+    def _write_parallel(sinks: List[BaseSink], size: int, segments: List[Tuple[int, bytes]],
+                        regions: Sequence[BaseRegion], jobs: int) -> None:
+        """Write the partition table and then all regions concurrently with positional writers"""
+        ranges = [(offset, offset + len(data)) for offset, data in segments]
+        ranges += [(region.start.bytes, (region.start + region.size).bytes) for region in regions]
+        ranges.sort()
+
+        positional_sinks = PositionalSinks(sinks)
+
+        def write_region(region: BaseRegion) -> None:
+            region.materialize()
+            with PositionalWriter(positional_sinks, size) as writer:
+                region.write(writer)
+            region.release()
+
+        positional_sinks.open(size)
+        try:
+            with PositionalWriter(positional_sinks, size) as writer:
+                end = 0
+                for start, range_end in ranges + [(size, size)]:
+                    if start > end:
+                        writer.punch_hole(end, start - end)
+                    end = max(end, range_end)
+                for offset, data in segments:
+                    writer.seek(offset)
+                    writer.write(data)
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                for _ in executor.map(write_region, regions):
+                    pass
+        finally:
+            positional_sinks.close()
+
+    @staticmethod
+    def output_sink(filename: Path, update_in_place: bool = False) -> BaseSink:
+        """Create the sink for writing the image to filename
+
+        An existing image or device is only updated with ``UpdateSink``, if update_in_place is set.
+        Otherwise block devices are written with ``BlockDeviceSink`` and files with ``RawSink``.
+        Additional outputs (e.g. when writing to multiple devices at once) can be written
+        by passing the sinks returned by this method to ``create``.
+        """
+        if update_in_place:
+            return UpdateSink(filename)
+        if filename.is_block_device():
+            return BlockDeviceSink(filename)
+        return RawSink(filename)
+
+    def export_partitions(self, filename: Path, partition_dir: Path) -> None:
+        """Copy the content of all partitions from the image to separate files
+
+        The copies are made with reflinks, if supported by the filesystem,
+        and holes in the image are kept sparse.
+        """
+        partition_dir.mkdir(parents=True, exist_ok=True)
+        with filename.open("rb") as in_file:
+            for part in self.parts:
+                if not isinstance(part, PartitionRegion):
+                    continue
+                if "/" in part.name:
+                    raise Exception(f"Cannot export partition '{part.name}', the name contains a '/'")
+                with (partition_dir / f"{part.name}.img").open("wb") as out_file:
+                    out_file.truncate(part.size.bytes)
+                    copy_range_sparse(in_file.fileno(), out_file.fileno(), part.start.bytes, 0, part.size.bytes)
 
     @abc.abstractmethod
     def create_partition_table(self, filename: Path) -> None:
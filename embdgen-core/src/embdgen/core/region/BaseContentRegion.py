@@ -13,12 +13,18 @@ class BaseContentRegion(BaseRegion):
         if not self.size.is_undefined:
             self.content.size = self.size
         self.content.prepare()
+        self.content.acquire()
 
         if self.size.is_undefined:
             self.size = self.content.size
 
         super().prepare()
 
+    def materialize(self) -> None:
+        self.content.materialize()
+
+    def release(self) -> None:
+        self.content.release()
 
     def __repr__(self) -> str:
         return (f"{self.start.hex_bytes} - {(self.start + self.size).hex_bytes} Part {self.name}\n" +
@@ -44,6 +44,19 @@ class BaseRegion(abc.ABC):
         or even prepares a temporary file.
         """
 
+    def materialize(self) -> None:
+        """Generate the data of this region
+
+        This is called after ``prepare``, when the layout of the image is fixed
+        and can run concurrently with writing other regions.
+        """
+
+    def release(self) -> None:
+        """Called after this region was written to the image
+
+        This allows removing intermediate data, that is not required anymore.
+        """
+
     @abc.abstractmethod
     def write(self, out_file: io.BufferedIOBase):
         """Writes this region to the current position in ``out_file``"""
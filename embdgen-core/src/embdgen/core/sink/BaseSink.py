@@ -0,0 +1,56 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import abc
+from pathlib import Path
+
+
+class BaseSink(abc.ABC):
+    """Base class for output sinks
+
+    A sink receives the data of the image, while it is written by the label.
+    Every sink is driven by its own worker thread (see ``TeeWriter``),
+    so a slow sink does not block the other sinks.
+
+    If ``SEQUENTIAL`` is true, the sink receives all data in ascending order
+    and without gaps, i.e. ranges of the image without data are passed to ``discard``.
+    Otherwise the sink must support writing at arbitrary offsets.
+
+    If ``STREAMABLE`` is false, the sink seeks in its output file, so it cannot write
+    to a pipe or stdout.
+    """
+
+    SEQUENTIAL: bool = True
+
+    STREAMABLE: bool = True
+
+    filename: Path
+    """Output file of this sink"""
+
+    size: int
+    """Size of the image in bytes"""
+
+    def __init__(self, filename: Path) -> None:
+        self.filename = filename
+        self.size = 0
+
+    def open(self, size: int) -> None:
+        """Called before any data is written to the sink"""
+        self.size = size
+
+    @abc.abstractmethod
+    def write(self, offset: int, data: bytes) -> None:
+        """Write data at offset"""
+
+    @abc.abstractmethod
+    def discard(self, offset: int, length: int) -> None:
+        """The range from offset to offset + length contains only zeros"""
+
+    def close(self) -> None:
+        """Called after all data is written to the sink"""
+
+    def estimate_memory(self) -> int:
+        """Estimate the memory used by the sink (and its helper processes) while writing"""
+        return 0
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.filename})"
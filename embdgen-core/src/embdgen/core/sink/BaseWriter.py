@@ -0,0 +1,106 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import abc
+import io
+from typing import List, Tuple, Union
+
+from .BaseSink import BaseSink
+
+
+def raise_sink_errors(failed: List[Tuple[BaseSink, BaseException]]) -> None:
+    """Report the failures of all sinks (if any) in a single exception"""
+    if failed:
+        raise Exception("\n".join(
+            f"Writing to {sink} failed: {error}" for sink, error in failed
+        )) from failed[0][1]
+
+
+class BaseWriter(io.BufferedIOBase):
+    """Base class for file like objects, that pass the written data to sinks
+
+    Consecutive writes and discards (see ``punch_hole``) are combined into larger
+    operations, before they are passed to ``_dispatch``.
+    """
+    BUFFER_SIZE = 1024 * 1024
+
+    _size: int
+    _pos: int
+    _buffer: bytearray
+    _buffer_offset: int
+    _discard_offset: int
+    _discard_length: int
+
+    def __init__(self, size: int) -> None:
+        super().__init__()
+        self._size = size
+        self._pos = 0
+        self._buffer = bytearray()
+        self._buffer_offset = 0
+        self._discard_offset = 0
+        self._discard_length = 0
+
+    def seekable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._pos = offset
+        return self._pos
+
+    def write(self, b) -> int: # type: ignore[override]
+        length = len(b)
+        if not length:
+            return 0
+        self._flush_discard()
+        if self._buffer and self._buffer_offset + len(self._buffer) != self._pos:
+            self._flush_buffer()
+        if not self._buffer:
+            self._buffer_offset = self._pos
+        self._buffer += b
+        self._pos += length
+        if len(self._buffer) >= self.BUFFER_SIZE:
+            self._flush_buffer()
+        return length
+
+    def punch_hole(self, offset: int, length: int) -> None:
+        """Mark a range of the image as zeros"""
+        self._flush_buffer()
+        if self._discard_length and self._discard_offset + self._discard_length == offset:
+            self._discard_length += length
+            return
+        self._flush_discard()
+        self._discard_offset = offset
+        self._discard_length = length
+
+    def flush(self) -> None:
+        self._flush_buffer()
+        self._flush_discard()
+
+    def _flush_buffer(self) -> None:
+        if not self._buffer:
+            return
+        data = bytes(self._buffer)
+        self._buffer = bytearray()
+        self._dispatch("write", self._buffer_offset, data, len(data))
+
+    def _flush_discard(self) -> None:
+        if not self._discard_length:
+            return
+        length = self._discard_length
+        self._discard_length = 0
+        self._dispatch("discard", self._discard_offset, length, length)
+
+    @abc.abstractmethod
+    def _dispatch(self, op: str, offset: int, arg: Union[bytes, int], length: int) -> None:
+        """Pass a write (arg is the data) or discard (arg is the length) to the sinks"""
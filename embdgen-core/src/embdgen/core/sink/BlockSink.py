@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import abc
+
+from .BaseSink import BaseSink
+
+
+class BlockSink(BaseSink):
+    """Base class for sequential sinks, that process the image in blocks
+
+    Every block of ``BLOCK_SIZE`` bytes is either mapped (i.e. some data was written to it)
+    or unmapped (i.e. it was only discarded and contains zeros).
+    The last block of the image is shorter, if the image size is not a multiple of the block size.
+    """
+    BLOCK_SIZE = 4096
+
+    _block: bytearray
+    _block_mapped: bool
+
+    def open(self, size: int) -> None:
+        super().open(size)
+        self._block = bytearray()
+        self._block_mapped = False
+
+    @abc.abstractmethod
+    def mapped_blocks(self, data: bytes) -> None:
+        """Process one or more consecutive mapped blocks"""
+
+    @abc.abstractmethod
+    def unmapped_blocks(self, count: int) -> None:
+        """Process count consecutive unmapped blocks"""
+
+    def _emit_block(self) -> None:
+        if self._block_mapped:
+            self.mapped_blocks(bytes(self._block))
+        else:
+            self.unmapped_blocks(1)
+        self._block = bytearray()
+        self._block_mapped = False
+
+    def write(self, offset: int, data: bytes) -> None:
+        view = memoryview(data)
+        if self._block:
+            fill = min(len(view), self.BLOCK_SIZE - len(self._block))
+            self._block += view[:fill]
+            self._block_mapped = True
+            view = view[fill:]
+            if len(self._block) == self.BLOCK_SIZE:
+                self._emit_block()
+        full = len(view) - len(view) % self.BLOCK_SIZE
+        if full:
+            self.mapped_blocks(bytes(view[:full]))
+        if full < len(view):
+            self._block += view[full:]
+            self._block_mapped = True
+
+    def discard(self, offset: int, length: int) -> None:
+        if self._block:
+            fill = min(length, self.BLOCK_SIZE - len(self._block))
+            self._block += bytes(fill)
+            length -= fill
+            if len(self._block) == self.BLOCK_SIZE:
+                self._emit_block()
+        full = length - length % self.BLOCK_SIZE
+        if full:
+            self.unmapped_blocks(full // self.BLOCK_SIZE)
+        if full < length:
+            self._block += bytes(length - full)
+
+    def close(self) -> None:
+        if self._block:
+            self._emit_block()
+        super().close()
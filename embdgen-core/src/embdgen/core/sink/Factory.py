@@ -0,0 +1,17 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from typing import Dict, Type
+
+from embdgen.plugins import sink
+
+from ..utils.class_factory import FactoryBase
+from .BaseSink import BaseSink
+
+class Factory(FactoryBase[BaseSink]):
+    """
+    Factory class for output sinks
+    """
+
+    @classmethod
+    def load(cls) -> Dict[str, Type[BaseSink]]:
+        return cls.load_plugins(sink, BaseSink, 'SINK_TYPE')
@@ -0,0 +1,107 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import contextlib
+import threading
+from typing import Dict, List, Union
+
+from .BaseSink import BaseSink
+from .BaseWriter import BaseWriter, raise_sink_errors
+
+
+class PositionalSinks:
+    """Random access sinks, that are written by one or more ``PositionalWriter``
+
+    Like in ``TeeWriter``, a sink, that fails, is closed and does not receive any
+    further data, but all other sinks are still written completely.
+    The failures of all sinks are reported in a single exception by ``close``.
+    """
+
+    sinks: List[BaseSink]
+    _errors: Dict[int, BaseException]
+    _lock: threading.Lock
+
+    def __init__(self, sinks: List[BaseSink]) -> None:
+        sequential = [sink for sink in sinks if sink.SEQUENTIAL]
+        if sequential:
+            raise Exception(f"Positional writes are not supported by {', '.join(map(str, sequential))}")
+        self.sinks = sinks
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def _active(self) -> List[BaseSink]:
+        with self._lock:
+            return [sink for i, sink in enumerate(self.sinks) if i not in self._errors]
+
+    def _fail(self, sink: BaseSink, error: BaseException) -> None:
+        """Stop passing operations to the sink and release it (only the first error is reported)"""
+        with self._lock:
+            index = self.sinks.index(sink)
+            if index in self._errors:
+                return
+            self._errors[index] = error
+        with contextlib.suppress(Exception):
+            sink.close()
+
+    def _raise_errors(self) -> None:
+        with self._lock:
+            failed = [(self.sinks[i], self._errors[i]) for i in sorted(self._errors)]
+        raise_sink_errors(failed)
+
+    def open(self, size: int) -> None:
+        for sink in self.sinks:
+            try:
+                sink.open(size)
+            except Exception as e: # pylint: disable=broad-exception-caught
+                self._fail(sink, e)
+
+    def dispatch(self, op: str, offset: int, arg: Union[bytes, int]) -> None:
+        """Pass a write (arg is the data) or discard (arg is the length) to all working sinks"""
+        active = self._active()
+        if not active:
+            self._raise_errors()
+        for sink in active:
+            try:
+                if op == "write":
+                    sink.write(offset, arg) # type: ignore[arg-type]
+                else:
+                    sink.discard(offset, arg) # type: ignore[arg-type]
+            except Exception as e: # pylint: disable=broad-exception-caught
+                self._fail(sink, e)
+
+    def close(self) -> None:
+        for sink in self._active():
+            try:
+                sink.close()
+            except Exception as e: # pylint: disable=broad-exception-caught
+                with self._lock:
+                    self._errors[self.sinks.index(sink)] = e
+        self._raise_errors()
+
+
+class PositionalWriter(BaseWriter):
+    """File like object, that writes directly to random access sinks
+
+    In contrast to ``TeeWriter``, no worker threads are involved and the sinks are called
+    directly with the absolute offset of every write (i.e. like ``os.pwrite``).
+    This allows multiple positional writers to write different, non overlapping ranges
+    of the same sinks concurrently (e.g. one writer per region).
+
+    The sinks must be opened and closed by the caller (see ``PositionalSinks``).
+    """
+
+    _sinks: PositionalSinks
+
+    def __init__(self, sinks: PositionalSinks, size: int) -> None:
+        super().__init__(size)
+        self._sinks = sinks
+
+    def _dispatch(self, op: str, offset: int, arg: Union[bytes, int], length: int) -> None:
+        self._sinks.dispatch(op, offset, arg)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            super().close()
@@ -0,0 +1,128 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import contextlib
+import queue
+import threading
+from typing import List, Optional, Tuple, Union
+
+from .BaseSink import BaseSink
+from .BaseWriter import BaseWriter, raise_sink_errors
+
+_Operation = Optional[Tuple[str, int, Union[bytes, int]]]
+
+
+class _SinkWorker(threading.Thread):
+    """Thread, that passes all operations from its queue to a sink"""
+    QUEUE_SIZE = 64
+
+    sink: BaseSink
+    error: Optional[BaseException]
+    _size: int
+    _queue: "queue.Queue[_Operation]"
+
+    def __init__(self, sink: BaseSink, size: int) -> None:
+        super().__init__(name=f"sink-{sink}", daemon=True)
+        self.sink = sink
+        self.error = None
+        self._size = size
+        self._queue = queue.Queue(self.QUEUE_SIZE)
+
+    def put(self, operation: _Operation) -> None:
+        self._queue.put(operation)
+
+    def run(self) -> None:
+        try:
+            self.sink.open(self._size)
+        except BaseException as e: # pylint: disable=broad-exception-caught
+            self._fail(e)
+        while True:
+            operation = self._queue.get()
+            if operation is None:
+                break
+            if self.error:
+                continue # Drain the queue, to not block the writer
+            op, offset, arg = operation
+            try:
+                if op == "write":
+                    self.sink.write(offset, arg) # type: ignore[arg-type]
+                else:
+                    self.sink.discard(offset, arg) # type: ignore[arg-type]
+            except BaseException as e: # pylint: disable=broad-exception-caught
+                self._fail(e)
+        if not self.error:
+            try:
+                self.sink.close()
+            except BaseException as e: # pylint: disable=broad-exception-caught
+                self.error = e
+
+    def _fail(self, error: BaseException) -> None:
+        """Stop passing operations to the sink and release it (the original error is reported)"""
+        self.error = error
+        with contextlib.suppress(Exception):
+            self.sink.close()
+
+
+class TeeWriter(BaseWriter):
+    """File like object, that passes everything written to it to multiple sinks.
+
+    Consecutive writes and discards (see ``punch_hole``) are combined into larger
+    operations, that are queued for a worker thread per sink.
+    The data buffers are shared between all sinks, so every byte of the image is
+    only passed through once, no matter how many sinks are used.
+
+    Gaps between the written ranges are passed to the sinks as discarded ranges.
+    If at least one sink is sequential, all writes must be done in ascending order.
+
+    If a sink fails, it is closed and does not receive any further data, but all other sinks
+    are still written completely. The failures of all sinks are reported in
+    a single exception, when the writer is closed.
+    """
+
+    MAX_BUFFERED = _SinkWorker.QUEUE_SIZE * BaseWriter.BUFFER_SIZE
+    """Upper bound of the data queued for slow sinks (the buffers are shared between all sinks)"""
+
+    _workers: List[_SinkWorker]
+    _sequential: bool
+    _end: int
+
+    def __init__(self, sinks: List[BaseSink], size: int) -> None:
+        super().__init__(size)
+        self._end = 0
+        self._sequential = any(sink.SEQUENTIAL for sink in sinks)
+        self._workers = [_SinkWorker(sink, size) for sink in sinks]
+        for worker in self._workers:
+            worker.start()
+
+    def _dispatch(self, op: str, offset: int, arg: Union[bytes, int], length: int) -> None:
+        if offset < self._end and self._sequential:
+            raise Exception(f"Non-sequential write at offset {offset} (already written up to {self._end})")
+        if offset > self._end:
+            self._send(("discard", self._end, offset - self._end))
+        self._send((op, offset, arg))
+        self._end = max(self._end, offset + length)
+
+    def _send(self, operation: _Operation) -> None:
+        active = [worker for worker in self._workers if not worker.error]
+        if not active:
+            self._raise_errors()
+        for worker in active:
+            worker.put(operation)
+
+    def _raise_errors(self) -> None:
+        raise_sink_errors([(worker.sink, worker.error) for worker in self._workers if worker.error])
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self.flush()
+            if self._end < self._size:
+                self._send(("discard", self._end, self._size - self._end))
+                self._end = self._size
+        finally:
+            for worker in self._workers:
+                worker.put(None)
+            for worker in self._workers:
+                worker.join()
+            super().close()
+        self._raise_errors()
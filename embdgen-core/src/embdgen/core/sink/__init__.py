@@ -0,0 +1,8 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from .BaseSink import BaseSink
+from .BlockSink import BlockSink
+from .BaseWriter import BaseWriter
+from .TeeWriter import TeeWriter
+from .PositionalWriter import PositionalSinks, PositionalWriter
+from .Factory import Factory
@@ -1,13 +1,14 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 from collections import deque
+import json
 import os
 from pathlib import Path
 import shutil
 import stat
 import subprocess
 import sys
-from typing import Deque, Iterable, Optional, Tuple, List, Union
+from typing import Deque, Dict, Iterable, Optional, Tuple, List, Union
 
 
 class FakeRoot():
@@ -32,6 +33,19 @@ class FakeRoot():
         if parent and parent._savefile.exists():
             shutil.copyfile(parent._savefile, self._savefile)
 
+    @classmethod
+    def combine(cls, savefile: Path, parents: Iterable["FakeRoot"]) -> "FakeRoot":
+        """
+        Create a fakeroot, that imports the state files of all parents.
+
+        The state is recorded per inode, so the parents should manage distinct files.
+        """
+        with savefile.open("wb") as out_file:
+            for parent in parents:
+                if parent.savefile.exists():
+                    out_file.write(parent.savefile.read_bytes())
+        return cls(savefile)
+
     @property
     def savefile(self) -> Path:
         return self._savefile
@@ -72,53 +86,113 @@ class FakeRoot():
         the same target.
         Files are either hardlinked, if possible, or copied.
         """
-        mod_self = sys.modules[__name__].__spec__
-        if not mod_self: # pragma: no cover
-            raise Exception("Cannot determine the module name of FakeRoot")
         dest.mkdir(parents=True, exist_ok=True)
         self.run([
             sys.executable,
-            "-m", mod_self.name,
+            "-m", _module_name(),
             src, dest
         ])
 
-def copy_recursive(src_: Path, dest_: Path):
-    to_do: Deque[Tuple[Iterable[Path], Path]] = deque([([src_], dest_)])
+    def stat_tree(self, directory: Path) -> Dict[str, List[int]]:
+        """
+        Get the attributes of directory and all files below it, as seen in the fakeroot.
+
+        The result maps the paths relative to directory (the directory itself is "")
+        to st_mode, st_uid, st_gid, st_size, st_mtime (in seconds), st_rdev and st_ino.
+        """
+        res = self.run([
+            sys.executable,
+            "-m", _module_name(),
+            "--stat", directory
+        ], stdout=subprocess.PIPE, encoding="utf8")
+        return json.loads(res.stdout)
+
+    def copy_entries(self, entries: Iterable[Tuple[Path, Path]]) -> None:
+        """
+        Copy single files (src, dest) without the contents of directories.
+
+        Like in ``copy``, all attributes are preserved and files are hardlinked, if possible.
+        The parent directory of every dest must exist or be created by a previous entry.
+        """
+        self.run([
+            sys.executable,
+            "-m", _module_name(),
+            "--entries"
+        ], input=json.dumps([[str(src), str(dest)] for src, dest in entries]), encoding="ascii")
+
 
+def _module_name() -> str:
+    mod_self = sys.modules[__name__].__spec__
+    if not mod_self: # pragma: no cover
+        raise Exception("Cannot determine the module name of FakeRoot")
+    return mod_self.name
+
+def copy_entry(src: Path, dest: Path) -> bool:
+    """Copy a single file or directory (without its content), returns True for directories"""
     def copy_attrs(src: Path, dest: Path, sstat: os.stat_result) -> None:
         shutil.copystat(src, dest)
         os.chown(dest, sstat.st_uid, sstat.st_gid)
 
+    sstat: os.stat_result = src.lstat()
+
+    if stat.S_ISLNK(sstat.st_mode):
+        dest.symlink_to(src.readlink())
+    elif stat.S_ISDIR(sstat.st_mode):
+        dest.mkdir(exist_ok=True)
+        copy_attrs(src, dest, sstat)
+        return True
+    elif stat.S_ISCHR(sstat.st_mode) or stat.S_ISBLK(sstat.st_mode) or stat.S_ISFIFO(sstat.st_mode):
+        os.mknod(dest, sstat.st_mode, sstat.st_rdev)
+        copy_attrs(src, dest, sstat)
+    elif stat.S_ISREG(sstat.st_mode):
+        try:
+            os.link(src, dest)
+        except OSError:
+            # Fallback to copy, if hardlink does not work
+            shutil.copyfile(src, dest)
+            copy_attrs(src, dest, sstat)
+    else: # pragma: no cover
+        raise Exception(f"Unable to copy {src}, unknown file type: {sstat.st_mode}")
+    return False
+
+def copy_recursive(src_: Path, dest_: Path):
+    to_do: Deque[Tuple[Iterable[Path], Path]] = deque([([src_], dest_)])
+
     while to_do:
         srcs, dest_root = to_do.popleft()
         for src in srcs:
             dest = dest_root / src.name
-            sstat: os.stat_result = src.lstat()
-
-            if stat.S_ISLNK(sstat.st_mode):
-                dest.symlink_to(src.readlink())
-            elif stat.S_ISDIR(sstat.st_mode):
-                dest.mkdir(exist_ok=True)
-                copy_attrs(src, dest, sstat)
+            if copy_entry(src, dest):
                 to_do.append((list(src.iterdir()), dest))
-            elif stat.S_ISCHR(sstat.st_mode) or stat.S_ISBLK(sstat.st_mode) or stat.S_ISFIFO(sstat.st_mode):
-                os.mknod(dest, sstat.st_mode, sstat.st_rdev)
-                copy_attrs(src, dest, sstat)
-            elif stat.S_ISREG(sstat.st_mode):
-                try:
-                    os.link(src, dest)
-                except OSError:
-                    # Fallback to copy, if hardlink does not work
-                    shutil.copyfile(src, dest)
-                    copy_attrs(src, dest, sstat)
-            else: # pragma: no cover
-                raise Exception(f"Unable to copy {src}, unknown file type: {sstat.st_mode}")
+
+def stat_recursive(directory: Path) -> Dict[str, List[int]]:
+    paths = [directory]
+    for root, dirs, files in os.walk(directory):
+        paths += [Path(root) / name for name in dirs + files]
+    result = {}
+    for path in paths:
+        sstat = path.lstat()
+        rel = path.relative_to(directory).as_posix()
+        result["" if rel == "." else rel] = [
+            sstat.st_mode, sstat.st_uid, sstat.st_gid, sstat.st_size,
+            int(sstat.st_mtime), sstat.st_rdev, sstat.st_ino
+        ]
+    return result
 
 def copy_main() -> int:
+    if sys.argv[1:] == ["--entries"]:
+        for src, dest in json.load(sys.stdin):
+            copy_entry(Path(src), Path(dest))
+        return 0
+
     if len(sys.argv) != 3: # pragma: no cover
         print("invalid arg count:", sys.argv)
         return 1
 
+    if sys.argv[1] == "--stat":
+        json.dump(stat_recursive(Path(sys.argv[2])), sys.stdout)
+        return 0
+
     src = Path(sys.argv[1])
     dest = Path(sys.argv[2])
     copy_recursive(src, dest)
@@ -0,0 +1,314 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+"""
+Incremental updates of ext2/3/4 filesystems using debugfs
+
+The file tree of an existing filesystem is compared with a directory and
+only the differences are applied with a single debugfs script.
+Regular files are considered unchanged, if their size and modification time
+(in seconds) are unchanged. Optionally, the content of these files is compared as well,
+since modification times are often clamped (e.g. to ``SOURCE_DATE_EPOCH``)
+and do not indicate changes then.
+"""
+from __future__ import annotations
+
+import filecmp
+import os
+import re
+import stat
+import subprocess
+from dataclasses import dataclass, field
+from pathlib import Path, PurePosixPath
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional, Set, Tuple
+
+from .FakeRoot import FakeRoot
+from .image import BuildLocation
+
+_STAT_MTIME = re.compile(r"^\s*mtime: 0x([0-9a-f]+)", re.MULTILINE)
+_STAT_DEVICE = re.compile(r"Device major/minor number:\s+(\d+):(\d+)")
+_STAT_LINK = re.compile(r'Fast link dest: "(.*)"$', re.MULTILINE)
+_NON_CONTIGUOUS = re.compile(r"\(([0-9.]+)% non-contiguous\)")
+
+# Maximum size of the files extracted at once for comparing their content
+_COMPARE_BATCH = 256 * 1024 * 1024
+
+# Directories created by mke2fs, that are kept, even if they are missing in the new tree
+_KEEP = {"lost+found"}
+
+
+@dataclass
+class Inode:
+    """Attributes of a file, that are compared and updated"""
+
+    mode: int
+    uid: int
+    gid: int
+    size: int = 0
+    mtime: int = 0
+    rdev: Tuple[int, int] = (0, 0)
+    link: Optional[str] = None
+    """Target of a symbolic link (None, if it is unknown)"""
+
+    @property
+    def is_dir(self) -> bool:
+        return stat.S_ISDIR(self.mode)
+
+    def same_file(self, other: Inode) -> bool:
+        """Check if the other inode has the same type and content
+
+        For regular files only the size and modification time are compared (see ``changed_files``).
+        """
+        if stat.S_IFMT(self.mode) != stat.S_IFMT(other.mode):
+            return False
+        if stat.S_ISREG(self.mode):
+            return (self.size, self.mtime) == (other.size, other.mtime)
+        if stat.S_ISLNK(self.mode):
+            return self.link is not None and self.link == other.link
+        if stat.S_ISCHR(self.mode) or stat.S_ISBLK(self.mode):
+            return self.rdev == other.rdev
+        return True
+
+
+@dataclass
+class Update:
+    """Changes required for updating a filesystem"""
+
+    script: List[str] = field(default_factory=list)
+    """debugfs commands applying the changes"""
+
+    written: int = 0
+    """Number of bytes of regular files, that are written"""
+
+    total: int = 0
+    """Number of bytes of all regular files in the new tree"""
+
+
+def _quote(arg: str) -> str:
+    return f'"{arg}"'
+
+
+def _supported_name(name: str) -> bool:
+    return '"' not in name and "\n" not in name
+
+
+def _debugfs(image: Path, commands: List[str], write: bool = False) -> List[str]:
+    """Run commands with debugfs and return the output of each command"""
+    res = subprocess.run(
+        ["debugfs", *(["-w"] if write else []), "-f", "-", image],
+        input="\n".join(commands) + "\n", stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        encoding="utf8", errors="surrogateescape", check=True
+    )
+    errors = [line for line in res.stderr.splitlines() if line and not line.startswith("debugfs ")]
+    if errors:
+        raise Exception(f"debugfs failed on {image}: {errors[0]}")
+    outputs: List[str] = []
+    for line in res.stdout.splitlines():
+        if line.startswith("debugfs: "):
+            outputs.append("")
+        elif outputs:
+            outputs[-1] += line + "\n"
+    if len(outputs) != len(commands):
+        raise Exception(f"Unexpected output of debugfs for {image}")
+    return outputs
+
+
+def read_tree(image: Path) -> Optional[Dict[str, Inode]]:
+    """
+    Read the attributes of all files in the filesystem in image.
+
+    The paths are relative to the root directory. Returns None,
+    if the filesystem contains names, that cannot be handled in debugfs scripts.
+    """
+    tree: Dict[str, Inode] = {}
+    level = [""]
+    while level:
+        outputs = _debugfs(image, [f"ls -p {_quote('/' + path)}" for path in level])
+        next_level = []
+        for parent, output in zip(level, outputs):
+            for line in output.splitlines():
+                if not line.startswith("/"):
+                    continue
+                _, mode, uid, gid, name, size = line[1:].split("/")[:6]
+                if name in ("", ".", ".."):
+                    continue
+                if not _supported_name(name):
+                    return None
+                path = f"{parent}/{name}" if parent else name
+                tree[path] = Inode(int(mode, 8), int(uid), int(gid), int(size or 0))
+                if tree[path].is_dir:
+                    next_level.append(path)
+        level = next_level
+    _read_stat(image, tree)
+    return tree
+
+
+def _read_stat(image: Path, tree: Dict[str, Inode]) -> None:
+    """Read the attributes, that are not listed by ls, of all files in tree"""
+    paths = list(tree)
+    for path, output in zip(paths, _debugfs(image, [f"stat {_quote('/' + path)}" for path in paths])):
+        inode = tree[path]
+        mtime = _STAT_MTIME.search(output)
+        inode.mtime = int(mtime.group(1), 16) if mtime else 0
+        device = _STAT_DEVICE.search(output)
+        if device:
+            inode.rdev = (int(device.group(1)), int(device.group(2)))
+        link = _STAT_LINK.search(output)
+        if link:
+            inode.link = link.group(1)
+
+
+def local_tree(fakeroot: FakeRoot, directory: Path) -> Optional[Dict[str, Inode]]:
+    """
+    Read the attributes of all files below directory, as seen in fakeroot.
+
+    Like in ``read_tree``, the directory itself is not included.
+
+    Returns None, if the tree contains files, that cannot be updated incrementally
+    (i.e. hardlinks, extended attributes and unsupported names).
+    """
+    tree: Dict[str, Inode] = {}
+    inodes: Set[int] = set()
+    for path, (mode, uid, gid, size, mtime, rdev, ino) in fakeroot.stat_tree(directory).items():
+        if not path:
+            continue # Like mke2fs -d, the attributes of the root directory are not copied
+        local = directory / path
+        if not _supported_name(path) or ino in inodes:
+            return None
+        inodes.add(ino)
+        if os.listxattr(local, follow_symlinks=False):
+            return None
+        tree[path] = Inode(mode, uid, gid, size, mtime, (os.major(rdev), os.minor(rdev)),
+                           os.readlink(local) if stat.S_ISLNK(mode) else None)
+    return tree
+
+
+def changed_files(image: Path, old: Dict[str, Inode], new: Dict[str, Inode], directory: Path) -> Set[str]:
+    """
+    Compare the content of the regular files, that are the same according to ``Inode.same_file``.
+
+    The files are extracted from the filesystem in image in batches and compared
+    with the files in directory. Returns the paths of the files with a different content.
+    """
+    batches: List[List[str]] = []
+    batch_size = 0
+    for path, inode in new.items():
+        if not stat.S_ISREG(inode.mode) or path not in old or not old[path].same_file(inode):
+            continue
+        if not batches or batch_size + inode.size > _COMPARE_BATCH:
+            batches.append([])
+            batch_size = 0
+        batches[-1].append(path)
+        batch_size += inode.size
+
+    changed: Set[str] = set()
+    with TemporaryDirectory(dir=BuildLocation().path) as tmp_dir:
+        for batch in batches:
+            dumped = [Path(tmp_dir) / str(i) for i in range(len(batch))]
+            _debugfs(image, [f"dump {_quote('/' + path)} {_quote(str(out))}" for path, out in zip(batch, dumped)])
+            for path, out in zip(batch, dumped):
+                if not filecmp.cmp(out, directory / path, shallow=False):
+                    changed.add(path)
+                out.unlink()
+    return changed
+
+
+def _depth(path: str) -> Tuple[str, ...]:
+    return PurePosixPath(path).parts
+
+
+def plan_update(old: Dict[str, Inode], new: Dict[str, Inode], directory: Path,
+                image: Optional[Path] = None) -> Update:
+    """
+    Create the debugfs script, that updates a filesystem containing the old tree to the new tree.
+
+    The files of the new tree are read from directory. If image (containing the old tree)
+    is set, the content of the regular files is compared as well (see ``changed_files``).
+    """
+    update = Update(total=sum(inode.size for inode in new.values() if stat.S_ISREG(inode.mode)))
+    changed_content = changed_files(image, old, new, directory) if image else set()
+    removed = [path for path, inode in old.items() if path.split("/")[0] not in _KEEP and
+               (path not in new or not inode.same_file(new[path]) or path in changed_content)]
+    # Children are removed before their parents
+    for path in sorted(removed, key=lambda x: len(_depth(x)), reverse=True):
+        update.script.append(f"{'rmdir' if old[path].is_dir else 'rm'} {_quote('/' + path)}")
+
+    removed_set = set(removed)
+    touched: Set[str] = set()
+    for path in sorted(new, key=_depth):
+        inode = new[path]
+        absolute = "/" + path
+        if path not in old or path in removed_set:
+            touched.add(str(PurePosixPath(absolute).parent))
+            update.script += _create(absolute, inode, directory / path)
+            if stat.S_ISREG(inode.mode):
+                update.written += inode.size
+            changed = True
+        else:
+            changed = _attributes(inode) != _attributes(old[path])
+        if changed and not inode.is_dir:
+            update.script += _set_attributes(absolute, inode)
+    for path in removed:
+        touched.add(str(PurePosixPath("/" + path).parent))
+
+    # The attributes of the directories are set last, as changing their entries modifies them
+    for path in sorted(new, key=_depth):
+        inode = new[path]
+        absolute = "/" + path
+        if inode.is_dir and (absolute in touched or path not in old or path in removed_set or
+                             _attributes(inode) != _attributes(old[path])):
+            update.script += _set_attributes(absolute, inode)
+    return update
+
+
+def _attributes(inode: Inode) -> Tuple[int, int, int, int]:
+    return inode.mode, inode.uid, inode.gid, inode.mtime
+
+
+def _create(path: str, inode: Inode, local: Path) -> List[str]:
+    parent, name = str(PurePosixPath(path).parent), PurePosixPath(path).name
+    if inode.is_dir:
+        return [f"mkdir {_quote(path)}"]
+    if stat.S_ISLNK(inode.mode):
+        return [f"symlink {_quote(path)} {_quote(inode.link or '')}"]
+    # write and mknod create the file in the current directory
+    commands = [f"cd {_quote(parent)}"]
+    if stat.S_ISREG(inode.mode):
+        commands.append(f"write {_quote(str(local))} {_quote(name)}")
+    elif stat.S_ISCHR(inode.mode) or stat.S_ISBLK(inode.mode):
+        kind = "c" if stat.S_ISCHR(inode.mode) else "b"
+        commands.append(f"mknod {_quote(name)} {kind} {inode.rdev[0]} {inode.rdev[1]}")
+    elif stat.S_ISFIFO(inode.mode):
+        commands.append(f"mknod {_quote(name)} p")
+    else:
+        raise Exception(f"Unsupported file type of {local}")
+    return commands + ["cd /"]
+
+
+def _set_attributes(path: str, inode: Inode) -> List[str]:
+    return [
+        f"sif {_quote(path)} mode 0{inode.mode:o}",
+        f"sif {_quote(path)} uid {inode.uid}",
+        f"sif {_quote(path)} gid {inode.gid}",
+        f"sif {_quote(path)} mtime @{inode.mtime}",
+    ]
+
+
+def apply_update(image: Path, update: Update) -> None:
+    """Apply update to the filesystem in image (see ``plan_update``)"""
+    if update.script:
+        _debugfs(image, update.script, write=True)
+
+
+def fragmentation(image: Path) -> float:
+    """
+    Check the filesystem in image and get the percentage of non-contiguous files.
+
+    An exception is raised, if the check fails.
+    """
+    res = subprocess.run(["e2fsck", "-fn", image], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                         encoding="utf8", check=False)
+    match = _NON_CONTIGUOUS.search(res.stdout)
+    if res.returncode != 0 or not match:
+        raise Exception(f"Checking the filesystem in {image} failed:\n{res.stdout}")
+    return float(match.group(1))
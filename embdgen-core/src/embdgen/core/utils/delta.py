@@ -0,0 +1,327 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+"""
+Block level delta artifacts between two images
+
+A delta contains all blocks, that differ between a base image (e.g. the previous release)
+and a newly generated image. Applying the delta to a copy of the base image results in the new image.
+
+The delta file has the following format (all integers are little endian):
+
++-----------+--------+-----------------------------------------------+
+| Field     | Size   | Description                                   |
++===========+========+===============================================+
+| magic     | 8      | ``EMBDDLT1``                                  |
++-----------+--------+-----------------------------------------------+
+| blocksize | 4      | Block size used for the comparison            |
++-----------+--------+-----------------------------------------------+
+| size      | 8      | Size of the target image in bytes             |
++-----------+--------+-----------------------------------------------+
+| records   | ...    | Sequence of records, sorted by offset         |
++-----------+--------+-----------------------------------------------+
+
+Each record starts with a header of 17 bytes (``type``: 1 byte, ``offset``: 8 bytes, ``length``: 8 bytes):
+
+- ``type == 1`` (data): followed by ``length`` bytes, that are written at ``offset``
+- ``type == 2`` (zero): the range ``offset`` to ``offset + length`` is filled with zeros
+- ``type == 0`` (end): terminates the delta (``offset`` and ``length`` are 0)
+
+To avoid reading unchanged regions of the base image, a fingerprint file is written next to
+the generated image (``<image>.fingerprints``). It contains a sha256 hash for every chunk of every region.
+If the base image has such a file as well, chunks with identical hashes are skipped without
+reading the base image at all. The fingerprint file is written whenever a delta is created and
+can be written for any image with ``write_fingerprints`` (e.g. for release images, that are used
+as the base of later deltas).
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import hashlib
+import json
+import os
+from pathlib import Path
+import struct
+import sys
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from ..region.BaseRegion import BaseRegion
+from .image import data_ranges, zero_range
+
+MAGIC = b"EMBDDLT1"
+HEADER = struct.Struct("<8sIQ")
+RECORD = struct.Struct("<BQQ")
+
+RECORD_END = 0
+RECORD_DATA = 1
+RECORD_ZERO = 2
+
+BLOCK_SIZE = 4096
+CHUNK_SIZE = 4 * 1024 * 1024
+
+FINGERPRINT_VERSION = 1
+
+Record = Tuple[int, int, int, bytes]
+
+
+@dataclass
+class Extent:
+    """A range of the image, that is compared as a unit"""
+    name: str
+    start: int
+    size: int
+    chunks: List[str] = field(default_factory=list)
+
+    @property
+    def fingerprint(self) -> str:
+        return hashlib.sha256("".join(self.chunks).encode()).hexdigest()
+
+
+def fingerprint_file(image: Path) -> Path:
+    return image.with_name(image.name + ".fingerprints")
+
+
+def _file_size(fd: int) -> int:
+    """Size of a file or a block device (``st_size`` is 0 for block devices)"""
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def _chunks(extent: Extent) -> Iterator[Tuple[int, int]]:
+    """Offset and length of all chunks of an extent"""
+    for chunk_offset in range(0, extent.size, CHUNK_SIZE):
+        yield extent.start + chunk_offset, min(CHUNK_SIZE, extent.size - chunk_offset)
+
+
+def _extents(regions: Sequence[BaseRegion], size: int) -> List[Extent]:
+    """
+    Create extents for all regions and for the gaps between them
+    (these might contain data written by the partition table).
+    """
+    out = []
+    cur_offset = 0
+    for region in sorted(regions, key=lambda x: x.start):
+        if region.size.bytes == 0:
+            continue
+        if region.start.bytes > cur_offset:
+            out.append(Extent("", cur_offset, region.start.bytes - cur_offset))
+        out.append(Extent(region.name, region.start.bytes, region.size.bytes))
+        cur_offset = region.start.bytes + region.size.bytes
+    if cur_offset < size:
+        out.append(Extent("", cur_offset, size - cur_offset))
+    return out
+
+
+def _load_fingerprints(image: Path) -> Dict[Tuple[str, int, int], Extent]:
+    filename = fingerprint_file(image)
+    if not filename.exists():
+        return {}
+    data = json.loads(filename.read_text(encoding="utf-8"))
+    if data.get("version") != FINGERPRINT_VERSION or data.get("chunk_size") != CHUNK_SIZE:
+        return {}
+    return {
+        (e["name"], e["start"], e["size"]): Extent(e["name"], e["start"], e["size"], e["chunks"])
+        for e in data["extents"]
+    }
+
+
+def _write_fingerprints(image: Path, extents: List[Extent]) -> None:
+    fingerprint_file(image).write_text(json.dumps({
+        "version": FINGERPRINT_VERSION,
+        "chunk_size": CHUNK_SIZE,
+        "extents": [
+            {
+                "name": e.name,
+                "start": e.start,
+                "size": e.size,
+                "fingerprint": e.fingerprint,
+                "chunks": e.chunks
+            } for e in extents if e.name
+        ]
+    }, indent=1), encoding="utf-8")
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+def ordered_parallel(func: Callable[[T], R], items: Iterable[T], jobs: int) -> Iterator[R]:
+    """
+    Like ThreadPoolExecutor.map, but only keeps up to 2 * jobs items in flight,
+    so that the memory usage is bounded, if the consumer is slower than the workers.
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = []
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * jobs:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+class _Hasher:
+    _new_fd: int
+    _zero_chunk_hash: str
+
+    def __init__(self, new_fd: int) -> None:
+        self._new_fd = new_fd
+        self._zero_chunk_hash = hashlib.sha256(b"\0" * CHUNK_SIZE).hexdigest()
+
+    def _read_new(self, offset: int, length: int) -> Optional[bytes]:
+        """Read a chunk from the new image, returns None, if the chunk is a hole"""
+        if not any(True for _ in data_ranges(self._new_fd, offset, offset + length)):
+            return None
+        return os.pread(self._new_fd, length, offset)
+
+    def chunk_hash(self, offset: int, length: int) -> Tuple[str, Optional[bytes]]:
+        data = self._read_new(offset, length)
+        if data is None:
+            if length == CHUNK_SIZE:
+                return self._zero_chunk_hash, None
+            return hashlib.sha256(b"\0" * length).hexdigest(), None
+        return hashlib.sha256(data).hexdigest(), data
+
+
+class _Differ(_Hasher):
+    _old_fd: int
+    _old_size: int
+
+    def __init__(self, new_fd: int, old_fd: int) -> None:
+        super().__init__(new_fd)
+        self._old_fd = old_fd
+        self._old_size = _file_size(old_fd)
+
+    def _read_old(self, offset: int, length: int) -> bytes:
+        data = os.pread(self._old_fd, max(0, min(length, self._old_size - offset)), offset)
+        return data + b"\0" * (length - len(data))
+
+    def compare(self, offset: int, length: int, new_data: Optional[bytes]) -> List[Record]:
+        old_data = self._read_old(offset, length)
+        if new_data is None:
+            new_data = b"\0" * length
+        if old_data == new_data:
+            return []
+
+        runs: List[List[int]] = []
+        zero_block = b"\0" * BLOCK_SIZE
+        for block_offset in range(0, length, BLOCK_SIZE):
+            block_end = min(block_offset + BLOCK_SIZE, length)
+            new_block = new_data[block_offset:block_end]
+            if new_block == old_data[block_offset:block_end]:
+                continue
+            rec_type = RECORD_ZERO if new_block == zero_block[:len(new_block)] else RECORD_DATA
+            if runs and runs[-1][0] == rec_type and runs[-1][2] == block_offset:
+                runs[-1][2] = block_end
+            else:
+                runs.append([rec_type, block_offset, block_end])
+
+        records: List[Record] = []
+        for rec_type, start, end in runs:
+            records.append((rec_type, offset + start, end - start,
+                            new_data[start:end] if rec_type == RECORD_DATA else b""))
+        return records
+
+
+def create_delta(regions: Sequence[BaseRegion], image: Path, base: Path, delta: Path, # pylint: disable = too-many-locals
+                 jobs: Optional[int] = None) -> None:
+    """
+    Create a delta from base to image
+
+    The comparison is done in chunks, that are processed in parallel by ``jobs`` threads
+    (defaults to the number of cpus). Chunks, that are unchanged according to the fingerprints
+    of the base image, are not read from the base image.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    old_fingerprints = _load_fingerprints(base)
+
+    with image.open("rb") as new_file, base.open("rb") as old_file, delta.open("wb") as out_file:
+        size = _file_size(new_file.fileno())
+        extents = _extents(regions, size)
+        differ = _Differ(new_file.fileno(), old_file.fileno())
+        out_file.write(HEADER.pack(MAGIC, BLOCK_SIZE, size))
+
+        tasks = []
+        for extent in extents:
+            old_extent = old_fingerprints.get((extent.name, extent.start, extent.size))
+            for i, (offset, length) in enumerate(_chunks(extent)):
+                tasks.append((extent, offset, length, old_extent.chunks[i] if old_extent else None))
+
+        def process(task: Tuple[Extent, int, int, Optional[str]]) -> Tuple[Extent, str, List[Record]]:
+            extent, offset, length, old_hash = task
+            new_hash, new_data = differ.chunk_hash(offset, length)
+            if new_hash == old_hash:
+                return extent, new_hash, []
+            return extent, new_hash, differ.compare(offset, length, new_data)
+
+        for extent, chunk_hash, records in ordered_parallel(process, tasks, jobs):
+            extent.chunks.append(chunk_hash)
+            for rec_type, offset, length, data in records:
+                out_file.write(RECORD.pack(rec_type, offset, length))
+                out_file.write(data)
+
+        out_file.write(RECORD.pack(RECORD_END, 0, 0))
+
+    _write_fingerprints(image, extents)
+
+
+def write_fingerprints(regions: Sequence[BaseRegion], image: Path, jobs: Optional[int] = None) -> None:
+    """
+    Write the fingerprint file of image without creating a delta
+
+    Images with a fingerprint file can be used as the base of a later delta,
+    without reading the unchanged regions from them.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    with image.open("rb") as file:
+        extents = [extent for extent in _extents(regions, _file_size(file.fileno())) if extent.name]
+        hasher = _Hasher(file.fileno())
+
+        def process(task: Tuple[Extent, int, int]) -> Tuple[Extent, str]:
+            extent, offset, length = task
+            return extent, hasher.chunk_hash(offset, length)[0]
+
+        tasks = [(extent, offset, length) for extent in extents for offset, length in _chunks(extent)]
+        for extent, chunk_hash in ordered_parallel(process, tasks, jobs):
+            extent.chunks.append(chunk_hash)
+
+    _write_fingerprints(image, extents)
+
+
+def apply_delta(delta: Path, image: Path) -> None:
+    """
+    Apply a delta to image (in place).
+
+    The image must be a copy of the base image, that was used to create the delta.
+    """
+    with delta.open("rb") as in_file, image.open("rb+") as out_file:
+        magic, _, size = HEADER.unpack(in_file.read(HEADER.size))
+        if magic != MAGIC:
+            raise Exception(f"{delta} is not an embdgen delta file")
+        out_fd = out_file.fileno()
+        if not image.is_block_device():
+            os.ftruncate(out_fd, size)
+
+        while True:
+            header = in_file.read(RECORD.size)
+            if len(header) != RECORD.size:
+                raise Exception(f"Unexpected end of delta file {delta}")
+            rec_type, offset, length = RECORD.unpack(header)
+            if rec_type == RECORD_END:
+                break
+            if rec_type == RECORD_DATA:
+                os.pwrite(out_fd, in_file.read(length), offset)
+            elif rec_type == RECORD_ZERO:
+                zero_range(out_file, offset, length)
+            else:
+                raise Exception(f"Invalid record type {rec_type} in delta file {delta}")
+
+
+def apply_main() -> int:
+    if len(sys.argv) != 3: # pragma: no cover
+        print(f"usage: {sys.argv[0]} DELTA IMAGE")
+        return 1
+    apply_delta(Path(sys.argv[1]), Path(sys.argv[2]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(apply_main())
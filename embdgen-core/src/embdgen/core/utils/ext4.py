@@ -0,0 +1,183 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+"""
+Utility functions for reading the block allocation of ext2/3/4 filesystems
+"""
+import io
+import math
+import re
+import struct
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from .image import copy_sparse, punch_hole
+
+EXT4_MAGIC = 0xEF53
+INCOMPAT_META_BG = 0x10
+INCOMPAT_64BIT = 0x80
+BG_BLOCK_UNINIT = 0x2
+
+_NON_ZERO = re.compile(rb"[^\x00]+")
+
+
+def _read(file: BinaryIO, offset: int, length: int) -> bytes:
+    file.seek(offset)
+    data = file.read(length)
+    if len(data) != length:
+        raise Exception(f"Unexpected end of filesystem at offset {offset}")
+    return data
+
+
+def _superblock(file: BinaryIO) -> Optional[bytes]:
+    """Read the superblock, if file contains an ext2/3/4 filesystem"""
+    pos = file.tell()
+    try:
+        file.seek(1024)
+        superblock = file.read(1024)
+    finally:
+        file.seek(pos)
+    if len(superblock) != 1024 or struct.unpack_from("<H", superblock, 0x38)[0] != EXT4_MAGIC:
+        return None
+    return superblock
+
+
+def _bitmap_ranges(bitmap: bytes, count: int) -> Iterator[Tuple[int, int]]:
+    """Ranges (start, end) of consecutive set bits within the first count bits of bitmap"""
+    for match in _NON_ZERO.finditer(bitmap):
+        first, last = bitmap[match.start()], bitmap[match.end() - 1]
+        start = match.start() * 8 + (first & -first).bit_length() - 1
+        end = (match.end() - 1) * 8 + last.bit_length()
+        # Bits after the end of the filesystem are set as well in the last group
+        if start < count:
+            yield start, min(end, count)
+
+
+def used_ranges(file: BinaryIO) -> Optional[List[Tuple[int, int]]]: # pylint: disable = too-many-locals
+    """
+    Get the byte ranges (start, end) of all blocks in use by the ext2/3/4 filesystem in file.
+
+    The ranges are read from the block bitmaps of all block groups.
+    Block groups with an uninitialized block bitmap are treated as completely in use.
+    Returns None, if file does not contain a supported filesystem.
+    """
+    superblock = _superblock(file)
+    if superblock is None:
+        return None
+    pos = file.tell()
+    try:
+        blocks_count, = struct.unpack_from("<I", superblock, 0x4)
+        first_data_block, log_block_size = struct.unpack_from("<II", superblock, 0x14)
+        blocks_per_group, = struct.unpack_from("<I", superblock, 0x20)
+        feature_incompat, = struct.unpack_from("<I", superblock, 0x60)
+        desc_size, = struct.unpack_from("<H", superblock, 0xFE)
+        if feature_incompat & INCOMPAT_META_BG:
+            return None
+        if feature_incompat & INCOMPAT_64BIT:
+            blocks_count |= struct.unpack_from("<I", superblock, 0x150)[0] << 32
+        else:
+            desc_size = 32
+        block_size = 1024 << log_block_size
+
+        groups = math.ceil((blocks_count - first_data_block) / blocks_per_group)
+        descriptors = _read(file, (first_data_block + 1) * block_size, groups * desc_size)
+
+        # The blocks before the first group (i.e. the boot block) are always copied
+        blocks: List[Tuple[int, int]] = [(0, first_data_block)] if first_data_block else []
+
+        def add(start: int, end: int) -> None:
+            if blocks and blocks[-1][1] == start:
+                blocks[-1] = (blocks[-1][0], end)
+            else:
+                blocks.append((start, end))
+
+        for group in range(groups):
+            group_start = first_data_block + group * blocks_per_group
+            group_end = min(group_start + blocks_per_group, blocks_count)
+            descriptor = descriptors[group * desc_size:(group + 1) * desc_size]
+            bitmap_block, = struct.unpack_from("<I", descriptor, 0x0)
+            flags, = struct.unpack_from("<H", descriptor, 0x12)
+            if desc_size >= 64:
+                bitmap_block |= struct.unpack_from("<I", descriptor, 0x20)[0] << 32
+            if flags & BG_BLOCK_UNINIT:
+                add(group_start, group_end)
+                continue
+            bitmap = _read(file, bitmap_block * block_size, math.ceil((group_end - group_start) / 8))
+            for start, end in _bitmap_ranges(bitmap, group_end - group_start):
+                add(group_start + start, group_start + end)
+    finally:
+        file.seek(pos)
+
+    return [(start * block_size, end * block_size) for start, end in blocks]
+
+
+def filesystem_size(file: BinaryIO) -> Optional[int]:
+    """
+    Get the size of the ext2/3/4 filesystem in file (i.e. the number of blocks multiplied by the block size).
+
+    Returns None, if file does not contain an ext2/3/4 filesystem.
+    """
+    superblock = _superblock(file)
+    if superblock is None:
+        return None
+    blocks_count, = struct.unpack_from("<I", superblock, 0x4)
+    log_block_size, = struct.unpack_from("<I", superblock, 0x18)
+    feature_incompat, = struct.unpack_from("<I", superblock, 0x60)
+    if feature_incompat & INCOMPAT_64BIT:
+        blocks_count |= struct.unpack_from("<I", superblock, 0x150)[0] << 32
+    return blocks_count * (1024 << log_block_size)
+
+
+def copy_used(out_file: io.BufferedIOBase, in_file: BinaryIO, size: int) -> None:
+    """
+    Copy size bytes of the ext2/3/4 filesystem in in_file to the current position of out_file
+
+    Only blocks in use by the filesystem (see ``used_ranges``) are copied,
+    all other blocks are deallocated in out_file, to ensure they are 0.
+    If in_file does not contain a supported filesystem at offset 0,
+    it is copied from its current position with ``copy_sparse``.
+    """
+    ranges = used_ranges(in_file) if in_file.tell() == 0 else None
+    if ranges is None:
+        copy_sparse(out_file, in_file, size) # type: ignore[arg-type]
+        return
+
+    out_start = out_file.tell()
+    copied = 0
+    for range_start, range_end in ranges:
+        range_end = min(range_end, size)
+        if range_start >= range_end:
+            break
+        if range_start > copied:
+            punch_hole(out_file, out_start + copied, range_start - copied)
+        out_file.seek(out_start + range_start)
+        in_file.seek(range_start)
+        copy_sparse(out_file, in_file, range_end - range_start) # type: ignore[arg-type]
+        copied = range_end
+    if copied < size:
+        punch_hole(out_file, out_start + copied, size - copied)
+    # Like copy_sparse, allocate the whole output, if it ends with a hole
+    end = out_start + size
+    if out_file.seek(0, io.SEEK_END) < end:
+        out_file.seek(end - 1)
+        out_file.write(b"\0")
+    out_file.seek(end)
+    in_file.seek(size)
+
+
+def discard_unused(file: BinaryIO) -> None:
+    """
+    Deallocate all blocks of the ext2/3/4 filesystem in file, that are not in use (see ``used_ranges``)
+
+    Afterwards, the free blocks read as zeros (e.g. instead of the data of deleted files),
+    so the file contains the same data, that ``copy_used`` writes.
+    Nothing is done, if file does not contain a supported filesystem.
+    """
+    ranges = used_ranges(file)
+    size = filesystem_size(file)
+    if ranges is None or size is None:
+        return
+    pos = 0
+    for range_start, range_end in ranges + [(size, size)]:
+        range_start = min(range_start, size)
+        if range_start > pos:
+            punch_hole(file, pos, range_start - pos) # type: ignore[arg-type]
+        pos = max(pos, range_end)
@@ -0,0 +1,534 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+"""
+Size calculation and creation of FAT filesystems
+
+The calculation follows the layout created by mkfs.fat (dosfstools) with two FATs,
+512 byte sectors and no alignment of the data structures (``mkfs.fat -a``).
+FAT32 is used, if the data requires more clusters than FAT16 can address,
+otherwise FAT16 is used. Both are padded to the minimum number of clusters
+of the respective FAT type, so mkfs.fat does not choose a different type.
+
+``FatWriter`` creates a FAT12/16/32 filesystem with the same layout without any external tools.
+"""
+
+from __future__ import annotations
+
+from array import array
+from dataclasses import dataclass, field
+import io
+import math
+from pathlib import Path
+import re
+import struct
+import sys
+import time
+from typing import BinaryIO, Dict, Iterable, List, Optional, Set, Tuple
+import zlib
+
+from .image import copy_sparse, punch_hole
+
+SECTOR_SIZE = 512
+NUM_FATS = 2
+DIR_ENTRY_SIZE = 32
+LFN_CHARS = 13
+
+MAX_CLUSTERS_12 = 4084
+MIN_CLUSTERS_16 = 4085
+MAX_CLUSTERS_16 = 65524
+MIN_CLUSTERS_32 = 65529
+MAX_CLUSTERS_32 = 0x0FFFFFF5
+
+ROOT_ENTRIES_16 = 512
+RESERVED_SECTORS = {12: 1, 16: 1, 32: 32}
+MAX_CLUSTER_SIZE = 64 * 1024
+
+_SHORT_NAME = re.compile(r"[A-Z0-9!#$%&'()@^_`{}~-]{1,8}(\.[A-Z0-9!#$%&'()@^_`{}~-]{1,3})?")
+
+
+def check_cluster_size(cluster_size: int) -> None:
+    """Raise an exception, if cluster_size is not supported"""
+    if cluster_size <= 0 or cluster_size % SECTOR_SIZE or cluster_size & (cluster_size - 1) \
+            or cluster_size > MAX_CLUSTER_SIZE:
+        raise Exception(f"Invalid FAT cluster size {cluster_size} (must be a power of two between "
+                        f"{SECTOR_SIZE} and {MAX_CLUSTER_SIZE})")
+
+
+def dir_entries(name: str) -> int:
+    """Number of directory entries required for a file name (including the long file name entries)"""
+    if _SHORT_NAME.fullmatch(name):
+        return 1
+    return 1 + math.ceil(len(name.encode("utf-16-le")) // 2 / LFN_CHARS)
+
+
+def _clusters(path: Path, cluster_size: int) -> int:
+    if path.is_dir() and not path.is_symlink():
+        entries = 2 # . and ..
+        clusters = 0
+        for child in path.iterdir():
+            entries += dir_entries(child.name)
+            clusters += _clusters(child, cluster_size)
+        return clusters + math.ceil(entries * DIR_ENTRY_SIZE / cluster_size)
+    return math.ceil(path.stat().st_size / cluster_size)
+
+
+def clusters_required(files: Iterable[Path], cluster_size: int) -> Tuple[int, int]:
+    """
+    Get the number of data clusters required for copying files (recursively) into the root directory
+    and the number of entries in the root directory.
+    """
+    clusters = 0
+    root_entries = 1 # Volume label
+    for file in files:
+        root_entries += dir_entries(file.name)
+        clusters += _clusters(file, cluster_size)
+    return clusters, root_entries
+
+
+@dataclass
+class FatLayout:
+    """Layout of a FAT filesystem, as created by mkfs.fat"""
+
+    fat_bits: int
+    """Size of the FAT entries (12, 16 or 32)"""
+
+    cluster_size: int
+    """Size of a cluster in bytes"""
+
+    clusters: int
+    """Minimum number of data clusters"""
+
+    root_entries: int = 0
+    """Number of entries in the fixed root directory (FAT12 and FAT16 only)"""
+
+    @property
+    def reserved_sectors(self) -> int:
+        return RESERVED_SECTORS[self.fat_bits]
+
+    @property
+    def root_dir_sectors(self) -> int:
+        return math.ceil(self.root_entries * DIR_ENTRY_SIZE / SECTOR_SIZE)
+
+    def fat_sectors(self, clusters: int) -> int:
+        """Number of sectors of a FAT for the given number of data clusters"""
+        return math.ceil((clusters + 2) * self.fat_bits / (8 * SECTOR_SIZE))
+
+    def geometry(self, sectors: int) -> Tuple[int, int]:
+        """
+        Get the number of sectors of a FAT and the number of data clusters,
+        that mkfs.fat creates in a filesystem with the given number of sectors.
+        """
+        sectors_per_cluster = self.cluster_size // SECTOR_SIZE
+        fat_data = sectors - self.reserved_sectors - self.root_dir_sectors
+        clusters = (fat_data * SECTOR_SIZE * 8 + NUM_FATS * 2 * self.fat_bits) // \
+            (self.cluster_size * 8 + NUM_FATS * self.fat_bits)
+        fat_sectors = self.fat_sectors(clusters)
+        clusters = (fat_data - NUM_FATS * fat_sectors) // sectors_per_cluster
+        # The FAT must contain an entry for every cluster
+        return fat_sectors, min(clusters, fat_sectors * SECTOR_SIZE * 8 // self.fat_bits - 2)
+
+    def mkfs_clusters(self, sectors: int) -> int:
+        """Number of data clusters mkfs.fat creates in a filesystem with the given number of sectors"""
+        return self.geometry(sectors)[1]
+
+    @property
+    def size(self) -> int:
+        """Minimum size of the filesystem in bytes"""
+        sectors_per_cluster = self.cluster_size // SECTOR_SIZE
+        sectors = self.reserved_sectors + self.root_dir_sectors + NUM_FATS * self.fat_sectors(self.clusters)
+        sectors += self.clusters * sectors_per_cluster
+        while self.mkfs_clusters(sectors) < self.clusters:
+            sectors += sectors_per_cluster
+        return sectors * SECTOR_SIZE
+
+    def mkfs_options(self) -> List[str]:
+        """Options for mkfs.fat, to create this layout"""
+        options = [
+            "-F", str(self.fat_bits),
+            "-S", str(SECTOR_SIZE),
+            "-s", str(self.cluster_size // SECTOR_SIZE),
+            "-R", str(self.reserved_sectors),
+            "-f", str(NUM_FATS),
+            "-a"
+        ]
+        if self.fat_bits != 32:
+            options += ["-r", str(self.root_entries)]
+        return options
+
+    @classmethod
+    def for_size(cls, size: int, cluster_size: int, root_entries: int = ROOT_ENTRIES_16) -> FatLayout:
+        """
+        Get the layout of a filesystem of the given size.
+
+        The FAT type is determined by the number of clusters, that fit into the filesystem.
+        """
+        check_cluster_size(cluster_size)
+        root_entries = max(ROOT_ENTRIES_16, math.ceil(root_entries / 16) * 16)
+        sectors = size // SECTOR_SIZE
+        for fat_bits, min_clusters, max_clusters in [(12, 1, MAX_CLUSTERS_12),
+                                                     (16, MAX_CLUSTERS_12 + 1, MAX_CLUSTERS_16),
+                                                     (32, MAX_CLUSTERS_16 + 1, MAX_CLUSTERS_32)]:
+            layout = cls(fat_bits, cluster_size, 0, root_entries if fat_bits != 32 else 0)
+            _, layout.clusters = layout.geometry(sectors)
+            if min_clusters <= layout.clusters <= max_clusters:
+                return layout
+        raise Exception(f"No FAT layout for a filesystem of {size} B with a cluster size of {cluster_size} B")
+
+
+def minimum_layout(files: Iterable[Path], cluster_size: int, headroom: int = 0) -> FatLayout:
+    """
+    Calculate the smallest FAT layout, that can hold files (copied into the root directory)
+    and additionally headroom bytes of free space.
+    """
+    check_cluster_size(cluster_size)
+    clusters, root_entries = clusters_required(files, cluster_size)
+    clusters += math.ceil(headroom / cluster_size)
+
+    if clusters <= MAX_CLUSTERS_16:
+        root_entries = max(ROOT_ENTRIES_16, math.ceil(root_entries / 16) * 16)
+        return FatLayout(16, cluster_size, max(clusters, MIN_CLUSTERS_16), root_entries)
+
+    # The root directory is stored in clusters in FAT32
+    clusters += math.ceil(root_entries * DIR_ENTRY_SIZE / cluster_size)
+    if clusters > MAX_CLUSTERS_32:
+        raise Exception(f"The files require {clusters} clusters, but FAT32 supports only {MAX_CLUSTERS_32} "
+                        f"clusters (cluster size {cluster_size})")
+    return FatLayout(32, cluster_size, max(clusters, MIN_CLUSTERS_32))
+
+
+def fat_type(clusters: int) -> int:
+    """The FAT type (12, 16 or 32), that is determined by the number of clusters"""
+    if clusters <= MAX_CLUSTERS_12:
+        return 12
+    if clusters <= MAX_CLUSTERS_16:
+        return 16
+    return 32
+
+
+def short_name_checksum(short_name: bytes) -> int:
+    """Checksum of a short name, that is stored in the long file name entries"""
+    checksum = 0
+    for char in short_name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + char) & 0xFF
+    return checksum
+
+
+_SHORT_CHAR = re.compile(r"[A-Z0-9!#$%&'()@^_`{}~-]")
+
+
+def _short_name_basis(name: str) -> Tuple[str, str]:
+    """Generate the base name and extension of a short name for a long name"""
+    def clean(part: str) -> str:
+        return "".join(char if _SHORT_CHAR.fullmatch(char) else "_" for char in part if char not in " .")
+    name = name.upper().lstrip(".")
+    if "." in name:
+        base, ext = name.rsplit(".", 1)
+    else:
+        base, ext = name, ""
+    return clean(base) or "_", clean(ext)[:3]
+
+
+def short_names(names: Iterable[str]) -> Dict[str, bytes]:
+    """
+    Get the short names (8.3 format, 11 bytes) for all names in a directory.
+
+    Names, that are valid short names, are used as is. For all other names
+    a unique short name with a numeric tail (e.g. ``LONGNA~1.TXT``) is generated.
+    """
+    names = list(names)
+    result: Dict[str, bytes] = {}
+    used: Set[bytes] = set()
+    lower: Set[str] = set()
+    for name in names:
+        if name.lower() in lower:
+            raise Exception(f"Duplicate file name '{name}' (FAT file names are case insensitive)")
+        lower.add(name.lower())
+        if _SHORT_NAME.fullmatch(name):
+            base, _, ext = name.partition(".")
+            result[name] = f"{base:<8}{ext:<3}".encode("ascii")
+            used.add(result[name])
+    for name in names:
+        if name in result:
+            continue
+        base, ext = _short_name_basis(name)
+        for number in range(1, 1000000):
+            tail = f"~{number}"
+            short = f"{base[:8 - len(tail)] + tail:<8}{ext:<3}".encode("ascii")
+            if short not in used:
+                break
+        else: # pragma: no cover
+            raise Exception(f"No unique short name for '{name}' found")
+        result[name] = short
+        used.add(short)
+    return result
+
+
+def _timestamp(mtime: float) -> Tuple[int, int]:
+    """Convert a modification time to a FAT date and time (in UTC)"""
+    tm = time.gmtime(mtime)
+    if tm.tm_year < 1980:
+        return (1 << 5) | 1, 0
+    if tm.tm_year > 2107:
+        return (127 << 9) | (12 << 5) | 31, (23 << 11) | (59 << 5) | 29
+    return ((tm.tm_year - 1980) << 9) | (tm.tm_mon << 5) | tm.tm_mday, \
+        (tm.tm_hour << 11) | (tm.tm_min << 5) | (min(tm.tm_sec, 59) // 2)
+
+
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+_DIR_ENTRY = struct.Struct("<11sBBBHHHHHHHI")
+_LFN_ENTRY = struct.Struct("<B10sBBB12sH4s")
+
+
+def _dir_entry(short_name: bytes, attr: int, cluster: int, size: int, mtime: float) -> bytes:
+    date, tm = _timestamp(mtime)
+    return _DIR_ENTRY.pack(short_name, attr, 0, 0, tm, date, date, cluster >> 16, tm, date, cluster & 0xFFFF, size)
+
+
+def _lfn_entries(name: str, short_name: bytes) -> bytes:
+    """The long file name entries for name, in the order they are stored in the directory"""
+    chars = name.encode("utf-16-le")
+    count = math.ceil(len(chars) / (2 * LFN_CHARS))
+    if len(chars) % (2 * LFN_CHARS):
+        chars += b"\0\0"
+    chars = chars.ljust(count * 2 * LFN_CHARS, b"\xff")
+    checksum = short_name_checksum(short_name)
+    entries = []
+    for i in range(count):
+        part = chars[i * 2 * LFN_CHARS:(i + 1) * 2 * LFN_CHARS]
+        sequence = (i + 1) | (0x40 if i == count - 1 else 0)
+        entries.append(_LFN_ENTRY.pack(sequence, part[:10], ATTR_LONG_NAME, 0, checksum, part[10:22], 0, part[22:]))
+    return b"".join(reversed(entries))
+
+
+@dataclass
+class _Node:
+    """A file or directory in a FatWriter"""
+    name: str
+    path: Optional[Path]
+    mtime: float
+    size: int = 0
+    children: Optional[List[_Node]] = None
+    short_name: bytes = b""
+    cluster: int = 0
+    cluster_count: int = 0
+    data: bytes = b""
+
+    @property
+    def is_dir(self) -> bool:
+        return self.children is not None
+
+
+@dataclass
+class FatWriter:
+    """
+    Create a FAT filesystem containing files (copied recursively into the root directory)
+
+    The filesystem is written in ascending order (i.e. it can be streamed to an image),
+    files are stored in contiguous clusters in the order of the directory tree.
+    The entries of each directory are sorted by name, so the output only depends on the
+    files (names, sizes, modification times and content) and the layout.
+    If no volume_id is given, it is derived from the directory entries.
+    """
+    OEM_NAME = b"EMBDGEN "
+    MEDIA = 0xF8
+    LABEL = b"NO NAME    "
+
+    layout: FatLayout
+    """Layout of the filesystem (the number of clusters is determined by size)"""
+
+    size: int
+    """Size of the filesystem in bytes"""
+
+    files: Iterable[Path]
+    """Files and directories copied into the root directory"""
+
+    volume_id: Optional[int] = None
+    """Volume serial number"""
+
+    _root: _Node = field(init=False)
+    _nodes: List[_Node] = field(init=False)
+    _fat_sectors: int = field(init=False)
+    _clusters: int = field(init=False)
+    _used: int = field(init=False)
+
+    def __post_init__(self) -> None:
+        self._fat_sectors, self._clusters = self.layout.geometry(self.size // SECTOR_SIZE)
+        if self._clusters < 1 or fat_type(self._clusters) != self.layout.fat_bits:
+            raise Exception(f"A filesystem of {self.size} B cannot be formatted as FAT{self.layout.fat_bits}")
+        self._root = _Node("", None, 0, children=[self._node(Path(file), Path(file).name) for file in self.files])
+        self._nodes = []
+        self._used = 0
+        self._allocate(self._root)
+        self._allocate_children(self._root)
+        if self._used > self._clusters:
+            raise Exception(f"The files require {self._used} clusters, but the filesystem "
+                            f"has only {self._clusters} clusters")
+        self._build_directory(self._root, 0)
+        if self.volume_id is None:
+            self.volume_id = zlib.crc32(b"".join(node.data for node in self._nodes if node.is_dir) + self._root.data)
+
+    def _node(self, path: Path, name: str) -> _Node:
+        stat = path.stat()
+        if path.is_dir():
+            if path.is_symlink():
+                raise Exception(f"Symbolic links to directories are not supported in FAT filesystems ({path})")
+            children = [self._node(child, child.name) for child in sorted(path.iterdir())]
+            return _Node(name, path, stat.st_mtime, children=children)
+        if not path.is_file():
+            raise Exception(f"Only regular files and directories are supported in FAT filesystems ({path})")
+        return _Node(name, path, stat.st_mtime, stat.st_size)
+
+    def _allocate(self, node: _Node) -> None:
+        if node.is_dir:
+            entries = sum(dir_entries(child.name) for child in node.children or [])
+            if node is not self._root:
+                entries += 2 # . and ..
+            elif self.layout.fat_bits != 32:
+                if entries > self.layout.root_entries:
+                    raise Exception(f"Too many entries in the root directory ({entries} > {self.layout.root_entries})")
+                return
+            count = max(1, math.ceil(entries * DIR_ENTRY_SIZE / self.layout.cluster_size))
+        else:
+            count = math.ceil(node.size / self.layout.cluster_size)
+        if count:
+            node.cluster = self._used + 2
+            node.cluster_count = count
+            self._used += count
+            self._nodes.append(node)
+
+    def _allocate_children(self, node: _Node) -> None:
+        for child in node.children or []:
+            self._allocate(child)
+            if child.is_dir:
+                self._allocate_children(child)
+
+    def _build_directory(self, node: _Node, parent_cluster: int) -> None:
+        entries = []
+        if node is not self._root:
+            entries.append(_dir_entry(b".          ", ATTR_DIRECTORY, node.cluster, 0, node.mtime))
+            entries.append(_dir_entry(b"..         ", ATTR_DIRECTORY, parent_cluster, 0, node.mtime))
+        names = short_names(child.name for child in node.children or [])
+        for child in node.children or []:
+            child.short_name = names[child.name]
+            if not _SHORT_NAME.fullmatch(child.name):
+                entries.append(_lfn_entries(child.name, child.short_name))
+            entries.append(_dir_entry(child.short_name, ATTR_DIRECTORY if child.is_dir else ATTR_ARCHIVE,
+                                      child.cluster, child.size, child.mtime))
+            if child.is_dir:
+                # The root directory is always referenced as cluster 0
+                self._build_directory(child, 0 if node is self._root else node.cluster)
+        data = b"".join(entries)
+        if node is self._root and self.layout.fat_bits != 32:
+            node.data = data.ljust(self.layout.root_dir_sectors * SECTOR_SIZE, b"\0")
+        else:
+            node.data = data.ljust(node.cluster_count * self.layout.cluster_size, b"\0")
+
+    @property
+    def used_clusters(self) -> int:
+        """Number of clusters used by the files and directories"""
+        return self._used
+
+    def _boot_sector(self) -> bytes:
+        layout = self.layout
+        sectors = self.size // SECTOR_SIZE
+        small = sectors < 0x10000 and layout.fat_bits != 32
+        boot = bytearray(SECTOR_SIZE)
+        struct.pack_into(
+            "<3s8sHBHBHHBHHHII", boot, 0,
+            b"\xEB\x58\x90" if layout.fat_bits == 32 else b"\xEB\x3C\x90", self.OEM_NAME,
+            SECTOR_SIZE, layout.cluster_size // SECTOR_SIZE, layout.reserved_sectors, NUM_FATS,
+            layout.root_entries if layout.fat_bits != 32 else 0, sectors if small else 0, self.MEDIA,
+            self._fat_sectors if layout.fat_bits != 32 else 0, 63, 255, 0, 0 if small else sectors
+        )
+        fs_type = f"FAT{layout.fat_bits}".ljust(8).encode("ascii")
+        if layout.fat_bits == 32:
+            struct.pack_into("<IHHIHH12sBBBI11s8s", boot, 36, self._fat_sectors, 0, 0, self._root.cluster, 1, 6,
+                             b"", 0x80, 0, 0x29, self.volume_id, self.LABEL, fs_type)
+        else:
+            struct.pack_into("<BBBI11s8s", boot, 36, 0x80, 0, 0x29, self.volume_id, self.LABEL, fs_type)
+        boot[510:512] = b"\x55\xAA"
+        return bytes(boot)
+
+    def _fs_info(self) -> bytes:
+        info = bytearray(SECTOR_SIZE)
+        struct.pack_into("<I", info, 0, 0x41615252)
+        struct.pack_into("<IIII", info, 484, 0x61417272, self._clusters - self._used, self._used + 2, 0)
+        struct.pack_into("<I", info, 508, 0xAA550000)
+        return bytes(info)
+
+    def _fat(self) -> bytes:
+        bits = self.layout.fat_bits
+        end_of_chain = (1 << min(bits, 28)) - 1
+        entries = array("I" if bits == 32 else "H", bytes((self._clusters + 2) * (4 if bits == 32 else 2)))
+        entries[0] = (0x0FFFFF00 | self.MEDIA) & end_of_chain
+        entries[1] = end_of_chain
+        for node in self._nodes:
+            end = node.cluster + node.cluster_count - 1
+            entries[node.cluster:end] = array(entries.typecode, range(node.cluster + 1, end + 1))
+            entries[end] = end_of_chain
+        if bits == 12:
+            if len(entries) % 2:
+                entries.append(0)
+            data = bytearray()
+            for i in range(0, len(entries), 2):
+                first, second = entries[i], entries[i + 1]
+                data += bytes((first & 0xFF, (first >> 8) | ((second & 0xF) << 4), second >> 4))
+            fat = bytes(data)
+        else:
+            if sys.byteorder == "big": # pragma: no cover
+                entries.byteswap()
+            fat = entries.tobytes()
+        return fat.ljust(self._fat_sectors * SECTOR_SIZE, b"\0")
+
+    def write(self, out_file: BinaryIO) -> None:
+        """Write the filesystem to the current position of out_file"""
+        start = out_file.tell()
+        pos = 0
+
+        def write_at(offset: int, data: bytes) -> None:
+            nonlocal pos
+            if offset > pos:
+                punch_hole(out_file, start + pos, offset - pos) # type: ignore[arg-type]
+            out_file.seek(start + offset)
+            out_file.write(data)
+            pos = offset + len(data)
+
+        layout = self.layout
+        boot = self._boot_sector()
+        write_at(0, boot)
+        if layout.fat_bits == 32:
+            write_at(SECTOR_SIZE, self._fs_info())
+            write_at(6 * SECTOR_SIZE, boot + self._fs_info())
+
+        fat = self._fat()
+        fat_offset = layout.reserved_sectors * SECTOR_SIZE
+        for i in range(NUM_FATS):
+            write_at(fat_offset + i * len(fat), fat)
+        data_offset = fat_offset + NUM_FATS * len(fat)
+        if layout.fat_bits != 32:
+            write_at(data_offset, self._root.data)
+            data_offset += len(self._root.data)
+
+        for node in self._nodes:
+            if not node.cluster_count:
+                continue # Empty files have no clusters
+            offset = data_offset + (node.cluster - 2) * layout.cluster_size
+            if node.is_dir:
+                write_at(offset, node.data)
+                continue
+            write_at(offset, b"")
+            with node.path.open("rb") as in_file: # type: ignore[union-attr]
+                copy_sparse(out_file, in_file, node.size) # type: ignore[arg-type]
+            slack = node.cluster_count * layout.cluster_size - node.size
+            out_file.write(bytes(slack))
+            pos = offset + node.cluster_count * layout.cluster_size
+
+        if pos < self.size:
+            punch_hole(out_file, start + pos, self.size - pos) # type: ignore[arg-type]
+        # Ensure the complete filesystem is allocated (see copy_sparse)
+        if out_file.seek(0, io.SEEK_END) < start + self.size:
+            out_file.seek(start + self.size - 1)
+            out_file.write(b"\0")
+        out_file.seek(start + self.size)
@@ -5,54 +5,310 @@ Utility functions for working with images
 """
 from __future__ import annotations
 
+import contextlib
+import ctypes
+import errno
 import io
+import logging
 import os
+import subprocess
 import tempfile
+import threading
 import shutil
 
 from pathlib import Path
-from typing import Optional
+from typing import IO, Callable, Dict, Iterator, List, Optional, Tuple, Union
 from fallocate import fallocate, FALLOC_FL_PUNCH_HOLE, FALLOC_FL_KEEP_SIZE # type: ignore
 
+logger = logging.getLogger(__name__)
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+
+
+def _load_sync_file_range() -> Optional[Callable[[int, int, int, int], int]]:
+    """
+    Look up sync_file_range in the C library (Python does not provide it)
+
+    Returns None, if it is not available (e.g. not on Linux)
+    """
+    try:
+        func = ctypes.CDLL(None, use_errno=True).sync_file_range
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint)
+    func.restype = ctypes.c_int
+    return func
+
+_sync_file_range = _load_sync_file_range()
+
+
+def sync_file_range(fd: int, offset: int, length: int, flags: int) -> bool:
+    """
+    Call sync_file_range(2) for a range of fd (length 0 means up to the end of the file)
+
+    Returns False, if sync_file_range is not supported on this system.
+    """
+    if _sync_file_range is None:
+        return False
+    if _sync_file_range(fd, offset, length, flags) != 0:
+        err = ctypes.get_errno()
+        if err == errno.ENOSYS:
+            return False
+        raise OSError(err, os.strerror(err))
+    return True
+
 
 class BuildLocation:
     """
     Temporary location of the builds
+
+    Optionally, temporary files with a known size are placed in a RAM backed directory
+    (e.g. ``/dev/shm``), as long as they are not larger than a threshold and the total size
+    of all files in RAM stays within a budget (see ``set_ram_budget``).
+    All other temporary files are placed in ``path``.
     """
+    TRASH_PREFIX = ".embdgen-trash-"
+
     __instance: BuildLocation | None = None
     _path: Path
     _was_created: bool
+    _ram_path: Optional[Path]
+    _ram_budget: int
+    _ram_threshold: int
+    _ram_files: Dict[Path, int]
+    _lock: threading.Lock
 
     def __new__(cls) -> BuildLocation:
         if cls.__instance is None:
             cls.__instance: BuildLocation = super(BuildLocation, cls).__new__(cls)
             cls.__instance._path = Path(tempfile.mkdtemp(prefix="embdgen-"))
             cls.__instance._was_created = True
+            cls.__instance._ram_path = None
+            cls.__instance._ram_budget = 0
+            cls.__instance._ram_threshold = 0
+            cls.__instance._ram_files = {}
+            cls.__instance._lock = threading.Lock()
         return cls.__instance
 
     def __del__(self):
         self._remove()
 
     def set_path(self, path: Path) -> None:
-        self._remove()
+        self._remove_disk()
         self._path = path
         self._was_created = False
         if not self._path.exists():
             self._path.mkdir(parents=True, exist_ok=True)
             self._was_created = True
 
-    def remove(self) -> None:
+    def set_ram_budget(self, budget: int, threshold: Optional[int] = None,
+                       ram_dir: Path = Path("/dev/shm")) -> None:
+        """
+        Place temporary files of up to threshold bytes (default: budget) in ram_dir,
+        as long as the total size of these files does not exceed budget bytes.
+        A budget of 0 disables placing files in RAM.
+        """
+        self._remove_ram()
+        self._ram_budget = budget
+        self._ram_threshold = budget if threshold is None else threshold
+        if budget <= 0:
+            return
+        if not ram_dir.is_dir() or not os.access(ram_dir, os.W_OK):
+            logger.warning("%s is not usable, all temporary files are placed in %s", ram_dir, self._path)
+            return
+        self._ram_path = Path(tempfile.mkdtemp(prefix="embdgen-", dir=ram_dir))
+        logger.info("Placing temporary files up to %d B in %s (budget: %d B)",
+                    self._ram_threshold, self._ram_path, self._ram_budget)
+
+    def temp_file(self, ext: str = "", size_hint: Optional[int] = None) -> Path:
+        """
+        Get the path of a new temporary file
+
+        If size_hint (the expected size of the file in bytes) is given, the file
+        is placed in RAM, if it fits into the RAM budget.
+        Files in RAM are accounted for, until they are deleted.
+        """
+        if size_hint is not None and self._ram_path:
+            with self._lock:
+                self._ram_files = {path: size for path, size in self._ram_files.items() if path.exists()}
+                used = sum(self._ram_files.values())
+                if size_hint > self._ram_threshold:
+                    reason = "above the threshold"
+                elif used + size_hint > self._ram_budget:
+                    reason = f"exceeds the budget ({used} B used)"
+                elif shutil.disk_usage(self._ram_path).free < size_hint:
+                    reason = f"not enough space in {self._ram_path}"
+                else:
+                    fd, name = tempfile.mkstemp(dir=self._ram_path, suffix=ext)
+                    os.close(fd)
+                    path = Path(name)
+                    self._ram_files[path] = size_hint
+                    logger.info("Placing %s (%d B) in RAM", path.name, size_hint)
+                    return path
+            path = Path(tempfile.mktemp(dir=self._path, suffix=ext))
+            logger.info("Placing %s (%d B) on disk: %s", path.name, size_hint, reason)
+            return path
+        return Path(tempfile.mktemp(dir=self._path, suffix=ext))
+
+    def remove(self, background: bool = False) -> None:
+        """
+        Remove the build location
+
+        If background is set, the directory is moved to a trash directory next to it
+        and deleted by a detached process, so removing even huge trees returns immediately.
+        Trash directories left behind by previous runs (e.g. if the process was killed)
+        are deleted as well.
+        """
+        if background:
+            self._move_to_trash()
         self._remove()
         BuildLocation.__instance = None
 
+    def _move_to_trash(self) -> None:
+        if not self._was_created or not self._path.exists():
+            return
+        parent = self._path.parent
+        trash = Path(tempfile.mkdtemp(prefix=self.TRASH_PREFIX, dir=parent))
+        try:
+            self._path.rename(trash / self._path.name)
+        except OSError:
+            # The trash directory may already be removed by the background removal of another run
+            with contextlib.suppress(FileNotFoundError):
+                trash.rmdir()
+            return # Removed synchronously
+        logger.info("Removing %s in the background", self._path)
+        subprocess.Popen( # pylint: disable=consider-using-with
+            ["rm", "-rf", "--", trash, *self._stale_trash(parent, trash)],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True
+        )
+
+    def _stale_trash(self, parent: Path, current: Path) -> List[Path]:
+        """Trash directories of previous runs
+
+        Empty trash directories are skipped, as these are just being filled by other runs.
+        """
+        stale = []
+        for path in parent.glob(f"{self.TRASH_PREFIX}*"):
+            with contextlib.suppress(OSError):
+                if path != current and any(path.iterdir()):
+                    stale.append(path)
+        return stale
+
     def _remove(self) -> None:
+        self._remove_disk()
+        self._remove_ram()
+
+    def _remove_disk(self) -> None:
         if self._was_created and self._path.exists():
             shutil.rmtree(self._path)
 
+    def _remove_ram(self) -> None:
+        if self._ram_path:
+            shutil.rmtree(self._ram_path, ignore_errors=True)
+            self._ram_path = None
+            self._ram_files = {}
+
     @property
     def path(self):
         return self._path
 
+    @property
+    def ram_path(self) -> Optional[Path]:
+        """The RAM backed directory for temporary files or None, if files are not placed in RAM"""
+        return self._ram_path
+
+    @property
+    def ram_budget(self) -> int:
+        """Maximum total size of the temporary files in RAM"""
+        return self._ram_budget if self._ram_path else 0
+
+    @property
+    def ram_threshold(self) -> int:
+        """Maximum size of a temporary file in RAM"""
+        return self._ram_threshold if self._ram_path else 0
+
+
+class CacheDropper:
+    """
+    Page cache hints for processing a file sequentially
+
+    Files read through a CacheDropper are advised for sequential access and the next
+    ``INTERVAL`` bytes are read ahead. If ``enabled`` is set (globally, e.g. by the
+    ``--drop-caches`` command line option), the processed ranges are dropped from the
+    page cache every ``INTERVAL`` bytes. Dirty pages cannot be dropped, so the write-back
+    of a written range is only started and waited for with the next range. This way,
+    writing and write-back overlap and at most two ranges of a written file are cached.
+    This keeps the memory footprint flat, when copying or hashing huge files.
+
+    Files without a file descriptor (e.g. ``BytesIO`` or a ``TeeWriter``) are ignored.
+    """
+    INTERVAL = 64 * 1024 * 1024
+
+    enabled: bool = False
+    """Drop processed data from the page cache"""
+
+    _file: Union[IO[bytes], io.IOBase]
+    _fd: Optional[int]
+    _written: bool
+    _start: int
+
+    def __init__(self, file: Union[IO[bytes], io.IOBase], written: bool = False) -> None:
+        self._file = file
+        self._written = written
+        try:
+            self._fd = file.fileno()
+            self._start = file.tell()
+            if not written:
+                os.posix_fadvise(self._fd, self._start, 0, os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(self._fd, self._start, self.INTERVAL, os.POSIX_FADV_WILLNEED)
+        except (OSError, ValueError):
+            self._fd = None # Not a regular file
+
+    def advance(self, pos: int) -> None:
+        """The file was processed up to pos"""
+        if self._fd is not None and pos - self._start >= self.INTERVAL:
+            self.finish(pos)
+
+    def finish(self, pos: int) -> None:
+        """The file was processed up to pos and the next range is processed next (if any)"""
+        if self._fd is None or pos <= self._start:
+            return
+        if not self._written:
+            os.posix_fadvise(self._fd, pos, self.INTERVAL, os.POSIX_FADV_WILLNEED)
+        elif self.enabled:
+            self._file.flush()
+        self.drop(self._fd, self._start, pos - self._start, self._written)
+        self._start = pos
+
+    @classmethod
+    def drop(cls, fd: int, offset: int = 0, length: int = 0, written: bool = False) -> None:
+        """Drop a range (by default the whole file) from the page cache, if ``enabled`` is set
+
+        For written files, everything before the range is dropped as well,
+        since the range itself is still being written back.
+        """
+        if not cls.enabled:
+            return
+        if written:
+            cls._write_back(fd, offset, length)
+            length = offset + length if length else 0
+            offset = 0
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+    @staticmethod
+    def _write_back(fd: int, offset: int, length: int) -> None:
+        """Start writing back a range and wait for the write-back started before
+
+        Where sync_file_range is not available, the whole file is synced instead.
+        """
+        if offset > 0 and not sync_file_range(fd, 0, offset, SYNC_FILE_RANGE_WAIT_BEFORE):
+            os.fdatasync(fd)
+            return
+        if not sync_file_range(fd, offset, length, SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE):
+            os.fdatasync(fd)
+
 
 def create_empty_image(filename: Path, size: int) -> None:
     """
@@ -61,6 +317,17 @@ def create_empty_image(filename: Path, size: int) -> None:
     with open(filename, "wb") as out_file:
         out_file.truncate(size)
 
+def punch_hole(out_file: io.BufferedIOBase, offset: int, length: int) -> None:
+    """
+    Deallocate a range in out_file, to ensure it reads as zeros.
+    If out_file is not a real file, but implements punch_hole (e.g. TeeWriter), that is used instead.
+    """
+    punch = getattr(out_file, "punch_hole", None)
+    if punch:
+        punch(offset, length)
+    else:
+        fallocate(out_file, offset, length, FALLOC_FL_PUNCH_HOLE + FALLOC_FL_KEEP_SIZE)
+
 def copy_sparse(out_file: io.BufferedIOBase, in_file: io.BufferedIOBase, size: Optional[int]=None) -> None:
     """
     Copy sparse from in_file to out_file up to size bytes.
@@ -91,6 +358,9 @@ def copy_sparse(out_file: io.BufferedIOBase, in_file: io.BufferedIOBase, size: O
     if size == 0:
         return
 
+    in_cache = CacheDropper(in_file)
+    out_cache = CacheDropper(out_file, written=True)
+    out_start = out_file.tell()
     to_copy = size
     while to_copy > 0:
         block_size = min(4096, to_copy)
@@ -100,8 +370,11 @@ def copy_sparse(out_file: io.BufferedIOBase, in_file: io.BufferedIOBase, size: O
             out_file.write(data)
         else:
             # Deallocate blocks, to ensure they are 0
-            fallocate(out_file, out_file.tell(), len(data), FALLOC_FL_PUNCH_HOLE + FALLOC_FL_KEEP_SIZE)
+            punch_hole(out_file, out_file.tell(), len(data))
             out_file.seek(len(data), io.SEEK_CUR)
+        in_cache.advance(cur_pos + size - to_copy)
+        out_cache.advance(out_start + size - to_copy)
+    in_cache.finish(cur_pos + size)
 
     # If there is a hole at the end of the file,
     # allocate the remainder of the file as a whole
@@ -113,7 +386,75 @@ def copy_sparse(out_file: io.BufferedIOBase, in_file: io.BufferedIOBase, size: O
         os.ftruncate(out_file.fileno(), cur_pos)
     else:
         out_file.seek(cur_pos)
+    out_cache.finish(cur_pos)
+
+
+def data_ranges(fd: int, start: int, end: int) -> Iterator[Tuple[int, int]]:
+    """
+    Iterate over all ranges (start, end) containing data in the file between start and end.
+    Holes are skipped, if the filesystem supports SEEK_DATA / SEEK_HOLE,
+    otherwise the whole range is returned.
+    """
+    cur_pos = start
+    while cur_pos < end:
+        try:
+            data_start = os.lseek(fd, cur_pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO: # No more data after cur_pos
+                return
+            if e.errno == errno.EINVAL: # SEEK_DATA not supported
+                yield cur_pos, end
+                return
+            raise
+        if data_start >= end:
+            return
+        data_end = min(os.lseek(fd, data_start, os.SEEK_HOLE), end)
+        yield data_start, data_end
+        cur_pos = data_end
+
+
+def zero_range(out_file: io.BufferedIOBase, offset: int, length: int) -> None:
+    """
+    Make sure a range in out_file reads as zeros.
+    The range is deallocated if possible, otherwise zeros are written.
+    """
+    try:
+        fallocate(out_file, offset, length, FALLOC_FL_PUNCH_HOLE + FALLOC_FL_KEEP_SIZE)
+    except OSError:
+        zero_block = b"\0" * 4096
+        for block_offset in range(offset, offset + length, len(zero_block)):
+            block_size = min(len(zero_block), offset + length - block_offset)
+            os.pwrite(out_file.fileno(), zero_block[:block_size], block_offset)
 
 
-def get_temp_file(ext: str="") -> Path:
-    return Path(tempfile.mktemp(dir=BuildLocation().path, suffix=ext))
+def copy_range_sparse(in_fd: int, out_fd: int, in_offset: int, out_offset: int, length: int) -> None:
+    """
+    Copy length bytes from in_fd at in_offset to out_fd at out_offset.
+
+    Only ranges containing data are copied, holes in the input are skipped
+    (i.e. they stay holes in a newly created output file).
+    The data is copied using copy_file_range, which creates reflinks on filesystems
+    supporting it and avoids copying the data through userspace otherwise.
+    """
+    for start, end in data_ranges(in_fd, in_offset, in_offset + length):
+        pos = start
+        while pos < end:
+            try:
+                copied = os.copy_file_range(in_fd, out_fd, end - pos, pos, out_offset + pos - in_offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+                copied = os.pwrite(out_fd, os.pread(in_fd, min(end - pos, 1024 * 1024), pos),
+                                   out_offset + pos - in_offset)
+            if copied == 0:
+                raise Exception(f"Unexpected end of file while copying at offset {pos}")
+            pos += copied
+        CacheDropper.drop(in_fd, start, end - start)
+        CacheDropper.drop(out_fd, out_offset + start - in_offset, end - start, written=True)
+
+
+def get_temp_file(ext: str="", size_hint: Optional[int]=None) -> Path:
+    """
+    Get the path of a new temporary file in the build location (see ``BuildLocation.temp_file``)
+    """
+    return BuildLocation().temp_file(ext, size_hint)
@@ -0,0 +1,265 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+"""
+Creating LUKS2 encrypted volumes in user space
+
+The header follows the LUKS2 on-disk format specification, as created by
+``cryptsetup luksFormat --type luks2``: Two copies of the binary header and
+the JSON metadata, a single keyslot protected by a passphrase and a single
+aes-xts-plain64 segment starting at ``DATA_OFFSET``.
+
+The payload is encrypted in parallel chunks by multiple processes,
+as encrypting every sector with a separate tweak is dominated by the interpreter.
+"""
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+import multiprocessing
+import os
+import struct
+import uuid as uuid_module
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import BinaryIO, Dict
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+from .image import data_ranges
+
+MAGIC = b"LUKS\xba\xbe"
+MAGIC_SECONDARY = b"SKUL\xba\xbe"
+VERSION = 2
+HDR_SIZE = 16384
+"""Size of the binary header and the JSON area of one copy of the metadata"""
+BIN_HDR_SIZE = 4096
+KEYSLOTS_OFFSET = 2 * HDR_SIZE
+DATA_OFFSET = 16 * 1024 * 1024
+"""Offset of the encrypted data (the default of cryptsetup)"""
+
+CIPHER = "aes-xts-plain64"
+KEY_SIZE = 64
+"""Size of the volume key in bytes (AES-256 in XTS mode)"""
+HASH = "sha256"
+STRIPES = 4000
+SALT_SIZE = 32
+DIGEST_ITERATIONS = 100000
+KEYSLOT_SECTOR_SIZE = 512
+SECTOR_SIZES = [512, 1024, 2048, 4096]
+AREA_ALIGNMENT = 4096
+CHUNK_SIZE = 16 * 1024 * 1024
+"""Size of the chunks, that are encrypted in parallel"""
+CHUNK_MEMORY = 4 * CHUNK_SIZE
+"""Approximate memory used by a process encrypting a chunk (the data is copied while encrypting)"""
+
+_BIN_HDR = struct.Struct(">6sHQQ48s32s64s40s48sQ184s64s")
+
+
+@dataclass
+class Kdf:
+    """Key derivation function of a keyslot"""
+
+    type: str = "argon2id"
+    """pbkdf2 or argon2id"""
+    iterations: int = 4
+    """Number of iterations (pbkdf2) or time cost (argon2id)"""
+    memory: int = 1048576
+    """Memory cost in KiB (argon2id)"""
+    cpus: int = 4
+    """Number of lanes (argon2id)"""
+    salt: bytes = field(default_factory=lambda: os.urandom(SALT_SIZE))
+
+    def validate(self) -> None:
+        """Check the parameters against the limits of cryptsetup"""
+        if self.type == "pbkdf2" and self.iterations < 1000:
+            raise Exception("pbkdf2 requires at least 1000 iterations")
+        if self.type == "argon2id" and (self.iterations < 4 or self.memory < 32 or not 1 <= self.cpus <= 4):
+            raise Exception("argon2id requires at least 4 iterations, 32 KiB memory and 1 to 4 cpus")
+
+    def derive(self, passphrase: bytes, length: int) -> bytes:
+        if self.type == "pbkdf2":
+            return PBKDF2HMAC(hashes.SHA256(), length, self.salt, self.iterations).derive(passphrase)
+        if self.type == "argon2id":
+            try:
+                from cryptography.hazmat.primitives.kdf.argon2 import Argon2id # pylint: disable=import-outside-toplevel
+            except ImportError as e:
+                raise Exception("argon2id requires cryptography 44 or newer, use pbkdf2 instead") from e
+            return Argon2id(salt=self.salt, length=length, iterations=self.iterations,
+                            lanes=self.cpus, memory_cost=self.memory).derive(passphrase)
+        raise Exception(f"Unsupported key derivation function {self.type}")
+
+    def to_json(self) -> Dict:
+        if self.type == "pbkdf2":
+            return {"type": self.type, "hash": HASH, "iterations": self.iterations, "salt": _b64(self.salt)}
+        return {"type": self.type, "time": self.iterations, "memory": self.memory, "cpus": self.cpus,
+                "salt": _b64(self.salt)}
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+def _align(value: int, alignment: int) -> int:
+    return (value + alignment - 1) // alignment * alignment
+
+
+def _diffuse(block: bytes) -> bytes:
+    digest_size = hashlib.new(HASH).digest_size
+    out = b""
+    for i in range(0, len(block), digest_size):
+        chunk = block[i:i + digest_size]
+        out += hashlib.new(HASH, struct.pack(">I", i // digest_size) + chunk).digest()[:len(chunk)]
+    return out
+
+
+def af_split(key: bytes, stripes: int = STRIPES) -> bytes:
+    """Split key into stripes with the anti-forensic splitter of LUKS"""
+    stripes_data = os.urandom(len(key) * (stripes - 1))
+    buffer = bytes(len(key))
+    for i in range(stripes - 1):
+        stripe = stripes_data[i * len(key):(i + 1) * len(key)]
+        buffer = _diffuse(bytes(a ^ b for a, b in zip(buffer, stripe)))
+    return stripes_data + bytes(a ^ b for a, b in zip(buffer, key))
+
+
+def encrypt_sectors(key: bytes, data: bytes, first_sector: int, sector_size: int) -> bytes:
+    """Encrypt data with aes-xts-plain64 (the sector number is the tweak)"""
+    out = bytearray(len(data))
+    for offset in range(0, len(data), sector_size):
+        tweak = (first_sector + offset // sector_size).to_bytes(16, "little")
+        encryptor = Cipher(algorithms.AES(key), modes.XTS(tweak)).encryptor()
+        out[offset:offset + sector_size] = encryptor.update(data[offset:offset + sector_size])
+    return bytes(out)
+
+
+@dataclass
+class Header:
+    """LUKS2 header with one keyslot and one segment covering the rest of the device"""
+
+    passphrase: bytes
+    kdf: Kdf = field(default_factory=Kdf)
+    sector_size: int = 512
+    uuid: str = field(default_factory=lambda: str(uuid_module.uuid4()))
+    label: str = ""
+    volume_key: bytes = field(default_factory=lambda: os.urandom(KEY_SIZE))
+
+    def _metadata(self, keyslot_size: int) -> Dict:
+        digest_salt = os.urandom(SALT_SIZE)
+        digest = PBKDF2HMAC(hashes.SHA256(), hashlib.new(HASH).digest_size, digest_salt,
+                            DIGEST_ITERATIONS).derive(self.volume_key)
+        return {
+            "keyslots": {"0": {
+                "type": "luks2",
+                "key_size": KEY_SIZE,
+                "af": {"type": "luks1", "stripes": STRIPES, "hash": HASH},
+                "area": {"type": "raw", "offset": str(KEYSLOTS_OFFSET), "size": str(keyslot_size),
+                         "encryption": CIPHER, "key_size": KEY_SIZE},
+                "kdf": self.kdf.to_json()
+            }},
+            "tokens": {},
+            "segments": {"0": {
+                "type": "crypt", "offset": str(DATA_OFFSET), "size": "dynamic", "iv_tweak": "0",
+                "encryption": CIPHER, "sector_size": self.sector_size
+            }},
+            "digests": {"0": {
+                "type": "pbkdf2", "keyslots": ["0"], "segments": ["0"], "hash": HASH,
+                "iterations": DIGEST_ITERATIONS, "salt": _b64(digest_salt), "digest": _b64(digest)
+            }},
+            "config": {"json_size": str(HDR_SIZE - BIN_HDR_SIZE), "keyslots_size": str(DATA_OFFSET - KEYSLOTS_OFFSET)}
+        }
+
+    def _binary_header(self, magic: bytes, offset: int, json_area: bytes) -> bytes:
+        salt = os.urandom(64)
+
+        def header(checksum: bytes) -> bytes:
+            return _BIN_HDR.pack(
+                magic, VERSION, HDR_SIZE, 1, self.label.encode("utf8"), HASH.encode("ascii"),
+                salt, self.uuid.encode("ascii"), b"", offset, b"", checksum
+            ).ljust(BIN_HDR_SIZE, b"\0")
+        # The checksum covers the binary header (with an empty checksum) and the JSON area
+        return header(hashlib.new(HASH, header(b"") + json_area).digest())
+
+    def write(self, file: BinaryIO) -> None:
+        """Write the header (the first ``DATA_OFFSET`` bytes) to file, areas without data are skipped"""
+        if self.sector_size not in SECTOR_SIZES:
+            raise Exception(f"Invalid sector size {self.sector_size} (allowed: {', '.join(map(str, SECTOR_SIZES))})")
+        if len(self.label.encode("utf8")) >= 48:
+            raise Exception("The label must be shorter than 48 bytes")
+        self.kdf.validate()
+        keyslot = encrypt_sectors(self.kdf.derive(self.passphrase, KEY_SIZE), af_split(self.volume_key),
+                                  0, KEYSLOT_SECTOR_SIZE)
+        json_area = json.dumps(self._metadata(_align(len(keyslot), AREA_ALIGNMENT))).encode("ascii")
+        if len(json_area) >= HDR_SIZE - BIN_HDR_SIZE:
+            raise Exception("The LUKS2 metadata is too big")
+        json_area = json_area.ljust(HDR_SIZE - BIN_HDR_SIZE, b"\0")
+
+        for magic, offset in [(MAGIC, 0), (MAGIC_SECONDARY, HDR_SIZE)]:
+            file.seek(offset)
+            file.write(self._binary_header(magic, offset, json_area))
+            file.write(json_area)
+        file.seek(KEYSLOTS_OFFSET)
+        file.write(keyslot)
+
+
+@dataclass
+class Payload:
+    """Data, that is encrypted into the segment of a LUKS2 volume"""
+
+    source: Path
+    offset: int
+    """Offset of the data in source"""
+    size: int
+    target: Path
+    """Sparse file of the full size of the volume, the data is written to ``DATA_OFFSET``"""
+    sparse: bool = False
+    """Do not encrypt sectors, that contain only zeros, but leave them as holes (that decrypt to random data)"""
+
+
+def _encrypt_chunk(payload: Payload, key: bytes, sector_size: int, start: int, end: int) -> None:
+    """Encrypt the range (start, end) of the payload"""
+    zero = bytes(sector_size)
+    with payload.source.open("rb") as in_file, payload.target.open("rb+") as out_file:
+        ranges = data_ranges(in_file.fileno(), payload.offset + start, payload.offset + end) \
+            if payload.sparse else [(payload.offset + start, payload.offset + end)]
+        for range_start, range_end in ranges:
+            # Holes are only skipped, if they cover complete sectors
+            range_start = (range_start - payload.offset) // sector_size * sector_size
+            range_end = _align(range_end - payload.offset, sector_size)
+            data = os.pread(in_file.fileno(), range_end - range_start, payload.offset + range_start)
+            data = data.ljust(range_end - range_start, b"\0")
+            run_start = 0
+            for pos in range(0, len(data) + sector_size, sector_size):
+                # Consecutive sectors are encrypted and written at once
+                if pos < len(data) and not (payload.sparse and data[pos:pos + sector_size] == zero):
+                    continue
+                if run_start < pos:
+                    os.pwrite(out_file.fileno(),
+                              encrypt_sectors(key, data[run_start:pos], (range_start + run_start) // sector_size,
+                                              sector_size),
+                              DATA_OFFSET + range_start + run_start)
+                run_start = pos + sector_size
+
+
+def encrypt(header: Header, payload: Payload, jobs: int) -> None:
+    """
+    Encrypt the payload with the volume key of header in chunks by up to jobs processes
+
+    The processes are started by a fork server, since forking the (multi-threaded)
+    calling process is not safe.
+    """
+    if payload.size % header.sector_size:
+        raise Exception(f"The size of the payload must be a multiple of the sector size {header.sector_size}")
+    chunks = [(start, min(start + CHUNK_SIZE, payload.size)) for start in range(0, payload.size, CHUNK_SIZE)]
+    if jobs <= 1 or len(chunks) <= 1:
+        for start, end in chunks:
+            _encrypt_chunk(payload, header.volume_key, header.sector_size, start, end)
+        return
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("forkserver")) as executor:
+        futures = [executor.submit(_encrypt_chunk, payload, header.volume_key, header.sector_size, start, end)
+                   for start, end in chunks]
+        for future in futures:
+            future.result()
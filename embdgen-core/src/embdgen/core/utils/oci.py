@@ -0,0 +1,339 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+"""
+Reading OCI image layouts and applying their layers
+
+The layers are applied from the top-most layer to the lowest layer in a single pass.
+Paths, that were already written by an upper layer, or that were removed by
+a whiteout of an upper layer, are tracked in an index (see ``LayerIndex``),
+so files of lower layers, that are replaced or deleted, are never written.
+The compressed layers are decompressed in parallel, while the upper layers are applied.
+"""
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import stat
+import subprocess
+import sys
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional, Set
+
+from .FakeRoot import FakeRoot
+from .image import BuildLocation
+
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
+
+INDEX_TYPES = {
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+}
+REF_NAME = "org.opencontainers.image.ref.name"
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass
+class Descriptor:
+    """Reference to a blob in an OCI image layout"""
+
+    media_type: str
+    digest: str
+    size: int
+    platform: Optional[str] = None
+    """Platform as os/architecture[/variant] (if set in the descriptor)"""
+    annotations: Dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def from_json(cls, data: dict) -> Descriptor:
+        platform = None
+        if "platform" in data:
+            platform = "/".join(filter(None, [
+                data["platform"].get("os"),
+                data["platform"].get("architecture"),
+                data["platform"].get("variant")
+            ]))
+        return cls(data.get("mediaType", ""), data["digest"], data.get("size", 0),
+                   platform, data.get("annotations", {}))
+
+
+def blob_path(layout: Path, digest: str) -> Path:
+    algorithm, encoded = digest.split(":", 1)
+    return layout / "blobs" / algorithm / encoded
+
+
+def _read_json(layout: Path, digest: Optional[str] = None) -> dict:
+    path = blob_path(layout, digest) if digest else layout / "index.json"
+    try:
+        return json.loads(path.read_text(encoding="utf8"))
+    except (OSError, ValueError) as e:
+        raise Exception(f"Unable to read {path} of the OCI image layout: {e}") from e
+
+
+def _select(manifests: List[Descriptor], reference: Optional[str], platform: Optional[str]) -> Descriptor:
+    candidates = [
+        m for m in manifests
+        if (reference is None or m.annotations.get(REF_NAME) == reference) and
+           (platform is None or m.platform is None or m.platform == platform) and
+           # Attestation manifests of multi-platform images use the platform unknown/unknown
+           not (m.platform or "").startswith("unknown/")
+    ]
+    if len(candidates) != 1:
+        selection = ", ".join(f"{name} {value}" for name, value in
+                              [("reference", reference), ("platform", platform)] if value) or "no selection"
+        raise Exception(f"Expected exactly one image manifest matching {selection}, found {len(candidates)}")
+    return candidates[0]
+
+
+def read_layers(layout: Path, reference: Optional[str] = None, platform: Optional[str] = None) -> List[Descriptor]:
+    """
+    Get the layers of an image in an OCI image layout (the lowest layer first).
+
+    The image is selected by its reference name and platform (e.g. linux/arm64),
+    which are only required, if the layout contains multiple images.
+    """
+    index = _read_json(layout)
+    descriptor = _select([Descriptor.from_json(m) for m in index.get("manifests", [])], reference, platform)
+    manifest = _read_json(layout, descriptor.digest)
+    while descriptor.media_type in INDEX_TYPES or "manifests" in manifest:
+        descriptor = _select([Descriptor.from_json(m) for m in manifest.get("manifests", [])], None, platform)
+        manifest = _read_json(layout, descriptor.digest)
+    return [Descriptor.from_json(layer) for layer in manifest.get("layers", [])]
+
+
+def _compression(blob: Path) -> Optional[str]:
+    with blob.open("rb") as f:
+        magic = f.read(4)
+    if magic.startswith(_GZIP_MAGIC):
+        return "gzip"
+    if magic == _ZSTD_MAGIC:
+        return "zstd"
+    return None
+
+
+def is_compressed(blob: Path) -> bool:
+    """Check if a layer is compressed (with gzip or zstd)"""
+    return _compression(blob) is not None
+
+
+class LayerIndex:
+    """Index of the paths of all layers above the current layer
+
+    The paths are relative to the root directory (without a leading "/").
+    """
+
+    def __init__(self) -> None:
+        self._entries: Dict[str, bool] = {}
+        """Paths written by upper layers (True for directories)"""
+        self._removed: Set[str] = set()
+        """Paths (including their children) removed by whiteouts of upper layers"""
+        self._opaque: Set[str] = set()
+        """Directories, whose children of lower layers are removed"""
+        self._parents: Set[str] = set()
+        """Parent directories of all paths of upper layers"""
+        self._current: Dict[str, bool] = {}
+        self._current_removed: Set[str] = set()
+        self._current_opaque: Set[str] = set()
+        self._current_parents: Set[str] = set()
+
+    def hidden(self, path: str, is_dir: bool) -> bool:
+        """Check if path of the current layer is replaced or removed by an upper layer"""
+        parts = path.split("/")
+        for i in range(len(parts)):
+            parent = "/".join(parts[:i])
+            if parent in self._removed or parent in self._opaque or self._entries.get(parent) is False:
+                return True
+        # A directory, that only exists implicitly in an upper layer, gets its attributes from this layer
+        return path in self._removed or path in self._entries or (not is_dir and path in self._parents)
+
+    def whiteout(self, path: str) -> bool:
+        """Record path, if it is a whiteout, which applies to all lower layers"""
+        parent, name = posixpath.split(path)
+        if name == OPAQUE_WHITEOUT:
+            self._current_opaque.add(parent)
+        elif name.startswith(WHITEOUT_PREFIX):
+            self._current_removed.add(posixpath.join(parent, name[len(WHITEOUT_PREFIX):]))
+        else:
+            return False
+        return True
+
+    def add(self, path: str, is_dir: bool) -> bool:
+        """Record a path written by the current layer, returns True, if the layer already wrote it"""
+        parts = path.split("/")
+        for i in range(1, len(parts)):
+            parent = "/".join(parts[:i])
+            if self._current.get(parent) is False:
+                raise Exception(f"{path} is below a file, that is not a directory")
+            self._current_parents.add(parent)
+        existing = path in self._current
+        self._current[path] = is_dir
+        return existing
+
+    def next_layer(self) -> None:
+        """Continue with the next lower layer"""
+        self._entries.update(self._current)
+        self._removed |= self._current_removed
+        self._opaque |= self._current_opaque
+        self._parents |= self._current_parents
+        self._current, self._current_removed, self._current_opaque, self._current_parents = {}, set(), set(), set()
+
+
+def _verify(blob: Path, digest: str) -> None:
+    algorithm, expected = digest.split(":", 1)
+    hasher = hashlib.new(algorithm)
+    with blob.open("rb") as f:
+        while chunk := f.read(_CHUNK_SIZE):
+            hasher.update(chunk)
+    if hasher.hexdigest() != expected:
+        raise Exception(f"The digest of {blob} does not match {digest}")
+
+
+def _decompress(blob: Path, digest: str, tmp_dir: Path) -> Path:
+    """Verify a layer and decompress it into tmp_dir (uncompressed layers are used directly)"""
+    _verify(blob, digest)
+    compression = _compression(blob)
+    if compression is None:
+        return blob
+    out = tmp_dir / f"{digest.replace(':', '-')}.tar"
+    with out.open("wb") as out_file:
+        if compression == "zstd":
+            subprocess.run(["zstd", "-dcq", blob], stdout=out_file, check=True)
+        else:
+            with gzip.open(blob, "rb") as in_file:
+                shutil.copyfileobj(in_file, out_file, _CHUNK_SIZE)
+    return out
+
+
+def _normalize(name: str) -> str:
+    path = posixpath.normpath("/" + name).lstrip("/")
+    if ".." in name.split("/"):
+        raise Exception(f"Invalid path {name} in layer")
+    return path
+
+
+def _replace(target: Path, is_dir: bool) -> None:
+    """Remove an entry, that is written again by the same layer"""
+    if target.is_dir() and not target.is_symlink():
+        if not is_dir:
+            shutil.rmtree(target)
+    elif target.is_symlink() or target.exists():
+        target.unlink()
+
+
+def _extract(tar: tarfile.TarFile, member: tarfile.TarInfo, directory: Path, target: Path) -> None:
+    if member.isreg():
+        with tar.extractfile(member) as in_file, target.open("wb") as out_file: # type: ignore[union-attr]
+            shutil.copyfileobj(in_file, out_file, _CHUNK_SIZE)
+    elif member.issym():
+        os.symlink(member.linkname, target)
+    elif member.islnk():
+        # The attributes are shared with the target
+        os.link(directory / _normalize(member.linkname), target)
+        return
+    elif member.ischr() or member.isblk():
+        kind = stat.S_IFCHR if member.ischr() else stat.S_IFBLK
+        os.mknod(target, kind | member.mode, os.makedev(member.devmajor, member.devminor))
+    elif member.isfifo():
+        os.mkfifo(target)
+    else:
+        raise Exception(f"Unsupported type of {member.name} in layer")
+    _set_attributes(target, member)
+
+
+def _set_attributes(target: Path, member: tarfile.TarInfo) -> None:
+    os.chown(target, member.uid, member.gid, follow_symlinks=False)
+    if not member.issym():
+        os.chmod(target, member.mode)
+    os.utime(target, (member.mtime, member.mtime), follow_symlinks=False)
+
+
+def _apply_layer(layer: Path, directory: Path, index: LayerIndex, dirs: Dict[Path, tarfile.TarInfo]) -> None:
+    written: Set[str] = set()
+    with tarfile.open(layer, "r:") as tar:
+        for member in tar:
+            path = _normalize(member.name)
+            if not path or index.whiteout(path) or index.hidden(path, member.isdir()):
+                continue
+            target = directory / path
+            if index.add(path, member.isdir()):
+                _replace(target, member.isdir())
+            else:
+                target.parent.mkdir(parents=True, exist_ok=True)
+            if member.isdir():
+                # Lower layers may add entries, so the attributes are set after all layers
+                target.mkdir(mode=0o700, exist_ok=True)
+                dirs[target] = member
+                continue
+            if member.islnk() and _normalize(member.linkname) not in written:
+                raise Exception(f"The target of the hardlink {member.name} is replaced by an upper layer")
+            _extract(tar, member, directory, target)
+            written.add(path)
+
+
+def apply_layers(layers: List[Path], digests: List[str], directory: Path, tmp_dir: Path, threads: int) -> None:
+    """
+    Apply the layers (the lowest layer first) to directory.
+
+    This must run in fakeroot, to preserve the ownership and device nodes.
+    """
+    index = LayerIndex()
+    dirs: Dict[Path, tarfile.TarInfo] = {}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        # The upper layers are needed first
+        futures = [executor.submit(_decompress, layer, digest, tmp_dir)
+                   for layer, digest in reversed(list(zip(layers, digests)))]
+        try:
+            for layer, future in zip(reversed(layers), futures):
+                tar = future.result()
+                _apply_layer(tar, directory, index, dirs)
+                index.next_layer()
+                if tar != layer:
+                    tar.unlink()
+        finally:
+            for future in futures:
+                future.cancel()
+    # Children before their parents, as modifying the children modifies the parent
+    for target, member in sorted(dirs.items(), key=lambda x: len(x[0].parts), reverse=True):
+        _set_attributes(target, member)
+
+
+def extract(fakeroot: FakeRoot, layout: Path, layers: List[Descriptor], directory: Path, threads: int) -> None:
+    """Apply the layers of the OCI image layout to directory in fakeroot (see ``apply_layers``)"""
+    mod_self = sys.modules[__name__].__spec__
+    if not mod_self: # pragma: no cover
+        raise Exception("Cannot determine the module name of oci")
+    with TemporaryDirectory(dir=BuildLocation().path) as tmp_dir:
+        res = fakeroot.run([sys.executable, "-m", mod_self.name], input=json.dumps({
+            "layers": [str(blob_path(layout, layer.digest)) for layer in layers],
+            "digests": [layer.digest for layer in layers],
+            "directory": str(directory),
+            "tmp_dir": tmp_dir,
+            "threads": threads
+        }), stderr=subprocess.PIPE, encoding="utf8", check=False)
+    if res.returncode != 0:
+        raise Exception(f"Unable to apply the layers of {layout}: {res.stderr.strip()}")
+
+
+def main() -> int:
+    args = json.load(sys.stdin)
+    try:
+        apply_layers(list(map(Path, args["layers"])), args["digests"], Path(args["directory"]),
+                     Path(args["tmp_dir"]), args["threads"])
+    except Exception as e: # pylint: disable=broad-exception-caught
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
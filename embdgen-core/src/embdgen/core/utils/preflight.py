@@ -0,0 +1,188 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+"""
+Estimation of the resources required for creating an image
+
+The estimation is done after the layout of the image is known (i.e. after ``BaseLabel.prepare``),
+but before any content is materialized. This allows failing early, if there is not enough space
+for the temporary files or the output files.
+"""
+from __future__ import annotations
+
+import os
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set
+
+from ..content.ResourceEstimate import ResourceEstimate
+from ..region.BaseContentRegion import BaseContentRegion
+from ..sink import BaseSink, TeeWriter
+from .image import BuildLocation
+
+if TYPE_CHECKING: # pragma: no cover
+    from ..label.BaseLabel import BaseLabel
+
+
+def format_size(size: int) -> str:
+    """Format a size in bytes in a human readable way"""
+    value = float(size)
+    unit = "B"
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if value < 1024 or unit == "GiB":
+            break
+        value /= 1024
+    return f"{size} B" if unit == "B" else f"{value:.1f} {unit}"
+
+
+@dataclass
+class RegionEstimate:
+    """Estimated resources of a single region"""
+
+    name: str
+    """Name of the region"""
+
+    estimate: ResourceEstimate
+    """Estimate of the content of the region"""
+
+    ram: int
+    """Size of the temporary files, that are placed in RAM"""
+
+    shared: bool = False
+    """The content is used by multiple regions"""
+
+
+class Preflight:
+    """Estimate the resources required for creating an image and compare them with the available resources
+
+    At most jobs regions are materialized and not yet written at the same time (see ``BaseLabel.create``)
+    and the temporary files of a region are removed, after it was written. Contents shared by multiple
+    regions are only removed after the last of these regions was written. Therefore the peak usage of
+    temporary space is estimated as the usage of all shared contents and of the jobs other regions
+    requiring the most space. The memory used by the contents is estimated the same way. The peak memory
+    additionally includes the temporary files placed in RAM and the buffers of the writer and the sinks.
+    The allocated size of the outputs is estimated as the sum of all data written to the image.
+    """
+
+    regions: List[RegionEstimate]
+    """Estimates of all content regions"""
+
+    size: int
+    """Size of the image"""
+
+    allocated: int
+    """Estimated allocated size of the image"""
+
+    peak_temp: int
+    """Estimated peak size of all temporary files"""
+
+    peak_ram: int
+    """Estimated peak size of the temporary files in RAM"""
+
+    buffers: int
+    """Estimated memory used for buffering the image for the sinks"""
+
+    peak_memory: int
+    """Estimated peak memory usage (including the temporary files in RAM)"""
+
+    problems: List[str]
+    """Resources, that are not sufficient"""
+
+    _checks: List[str]
+
+    def __init__(self, label: BaseLabel, outputs: List[Path], jobs: int = 1,
+                 sinks: Optional[List[BaseSink]] = None) -> None:
+        self.problems = []
+        self._checks = []
+        self.regions = []
+        parts = [part for part in label.parts if isinstance(part, BaseContentRegion)]
+        users: Dict[int, int] = {}
+        for part in parts:
+            users[id(part.content)] = users.get(id(part.content), 0) + 1
+        seen: Set[int] = set()
+        for part in parts:
+            if id(part.content) in seen:
+                # Shared contents are only generated once
+                self.regions.append(RegionEstimate(part.name, ResourceEstimate(), 0))
+                continue
+            seen.add(id(part.content))
+            estimate = part.content.estimate()
+            ram = sum(size for size in estimate.temp_files if size <= BuildLocation().ram_threshold)
+            self.regions.append(RegionEstimate(part.name, estimate, ram, users[id(part.content)] > 1))
+
+        self.size = (label.parts[-1].start + label.parts[-1].size).bytes if label.parts else 0
+        self.allocated = min(self.size, sum(region.estimate.data for region in self.regions))
+
+        self.peak_temp = self._peak(lambda x: x.estimate.temp, jobs)
+        self.peak_ram = min(BuildLocation().ram_budget, self._peak(lambda x: x.ram, jobs))
+        self.buffers = TeeWriter.MAX_BUFFERED + sum(sink.estimate_memory() for sink in sinks or [])
+        self.peak_memory = self.peak_ram + self._peak(lambda x: x.estimate.memory, jobs) + self.buffers
+
+        self._check_space(outputs)
+
+    def _peak(self, value: Callable[[RegionEstimate], int], jobs: int) -> int:
+        """Peak of value of the shared contents and the jobs other regions with the highest value"""
+        shared = sum(value(region) for region in self.regions if region.shared)
+        others = sorted((value(region) for region in self.regions if not region.shared), reverse=True)
+        return shared + sum(others[:jobs])
+
+    def _check_space(self, outputs: List[Path]) -> None:
+        """Compare the required space with the free space of all affected filesystems"""
+        required: Dict[int, int] = {}
+        locations: Dict[int, List[str]] = {}
+        free: Dict[int, int] = {}
+
+        def add(directory: Path, size: int, what: str) -> None:
+            device = directory.stat().st_dev
+            if device not in free:
+                free[device] = shutil.disk_usage(directory).free
+            required[device] = required.get(device, 0) + size
+            locations.setdefault(device, []).append(what)
+
+        add(BuildLocation().path, self.peak_temp - self.peak_ram, f"temporary files in {BuildLocation().path}")
+
+        for output in outputs:
+            if output.is_block_device():
+                fd = os.open(output, os.O_RDONLY)
+                try:
+                    device_size = os.lseek(fd, 0, os.SEEK_END)
+                finally:
+                    os.close(fd)
+                self._checks.append(f"{output}: {format_size(device_size)} (device)")
+                if device_size < self.size:
+                    self.problems.append(
+                        f"The image ({format_size(self.size)}) does not fit on {output} ({format_size(device_size)})"
+                    )
+                continue
+            directory = output.resolve().parent
+            if not directory.is_dir():
+                continue # Reported, when the output is written
+            size = self.allocated
+            if output.exists():
+                # The existing file is replaced
+                size -= min(size, output.stat().st_blocks * 512)
+            add(directory, size, str(output))
+
+        for device, size in required.items():
+            what = ", ".join(locations[device])
+            self._checks.append(f"{what}: {format_size(size)} required, {format_size(free[device])} free")
+            if size > free[device]:
+                self.problems.append(
+                    f"Not enough space for {what}: {format_size(size)} required, {format_size(free[device])} free"
+                )
+
+    def report(self) -> str:
+        """Breakdown of the estimated resources"""
+        lines = [f"{'Region':<20} {'Data':>12} {'Temporary':>12} {'RAM':>12} {'Memory':>12}"]
+        for region in self.regions:
+            lines.append(
+                f"{region.name:<20} {format_size(region.estimate.data):>12} "
+                f"{format_size(region.estimate.temp):>12} {format_size(region.ram):>12} "
+                f"{format_size(region.estimate.memory):>12}"
+            )
+        lines.append(f"Image size: {format_size(self.size)} ({format_size(self.allocated)} allocated)")
+        lines.append(f"Peak temporary space: {format_size(self.peak_temp)} ({format_size(self.peak_ram)} in RAM)")
+        lines.append(f"Peak memory: {format_size(self.peak_memory)} "
+                     f"(including {format_size(self.buffers)} buffers of the outputs)")
+        lines += self._checks
+        return "\n".join(lines)
@@ -6,6 +6,7 @@ from tempfile import TemporaryDirectory
 
 from embdgen.core.utils.class_factory import Config
 from embdgen.core.content.FilesContentProvider import FilesContentProvider
+from embdgen.core.content.ResourceEstimate import ResourceEstimate
 from embdgen.core.utils.image import BuildLocation
 
 @Config("archive")
@@ -14,6 +15,9 @@ class ArchiveContent(FilesContentProvider):
 
     CONTENT_TYPE = "archive"
 
+    COMPRESSION_RATIO = 4
+    """Assumed ratio between the unpacked size and the size of a compressed archive"""
+
     archive: Path
     """Archive to be unpacked"""
 
@@ -24,6 +28,12 @@ class ArchiveContent(FilesContentProvider):
     def files(self) -> List[Path]:
         return self._files or []
 
+    def estimate(self) -> ResourceEstimate:
+        size = self.archive.stat().st_size
+        if self.archive.suffix != ".tar":
+            size *= self.COMPRESSION_RATIO
+        return ResourceEstimate(temp_other=size)
+
     def prepare(self) -> None:
         self._tmpDir = TemporaryDirectory(  # pylint: disable=consider-using-with
             dir=BuildLocation().path
@@ -38,5 +48,11 @@ class ArchiveContent(FilesContentProvider):
 
         self._files = list(tmpDir.iterdir())
 
+    def do_release(self) -> None:
+        if self._tmpDir:
+            self._tmpDir.cleanup()
+            self._tmpDir = None
+            self._files = []
+
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}({self.archive})"
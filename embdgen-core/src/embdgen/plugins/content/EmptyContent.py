@@ -4,10 +4,14 @@ import io
 from io import BufferedIOBase
 
 from embdgen.core.content.BinaryContent import BinaryContent
+from embdgen.core.content.ResourceEstimate import ResourceEstimate
 
 class EmptyContent(BinaryContent):
     """Empty content"""
     CONTENT_TYPE = "empty"
 
+    def estimate(self) -> ResourceEstimate:
+        return ResourceEstimate()
+
     def do_write(self, file: BufferedIOBase):
         file.seek(self.size.bytes, io.SEEK_CUR)
@@ -0,0 +1,51 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from pathlib import Path
+import re
+from typing import List, Union
+
+from embdgen.core.content.CompressedFilesystemContent import CompressedFilesystemContent
+from embdgen.core.utils.class_factory import Config
+
+
+@Config("extended_options", optional=True)
+class ErofsContent(CompressedFilesystemContent):
+    """EROFS Content
+
+    Creates a compressed read-only EROFS filesystem using mkfs.erofs,
+    that compresses the files in parallel with ``threads`` workers.
+    The compression level can be appended to the algorithm (e.g. ``lz4hc,12``).
+    """
+    CONTENT_TYPE = "erofs"
+
+    COMPRESSIONS = ["lz4", "lz4hc", "lzma", "deflate", "libdeflate", "zstd"]
+
+    _extended_options: List[str]
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._extended_options = []
+
+    @property
+    def extended_options(self) -> List[str]:
+        """Extended options (e.g. dedupe or fragments) (mkfs.erofs -E)"""
+        return self._extended_options
+
+    @extended_options.setter
+    def extended_options(self, value: List[str]) -> None:
+        for option in value:
+            if not re.fullmatch(r"\^?[a-z0-9_-]+(=[^,\s]+)?", option):
+                raise Exception(f"Invalid erofs extended option '{option}'")
+        self._extended_options = value
+
+    def _mkfs_command(self, directory: Path, image: Path) -> List[Union[str, Path]]:
+        options: List[Union[str, Path]] = [
+            "mkfs.erofs",
+            "--quiet",
+            f"--workers={self.threads}"
+        ]
+        if self.compression:
+            options.append(f"-z{self.compression}")
+        if self.extended_options:
+            options.append(f"-E{','.join(self.extended_options)}")
+        return options + [image, directory]
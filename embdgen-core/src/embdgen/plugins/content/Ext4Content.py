@@ -1,62 +1,384 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 import io
+import logging
+import math
+import os
 from pathlib import Path
+import re
 import subprocess
 from tempfile import TemporaryDirectory
-from typing import Optional
+from typing import List, Optional, Set
+from uuid import UUID
 
 from embdgen.core.content.BinaryContent import BinaryContent
+from embdgen.core.content.ResourceEstimate import ResourceEstimate
 from embdgen.core.content.FilesContentProvider import FilesContentProvider
 from embdgen.core.utils.class_factory import Config
+from embdgen.core.utils.debugfs import apply_update, fragmentation, local_tree, plan_update, read_tree
+from embdgen.core.utils.ext4 import copy_used, discard_unused, filesystem_size
 from embdgen.core.utils.FakeRoot import FakeRoot
-from embdgen.core.utils.image import (BuildLocation, copy_sparse,
-                                      create_empty_image, get_temp_file)
+from embdgen.core.utils.image import BuildLocation, copy_range_sparse, create_empty_image
+from embdgen.core.utils.SizeType import SizeType
 
+logger = logging.getLogger(__name__)
 
 @Config("content")
 @Config("size", optional=True)
+@Config("headroom", optional=True)
+@Config("features", optional=True)
+@Config("inode_count", optional=True)
+@Config("inode_ratio", optional=True)
+@Config("block_size", optional=True)
+@Config("reserved_percent", optional=True)
+@Config("extended_options", optional=True)
+@Config("label", optional=True)
+@Config("uuid", optional=True)
+@Config("base", optional=True)
+@Config("max_update_percent", optional=True)
+@Config("max_fragmentation_percent", optional=True)
+@Config("compare_content", optional=True)
 class Ext4Content(BinaryContent):
     """Ext4 Content
+
+    If no size is set, the size is determined automatically: The filesystem is created
+    with an estimated size, that is large enough for all files, and then shrunk
+    to the minimum size (plus ``headroom``). In this case the filesystem is already
+    created, when the layout of the image is prepared.
+
+    The options are passed to mke2fs. For read-only filesystems
+    (e.g. with verity) the filesystem can be created faster and smaller with e.g.::
+
+        features:
+          - ^has_journal
+        reserved_percent: 0
+        extended_options:
+          - nodiscard
+          - root_owner=0:0
+
+    If ``base`` is set, the filesystem is created by updating a copy of the base image
+    (cloned using reflinks, if supported by the build location). Only the added,
+    changed and removed files and attributes are applied using debugfs. Regular files
+    are considered unchanged, if their size and modification time are unchanged
+    (and their content, if ``compare_content`` is set).
+    The mke2fs options are not applied in this case, the filesystem keeps
+    the features of the base image. The filesystem is created from scratch instead, if
+
+     - the base filesystem is larger than the size of the content,
+     - the files contain hardlinks or extended attributes,
+     - more than ``max_update_percent`` of the file data has changed,
+     - applying the changes fails (e.g. because the filesystem is full) or
+     - more than ``max_fragmentation_percent`` of the files are fragmented afterwards.
     """
     CONTENT_TYPE = "ext4"
 
+    BLOCK_SIZES = [1024, 2048, 4096, 65536]
+    MAX_LABEL_LENGTH = 16
+
+    # Used for estimating the size of the filesystem before shrinking it
+    DEFAULT_BLOCK_SIZE = 4096
+    DEFAULT_INODE_RATIO = 16384
+    INODE_SIZE = 256
+    METADATA_MARGIN = 16 * 1024 * 1024
+
     content: Optional[FilesContentProvider]
     """Files, that are added to the filesystem"""
 
+    headroom: SizeType = SizeType(0)
+    """Free space added to the minimum size of the filesystem, if the size is determined automatically"""
+
+    inode_count: Optional[int] = None
+    """Number of inodes to create (mke2fs -N)"""
+
+    inode_ratio: Optional[SizeType] = None
+    """Create one inode per inode_ratio bytes of the filesystem (mke2fs -i)"""
+
+    base: Optional[Path] = None
+    """Image of a previous version of the filesystem, that is updated incrementally"""
+
+    max_update_percent: int = 50
+    """Maximum percentage of the file data, that is updated in the base filesystem"""
+
+    max_fragmentation_percent: int = 10
+    """Maximum percentage of non-contiguous files after updating the base filesystem"""
+
+    compare_content: bool = False
+    """
+    Compare the content of files with unchanged size and modification time with the base filesystem.
+    This is required, if the modification times are clamped (e.g. to ``SOURCE_DATE_EPOCH``),
+    but all these files are read from the base filesystem as well.
+    """
+
+    _features: List[str]
+    _block_size: Optional[SizeType] = None
+    _reserved_percent: Optional[int] = None
+    _extended_options: List[str]
+    _label: Optional[str] = None
+    _uuid: Optional[str] = None
+    _shrink_to_fit: bool = False
+    _created: bool = False
+
     def __init__(self) -> None:
         super().__init__()
         self.content = None
+        self._features = []
+        self._extended_options = []
+
+    @property
+    def features(self) -> List[str]:
+        """Filesystem features to enable or (if prefixed with ^) disable (mke2fs -O)"""
+        return self._features
+
+    @features.setter
+    def features(self, value: List[str]) -> None:
+        for feature in value:
+            if not re.fullmatch(r"\^?[a-z0-9_]+", feature):
+                raise Exception(f"Invalid ext4 feature '{feature}'")
+        self._features = value
+
+    @property
+    def block_size(self) -> Optional[SizeType]:
+        """Block size of the filesystem (mke2fs -b)"""
+        return self._block_size
+
+    @block_size.setter
+    def block_size(self, value: Optional[SizeType]) -> None:
+        if value is not None and value.bytes not in self.BLOCK_SIZES:
+            raise Exception(f"Invalid ext4 block size {value.bytes} (allowed: {', '.join(map(str, self.BLOCK_SIZES))})")
+        self._block_size = value
+
+    @property
+    def reserved_percent(self) -> Optional[int]:
+        """Percentage of blocks reserved for the super user (mke2fs -m)"""
+        return self._reserved_percent
+
+    @reserved_percent.setter
+    def reserved_percent(self, value: Optional[int]) -> None:
+        if value is not None and not 0 <= value <= 50:
+            raise Exception("The reserved percentage must be between 0 and 50")
+        self._reserved_percent = value
+
+    @property
+    def extended_options(self) -> List[str]:
+        """Extended options (e.g. nodiscard or root_owner=0:0) (mke2fs -E)"""
+        return self._extended_options
+
+    @extended_options.setter
+    def extended_options(self, value: List[str]) -> None:
+        for option in value:
+            if not re.fullmatch(r"[a-z0-9_]+(=[^,\s]+)?", option):
+                raise Exception(f"Invalid ext4 extended option '{option}'")
+        self._extended_options = value
+
+    @property
+    def label(self) -> Optional[str]:
+        """Volume label of the filesystem (mke2fs -L)"""
+        return self._label
+
+    @label.setter
+    def label(self, value: Optional[str]) -> None:
+        if value is not None and len(value.encode()) > self.MAX_LABEL_LENGTH:
+            raise Exception(f"The ext4 label must not be longer than {self.MAX_LABEL_LENGTH} bytes")
+        self._label = value
+
+    @property
+    def uuid(self) -> Optional[str]:
+        """UUID of the filesystem (mke2fs -U). This can be useful, to generate reproducible images"""
+        return self._uuid
+
+    @uuid.setter
+    def uuid(self, value: Optional[str]) -> None:
+        if value is not None:
+            try:
+                UUID(value)
+            except ValueError as e:
+                raise Exception(f"Invalid ext4 UUID '{value}'") from e
+        self._uuid = value
+
+    @property
+    def created(self) -> bool:
+        """The filesystem was created from scratch by mke2fs (i.e. not updated from ``base``)"""
+        return self._created
 
     def prepare(self) -> None:
+        if self.inode_count is not None and self.inode_ratio is not None:
+            raise Exception("Only one of inode_count and inode_ratio can be set")
+        if self.content:
+            self.content.acquire()
         if self.size.is_undefined:
-            raise Exception("Ext4 content requires a fixed size at the moment")
+            # The size depends on the files, so the filesystem has to be created already
+            self._shrink_to_fit = True
+            self.materialize()
+
+    def estimate(self) -> ResourceEstimate:
+        # The files are hardlinked into the staging directory, if possible
+        return ResourceEstimate(
+            data=self.size.bytes,
+            temp_files=[self.size.bytes],
+            temp_other=self.content.estimate().temp if self.content else 0
+        )
+
+    def do_materialize(self) -> None:
+        # The files are only required for creating the filesystem, so they
+        # are prepared here and not in prepare, which only determines the layout
         if self.content:
             self.content.prepare()
+            self.content.materialize()
+        self._materialize_result()
+        if self.content:
+            # The files are part of the filesystem now
+            self.content.release()
 
     def _prepare_result(self):
-        create_empty_image(self.result_file, self.size.bytes)
-
         if self.content:
             with TemporaryDirectory(dir=BuildLocation().path) as diro:
-                fr = FakeRoot(get_temp_file(), self.content.fakeroot)
                 tmp_dir = Path(diro)
-                for file in self.content.files:
-                    fr.copy(file, tmp_dir)
-
-                fr.run([
-                    "mkfs.ext4",
-                    "-d", diro,
-                    self.result_file
-                ], check=True)
+                fr = self.content.stage(tmp_dir)
+
+                self._created = not self.base or not self._update_base(fr, tmp_dir)
+                if self._created:
+                    self._create_image(tmp_dir)
+                    fr.run([
+                        "mkfs.ext4",
+                        *self._mkfs_options(),
+                        "-d", diro,
+                        self.result_file
+                    ], check=True)
+                fr.savefile.unlink(missing_ok=True)
         else:
+            self._created = True
+            self._create_image(None)
+            subprocess.run([
+                "mkfs.ext4", *self._mkfs_options(), self.result_file
+            ], check=True)
+
+        if self._shrink_to_fit:
+            self._shrink()
+        # Free blocks may contain stale data (e.g. of files removed from the base image).
+        # Consumers of the result file (e.g. verity) must see the same data, that is written.
+        with self.result_file.open("rb+") as f:
+            discard_unused(f)
+
+    def _update_base(self, fr: FakeRoot, directory: Path) -> bool:
+        """
+        Create the filesystem by applying the differences to the files in directory to a copy of base.
+
+        Returns False, if the filesystem has to be created from scratch instead.
+        """
+        assert self.base
+        with self.base.open("rb") as f:
+            base_size = filesystem_size(f)
+        if base_size is None:
+            raise Exception(f"{self.base} does not contain an ext4 filesystem")
+        size = base_size if self._shrink_to_fit else self.size.bytes
+        if size < base_size:
+            logger.info("Not updating %s: It is larger than the filesystem", self.base)
+            return False
+
+        new_tree = local_tree(fr, directory)
+        old_tree = read_tree(self.base)
+        if new_tree is None or old_tree is None:
+            logger.info("Not updating %s: The files cannot be updated incrementally", self.base)
+            return False
+        update = plan_update(old_tree, new_tree, directory, self.base if self.compare_content else None)
+        if update.written * 100 > update.total * self.max_update_percent:
+            logger.info("Not updating %s: %d of %d B changed", self.base, update.written, update.total)
+            return False
+
+        with self.base.open("rb") as in_file, self.result_file.open("wb") as out_file:
+            copy_range_sparse(in_file.fileno(), out_file.fileno(), 0, 0, base_size)
+            out_file.truncate(size)
+        if size > base_size:
+            subprocess.run(["resize2fs", self.result_file], check=True)
+        try:
+            apply_update(self.result_file, update)
+            fragmented = fragmentation(self.result_file)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            logger.info("Not updating %s: %s", self.base, e)
+            return False
+        if fragmented > self.max_fragmentation_percent:
+            logger.info("Not updating %s: %.1f%% of the files are fragmented", self.base, fragmented)
+            return False
+        logger.info("Updated %s: %d of %d B changed", self.base, update.written, update.total)
+        return True
+
+    def _create_image(self, directory: Optional[Path]) -> None:
+        if self._shrink_to_fit:
+            self.size = self._estimate_size(directory)
+        create_empty_image(self.result_file, self.size.bytes)
+
+    def _estimate_size(self, directory: Optional[Path]) -> SizeType:
+        """
+        Estimate an upper bound of the size of a filesystem containing all files in directory.
+
+        The size is the sum of the block rounded file sizes and inodes with
+        an additional margin for the metadata (e.g. the journal and bitmaps).
+        """
+        block_size = self.block_size.bytes if self.block_size else self.DEFAULT_BLOCK_SIZE
+        inodes: Set[int] = set()
+        blocks = 0
+        for root, dirs, files in os.walk(directory) if directory else []:
+            for name in dirs + files:
+                stat = os.lstat(os.path.join(root, name))
+                if stat.st_ino not in inodes: # Hardlinks are only stored once
+                    inodes.add(stat.st_ino)
+                    blocks += math.ceil(stat.st_size / block_size)
+        size = math.ceil((blocks * block_size + len(inodes) * self.INODE_SIZE) * 1.1)
+        if self.inode_count is None:
+            # Ensure, that enough inodes are created
+            inode_ratio = self.inode_ratio.bytes if self.inode_ratio else self.DEFAULT_INODE_RATIO
+            size = max(size, math.ceil(len(inodes) * 1.1) * inode_ratio)
+        size += self.METADATA_MARGIN
+        return SizeType(math.ceil(size / block_size) * block_size)
+
+    def _shrink(self) -> None:
+        """Shrink the filesystem to the minimum size and add the headroom"""
+        subprocess.run([
+            "resize2fs", "-M", self.result_file
+        ], check=True)
+        if self.headroom.bytes:
+            os.truncate(self.result_file, self._filesystem_size() + self.headroom.bytes)
             subprocess.run([
-                "mkfs.ext4", self.result_file
+                "resize2fs", self.result_file
             ], check=True)
+        self.size = SizeType(self._filesystem_size())
+        os.truncate(self.result_file, self.size.bytes)
+
+    def _filesystem_size(self) -> int:
+        with self.result_file.open("rb") as f:
+            size = filesystem_size(f)
+        if size is None:
+            raise Exception(f"{self.result_file} does not contain an ext4 filesystem")
+        return size
+
+    def _mkfs_options(self) -> List[str]:
+        options = []
+        if self.features:
+            options += ["-O", ",".join(self.features)]
+        if self.inode_count is not None:
+            options += ["-N", str(self.inode_count)]
+        if self.inode_ratio is not None:
+            options += ["-i", str(self.inode_ratio.bytes)]
+        if self.block_size is not None:
+            options += ["-b", str(self.block_size.bytes)]
+        if self.reserved_percent is not None:
+            options += ["-m", str(self.reserved_percent)]
+        if self.extended_options:
+            options += ["-E", ",".join(self.extended_options)]
+        if self.label is not None:
+            options += ["-L", self.label]
+        if self.uuid is not None:
+            options += ["-U", self.uuid]
+        return options
+
+    def write(self, file: io.BufferedIOBase) -> None:
+        # Copy only the used blocks of the result file, not the whole file like BinaryContent
+        self.materialize()
+        self.do_write(file)
 
     def do_write(self, file: io.BufferedIOBase):
         with open(self.result_file, "rb") as in_file:
-            copy_sparse(file, in_file, self.size.bytes)
+            copy_used(file, in_file, self.size.bytes)
 
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}({self.content or ''})"
@@ -1,45 +1,140 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 import io
+import math
 import subprocess
-from typing import Optional
+from typing import List, Optional
 
 from embdgen.core.content.BinaryContent import BinaryContent
+from embdgen.core.content.ResourceEstimate import ResourceEstimate
 from embdgen.core.content.FilesContentProvider import FilesContentProvider
 from embdgen.core.utils.class_factory import Config
+from embdgen.core.utils.fat import (DIR_ENTRY_SIZE, SECTOR_SIZE, FatLayout, FatWriter, check_cluster_size,
+                                    clusters_required, minimum_layout)
 from embdgen.core.utils.image import copy_sparse, create_empty_image
+from embdgen.core.utils.SizeType import SizeType
 
 
 @Config("content")
 @Config("size", optional=True)
+@Config("cluster_size", optional=True)
+@Config("headroom", optional=True)
+@Config("use_internal_implementation", optional=True)
+@Config("volume_id", optional=True)
 class Fat32Content(BinaryContent):
     """Fat32 Content
 
     Currently this can only be created using a FilesContent,
     that contains a list of files, that are copied to the root
     of a newly created fat32 filesystem.
+
+    If no size is set, the minimum size for the files (plus ``headroom``) is calculated.
+    If the files do not require enough clusters for FAT32, FAT16 is used instead.
+    In this case the content is already materialized, when the layout of the image is prepared.
+
+    By default the filesystem is created with mkfs.vfat and mcopy. If ``use_internal_implementation``
+    is set, it is created by embdgen instead and written directly to the image (see ``FatWriter``).
+    This results in a different (but reproducible) layout, volume id and timestamps. The type
+    of the FAT (12, 16 or 32 bit) is then determined by the number of clusters, that fit
+    into the filesystem.
     """
     CONTENT_TYPE = "fat32"
 
+    DEFAULT_CLUSTER_SIZE = 4096
+
     content: Optional[FilesContentProvider]
     """Content of this region"""
 
+    headroom: SizeType = SizeType(0)
+    """Free space added to the calculated minimum size of the filesystem"""
+
+    use_internal_implementation: bool = False
+    """
+    If set, the filesystem is created by embdgen, otherwise mkfs.vfat and mcopy are used (default).
+    """
+
+    volume_id: Optional[int] = None
+    """Volume serial number (only used by the internal implementation, derived from the files by default)"""
+
+    _cluster_size: Optional[SizeType] = None
+    _mkfs_options: List[str]
+    _auto_size: bool = False
+    _writer: Optional[FatWriter] = None
+
     def __init__(self) -> None:
         super().__init__()
         self.content = None
+        self._mkfs_options = []
+
+    @property
+    def cluster_size(self) -> Optional[SizeType]:
+        """
+        Size of a cluster (defaults to 4096, if the size is calculated or the internal implementation is used,
+        otherwise it is chosen by mkfs.vfat)
+        """
+        return self._cluster_size
+
+    @cluster_size.setter
+    def cluster_size(self, value: Optional[SizeType]) -> None:
+        if value is not None:
+            check_cluster_size(value.bytes)
+        self._cluster_size = value
 
     def prepare(self) -> None:
-        if self.size.is_undefined:
-            raise Exception("Fat32 content requires a fixed size at the moment")
         if self.content:
-            self.content.prepare()
+            self.content.acquire()
+        if self.size.is_undefined:
+            # The size depends on the files, so they have to be materialized already
+            self._auto_size = True
+            self.materialize()
+
+
+    def _calculate_size(self) -> Optional[FatLayout]:
+        """
+        Calculate the size, if it is not set, and return the layout of the internal implementation
+
+        An exception is raised, if the files do not fit into a filesystem of a fixed size.
+        """
+        files = self.content.files if self.content else []
+        if self._auto_size:
+            layout = minimum_layout(files, (self.cluster_size or SizeType(self.DEFAULT_CLUSTER_SIZE)).bytes,
+                                    self.headroom.bytes)
+            self.size = SizeType(layout.size)
+            self._mkfs_options = layout.mkfs_options()
+            return layout
+        if self.cluster_size:
+            self._mkfs_options = ["-s", str(self.cluster_size.sectors)]
+        if not self.use_internal_implementation:
+            # The cluster size is chosen by mkfs.vfat, if it is not set,
+            # but clusters of at least one sector are required for the data in any case
+            cluster_size = self.cluster_size.bytes if self.cluster_size else SECTOR_SIZE
+            clusters, _ = clusters_required(files, cluster_size)
+            self._check_fit(clusters, cluster_size, self.size.bytes // cluster_size)
+            return None
+        # The same layout is used by the FatWriter
+        cluster_size = (self.cluster_size or SizeType(self.DEFAULT_CLUSTER_SIZE)).bytes
+        clusters, root_entries = clusters_required(files, cluster_size)
+        layout = FatLayout.for_size(self.size.bytes, cluster_size, root_entries)
+        if layout.fat_bits == 32:
+            # The root directory is stored in clusters in FAT32
+            clusters += math.ceil(root_entries * DIR_ENTRY_SIZE / cluster_size)
+        self._check_fit(clusters, cluster_size, layout.clusters)
+        return layout
+
+
+    def _check_fit(self, clusters: int, cluster_size: int, available: int) -> None:
+        if clusters > available:
+            raise Exception(f"The files ({clusters * cluster_size} B) do not fit into the fat filesystem "
+                            f"({self.size.bytes} B)")
 
 
     def _prepare_result(self):
+        self._calculate_size()
         create_empty_image(self.result_file, self.size.bytes)
 
         subprocess.run([
                 "mkfs.vfat",
+                *self._mkfs_options,
                 self.result_file
             ],
             check=True,
@@ -60,7 +155,46 @@ class Fat32Content(BinaryContent):
                 )
 
 
+    def _create_writer(self) -> None:
+        files = self.content.files if self.content else []
+        layout = self._calculate_size()
+        assert layout
+        self._writer = FatWriter(layout, self.size.bytes, files, self.volume_id)
+
+
+    def do_materialize(self) -> None:
+        if self.content:
+            self.content.prepare()
+            self.content.materialize()
+        if self.use_internal_implementation:
+            # The files are read, when the filesystem is written to the image
+            self._create_writer()
+            return
+        self._materialize_result()
+        if self.content:
+            self.content.release()
+
+
+    def do_release(self) -> None:
+        if self._writer:
+            self._writer = None
+            if self.content:
+                self.content.release()
+        super().do_release()
+
+
+    def estimate(self) -> ResourceEstimate:
+        return ResourceEstimate(
+            data=self.size.bytes,
+            temp_files=[] if self.use_internal_implementation else [self.size.bytes],
+            temp_other=self.content.estimate().temp if self.content else 0
+        )
+
+
     def do_write(self, file: io.BufferedIOBase):
+        if self._writer:
+            self._writer.write(file) # type: ignore[arg-type]
+            return
         with open(self.result_file, "rb") as in_file:
             copy_sparse(file, in_file, self.size.bytes)
 
@@ -0,0 +1,141 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from embdgen.core.utils.class_factory import Config
+from embdgen.core.content.FilesContentProvider import FilesContentProvider
+from embdgen.core.content.ResourceEstimate import ResourceEstimate
+from embdgen.core.utils.FakeRoot import FakeRoot
+from embdgen.core.utils.image import BuildLocation, get_temp_file
+
+
+@dataclass
+class _Entry:
+    source: Path
+    layer: int
+    children: Optional[Dict[str, "_Entry"]] = None
+    """Entries of a directory (None for all other files)"""
+
+
+@Config("layers")
+class LayeredContent(FilesContentProvider):
+    """Files combined from multiple layers
+
+    The layers are applied in order: Files of later layers replace files with
+    the same path in earlier layers, directories are merged.
+    Whiteouts (as used by OCI image layers) remove files of earlier layers:
+
+     - ``.wh.<name>`` removes ``<name>`` from the same directory
+     - ``.wh..wh..opq`` removes all entries of earlier layers from the directory
+
+    The whiteouts themselves are not part of the result.
+
+    The layers are not merged physically: The paths are resolved in an index and
+    only the resulting files are staged by the filesystem contents (see ``stage``).
+    The ownership recorded by every layer (e.g. in an archive) is preserved.
+    """
+    CONTENT_TYPE = "layers"
+
+    WHITEOUT_PREFIX = ".wh."
+    OPAQUE_WHITEOUT = ".wh..wh..opq"
+
+    layers: List[FilesContentProvider]
+    """Layers of files (the first layer is the lowest)"""
+
+    _merged_dir: Optional[TemporaryDirectory] = None
+    _merged_fakeroot: Optional[FakeRoot] = None
+    _acquired: bool = False
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.layers = []
+
+    def prepare(self) -> None:
+        for layer in self.layers:
+            if not self._acquired:
+                layer.acquire()
+            layer.prepare()
+        self._acquired = True
+
+    def do_materialize(self) -> None:
+        for layer in self.layers:
+            layer.materialize()
+
+    def estimate(self) -> ResourceEstimate:
+        return ResourceEstimate(temp_other=sum(layer.estimate().temp for layer in self.layers))
+
+    def _index(self) -> Dict[str, _Entry]:
+        """Resolve the files of all layers"""
+        root: Dict[str, _Entry] = {}
+        for number, layer in enumerate(self.layers):
+            for file in layer.files:
+                self._add(root, file, number)
+        return root
+
+    def _add(self, entries: Dict[str, _Entry], source: Path, layer: int) -> None:
+        name = source.name
+        if name == self.OPAQUE_WHITEOUT:
+            for key in [key for key, entry in entries.items() if entry.layer < layer]:
+                del entries[key]
+        elif name.startswith(self.WHITEOUT_PREFIX):
+            entry = entries.get(name[len(self.WHITEOUT_PREFIX):])
+            if entry and entry.layer < layer:
+                del entries[name[len(self.WHITEOUT_PREFIX):]]
+        elif source.is_dir() and not source.is_symlink():
+            previous = entries.get(name)
+            # The attributes of a merged directory are taken from the latest layer
+            entry = _Entry(source, layer, previous.children if previous and previous.children is not None else {})
+            entries[name] = entry
+            for child in sorted(source.iterdir()):
+                self._add(entry.children, child, layer) # type: ignore[arg-type]
+        else:
+            entries[name] = _Entry(source, layer)
+
+    @classmethod
+    def _walk(cls, entries: Dict[str, _Entry], directory: Path) -> Iterator[Tuple[Path, Path]]:
+        """All entries (source, destination) below directory, parents before their children"""
+        for name, entry in sorted(entries.items()):
+            yield entry.source, directory / name
+            if entry.children is not None:
+                yield from cls._walk(entry.children, directory / name)
+
+    def stage(self, directory: Path) -> FakeRoot:
+        fr = FakeRoot.combine(get_temp_file(), [layer.fakeroot for layer in self.layers])
+        fr.copy_entries(self._walk(self._index(), directory))
+        return fr
+
+    @property
+    def fakeroot(self) -> FakeRoot:
+        return self._merged_fakeroot or self._fakeroot
+
+    @property
+    def files(self) -> List[Path]:
+        """The combined files
+
+        These are only staged into a temporary directory, when they are accessed
+        (e.g. by a fat32 content). Filesystems using ``stage`` do not access them.
+        """
+        if not self._merged_dir:
+            self._merged_dir = TemporaryDirectory(  # pylint: disable=consider-using-with
+                dir=BuildLocation().path
+            )
+            self._merged_fakeroot = self.stage(Path(self._merged_dir.name))
+        return sorted(Path(self._merged_dir.name).iterdir())
+
+    def do_release(self) -> None:
+        if self._merged_dir:
+            self._merged_dir.cleanup()
+            self._merged_dir = None
+        if self._merged_fakeroot:
+            self._merged_fakeroot.savefile.unlink(missing_ok=True)
+            self._merged_fakeroot = None
+        if self._acquired:
+            self._acquired = False
+            for layer in self.layers:
+                layer.release()
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({', '.join(map(repr, self.layers))})"
@@ -0,0 +1,144 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import io
+import os
+from pathlib import Path
+from typing import Optional
+
+from embdgen.core.utils.class_factory import Config
+from embdgen.core.content.BinaryContent import BinaryContent
+from embdgen.core.content.ResourceEstimate import ResourceEstimate
+from embdgen.core.utils import luks2
+from embdgen.core.utils.image import copy_sparse, create_empty_image
+from embdgen.core.utils.SizeType import SizeType
+
+
+@Config("content")
+@Config("passphrase", optional=True)
+@Config("key_file", optional=True)
+@Config("uuid", optional=True)
+@Config("label", optional=True)
+@Config("sector_size", optional=True)
+@Config("kdf", optional=True)
+@Config("kdf_iterations", optional=True)
+@Config("kdf_memory", optional=True)
+@Config("threads", optional=True)
+@Config("sparse", optional=True)
+class Luks2Content(BinaryContent):
+    """LUKS2 encrypted content
+
+    Creates a LUKS2 header (like ``cryptsetup luksFormat --type luks2``) followed
+    by the content encrypted with aes-xts-plain64, without using device mapper.
+    The content can be opened with ``cryptsetup open`` using the passphrase or key file.
+
+    The header takes 16 MiB (the default data offset of cryptsetup), the areas of the header,
+    that are not in use, are left as holes.
+
+    The content is encrypted in parallel by ``threads`` processes (not threads, the option
+    is named like in the other contents), which are started by a fork server.
+    """
+    CONTENT_TYPE = "luks2"
+
+    content: BinaryContent
+    """The payload content of the encrypted volume"""
+
+    passphrase: Optional[str] = None
+    """Passphrase of the keyslot"""
+
+    key_file: Optional[Path] = None
+    """File containing the key of the keyslot (like in cryptsetup, the whole file is used)"""
+
+    uuid: Optional[str] = None
+    """UUID of the volume (a random UUID is used, if not set)"""
+
+    label: str = ""
+    """Label of the volume"""
+
+    sector_size: SizeType = SizeType(4096)
+    """Encryption sector size (512, 1024, 2048 or 4096, defaults to 4096)"""
+
+    kdf: str = "argon2id"
+    """Key derivation function of the keyslot (argon2id or pbkdf2)"""
+
+    kdf_iterations: Optional[int] = None
+    """Number of iterations (pbkdf2, defaults to 1000000) or time cost (argon2id, defaults to 4)"""
+
+    kdf_memory: int = 1048576
+    """Memory cost of argon2id in KiB (defaults to 1 GiB)"""
+
+    _threads: int = 0
+
+    sparse: bool = False
+    """
+    If set, sectors of the content, that contain only zeros, are not encrypted but left as holes.
+    These sectors do not read as zeros from the opened volume, so this is only possible, if the
+    content does not rely on reading zeros from areas, it did not write (e.g. free space of a filesystem).
+    """
+
+    @property
+    def threads(self) -> int:
+        """Number of worker processes (despite the name) used for encrypting (defaults to the number of CPUs)"""
+        return self._threads or os.cpu_count() or 1
+
+    @threads.setter
+    def threads(self, value: int) -> None:
+        if value < 0:
+            raise Exception("The number of threads must not be negative")
+        self._threads = value
+
+    def _header(self) -> luks2.Header:
+        if (self.passphrase is None) == (self.key_file is None):
+            raise Exception("Exactly one of passphrase and key_file must be set")
+        passphrase = self.key_file.read_bytes() if self.key_file else self.passphrase.encode("utf8") # type: ignore[union-attr]
+        if self.kdf == "pbkdf2":
+            kdf = luks2.Kdf("pbkdf2", self.kdf_iterations or 1000000)
+        else:
+            kdf = luks2.Kdf(self.kdf, self.kdf_iterations or 4, self.kdf_memory)
+        header = luks2.Header(passphrase, kdf, self.sector_size.bytes, label=self.label)
+        if self.uuid:
+            header.uuid = self.uuid
+        return header
+
+    def prepare(self) -> None:
+        self.content.prepare()
+        self.content.acquire()
+
+        if self.sector_size.bytes not in luks2.SECTOR_SIZES:
+            raise Exception(f"Invalid sector size {self.sector_size.bytes}")
+        if self.content.size.bytes % self.sector_size.bytes != 0:
+            raise Exception("Underlying data device must be sector size-aligned")
+        self.size = SizeType(luks2.DATA_OFFSET + self.content.size.bytes)
+
+    def estimate(self) -> ResourceEstimate:
+        content = self.content.estimate()
+        # Only the header copies and the keyslot area of the header contain data
+        header = luks2.KEYSLOTS_OFFSET + luks2.KEY_SIZE * luks2.STRIPES
+        payload = content.data if self.sparse else self.content.size.bytes
+        # The content, the key derivation and the encryption are done one after the other
+        kdf_memory = self.kdf_memory * 1024 if self.kdf == "argon2id" else 0
+        processes = max(1, min(self.threads, -(-self.content.size.bytes // luks2.CHUNK_SIZE)))
+        memory = max(content.memory, kdf_memory, processes * luks2.CHUNK_MEMORY)
+        return ResourceEstimate(data=header + payload, temp_files=content.temp_files + [self.size.bytes],
+                                temp_other=content.temp_other, memory=memory)
+
+    def do_materialize(self) -> None:
+        self.content.materialize()
+        self._materialize_result()
+        # The content was encrypted into the result file and is not needed anymore
+        self.content.release()
+
+    def _prepare_result(self):
+        header = self._header()
+        create_empty_image(self.result_file, self.size.bytes)
+        with self.result_file.open("rb+") as f:
+            header.write(f)
+        source, offset = self.content.source or (self.content.result_file, 0)
+        luks2.encrypt(header, luks2.Payload(source, offset, self.content.size.bytes, self.result_file, self.sparse),
+                      self.threads)
+
+    def do_write(self, file: io.BufferedIOBase):
+        with open(self.result_file, "rb") as in_file:
+            copy_sparse(file, in_file, self.size.bytes)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.content})"
@@ -2,7 +2,7 @@
 
 from io import BufferedIOBase
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 
 from embdgen.core.utils.class_factory import Config
 from embdgen.core.content.BinaryContent import BinaryContent
@@ -63,6 +63,10 @@ class RawContent(BinaryContent):
         if self.size.is_undefined:
             self.size = SizeType(file_size_available)
 
+    @property
+    def source(self) -> Optional[Tuple[Path, int]]:
+        return self.file, self.offset.bytes
+
     def do_write(self, file: BufferedIOBase):
         with open(self.file, "rb") as in_file:
             in_file.seek(self.offset.bytes)
@@ -7,14 +7,21 @@ import subprocess
 from embdgen.core.utils.SizeType import SizeType, BYTES_PER_SECTOR
 from embdgen.core.utils.class_factory import Config
 from embdgen.core.content.BinaryContent import BinaryContent
-from embdgen.core.utils.image import create_empty_image, copy_sparse
+from embdgen.core.content.ResourceEstimate import ResourceEstimate
+from embdgen.core.utils.ext4 import copy_used, discard_unused
+from embdgen.core.utils.image import create_empty_image, copy_range_sparse
+from embdgen.plugins.content.Ext4Content import Ext4Content
 
 @Config('content')
 @Config('add_space', optional=True)
 class ResizeExt4Content(BinaryContent):
     """Resize an ext4 partition
     
-    Allows increasing the size of an ext4 filesystem
+    Allows increasing the size of an ext4 filesystem.
+
+    If the content is backed by a file, it is cloned into the result file
+    (using reflinks, if supported by the filesystem of the build location),
+    so the filesystem is only copied once, when it is written to the image.
     """
     CONTENT_TYPE = "resize_ext4"
 
@@ -40,27 +47,66 @@ class ResizeExt4Content(BinaryContent):
 
     def prepare(self) -> None:
         self.content.prepare()
+        self.content.acquire()
         self.size = self.content.size
         self.size += self.add_space
 
-    def _prepare_result(self):
-        create_empty_image(self.result_file, self.size.bytes)
+    def estimate(self) -> ResourceEstimate:
+        content = self.content.estimate()
+        return ResourceEstimate(
+            data=self.size.bytes,
+            temp_files=content.temp_files + [self.size.bytes],
+            temp_other=content.temp_other,
+            memory=content.memory
+        )
 
-        with self.result_file.open("rb+") as f:
-            self.content.write(f)
+    def do_materialize(self) -> None:
+        self.content.materialize()
+        self._materialize_result()
+        # The content was copied to the result file
+        self.content.release()
 
-        subprocess.run([
-            "e2fsck",
-            "-fp",
-            str(self.result_file)
-        ], check=True)
+    @property
+    def _content_is_clean(self) -> bool:
+        """
+        The content is a filesystem freshly created by mke2fs, so it does not need to be checked before resizing
+
+        Filesystems updated from a base image or resized are checked.
+        """
+        return isinstance(self.content, Ext4Content) and self.content.created
+
+    def _prepare_result(self):
+        source = self.content.source
+        if source:
+            with source[0].open("rb") as in_file, self.result_file.open("wb") as out_file:
+                copy_range_sparse(in_file.fileno(), out_file.fileno(), source[1], 0, self.content.size.bytes)
+                out_file.truncate(self.size.bytes)
+        else:
+            create_empty_image(self.result_file, self.size.bytes)
+            with self.result_file.open("rb+") as f:
+                self.content.write(f)
+
+        if not self._content_is_clean:
+            subprocess.run([
+                "e2fsck",
+                "-fp",
+                str(self.result_file)
+            ], check=True)
 
         subprocess.run([
             "resize2fs",
             str(self.result_file),
             f"{self.size.sectors}s"
         ], check=True)
+        # Like in Ext4Content, the result file contains the same data, that is written
+        with self.result_file.open("rb+") as f:
+            discard_unused(f)
+
+    def write(self, file: BufferedIOBase) -> None:
+        # Copy only the used blocks of the result file, not the whole file like BinaryContent
+        self.materialize()
+        self.do_write(file)
 
     def do_write(self, file: BufferedIOBase):
         with self.result_file.open("rb") as in_file:
-            copy_sparse(file, in_file)
+            copy_used(file, in_file, self.size.bytes)
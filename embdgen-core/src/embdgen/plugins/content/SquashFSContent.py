@@ -0,0 +1,49 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from pathlib import Path
+from typing import List, Optional, Union
+
+from embdgen.core.content.CompressedFilesystemContent import CompressedFilesystemContent
+from embdgen.core.utils.class_factory import Config
+from embdgen.core.utils.SizeType import SizeType
+
+
+@Config("block_size", optional=True)
+class SquashFSContent(CompressedFilesystemContent):
+    """SquashFS Content
+
+    Creates a compressed read-only SquashFS filesystem using mksquashfs,
+    that compresses the files in parallel with ``threads`` processors.
+    """
+    CONTENT_TYPE = "squashfs"
+
+    COMPRESSIONS = ["gzip", "lzo", "lz4", "xz", "zstd", "lzma"]
+    MIN_BLOCK_SIZE = 4096
+    MAX_BLOCK_SIZE = 1024 * 1024
+
+    _block_size: Optional[SizeType] = None
+
+    @property
+    def block_size(self) -> Optional[SizeType]:
+        """Block size of the filesystem (a power of two between 4 KiB and 1 MiB)"""
+        return self._block_size
+
+    @block_size.setter
+    def block_size(self, value: Optional[SizeType]) -> None:
+        if value is not None and (not self.MIN_BLOCK_SIZE <= value.bytes <= self.MAX_BLOCK_SIZE or
+                                  value.bytes & (value.bytes - 1)):
+            raise Exception(f"Invalid squashfs block size {value.bytes}")
+        self._block_size = value
+
+    def _mkfs_command(self, directory: Path, image: Path) -> List[Union[str, Path]]:
+        options: List[Union[str, Path]] = [
+            "mksquashfs", directory, image,
+            "-noappend",
+            "-no-progress",
+            "-processors", str(self.threads)
+        ]
+        if self.compression:
+            options += ["-comp", self.compression]
+        if self.block_size:
+            options += ["-b", str(self.block_size.bytes)]
+        return options
@@ -6,13 +6,14 @@ from io import BufferedIOBase
 import math
 import random
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Tuple
 
 import hashlib
 
 from embdgen.core.utils.class_factory import Config
 from embdgen.core.content.BinaryContent import BinaryContent
-from embdgen.core.utils.image import copy_sparse, get_temp_file
+from embdgen.core.content.ResourceEstimate import ResourceEstimate
+from embdgen.core.utils.image import CacheDropper, copy_sparse, get_temp_file
 from embdgen.core.utils.SizeType import SizeType
 
 @Config('content')
@@ -62,7 +63,8 @@ class VerityContent(BinaryContent):
     @property
     def hash_file(self):
         if not self.__hash_file:
-            self.__hash_file = get_temp_file(ext=".hash")
+            _, block_counts, _ = self._hash_tree_layout()
+            self.__hash_file = get_temp_file(ext=".hash", size_hint=sum(block_counts) * self.hash_block_size.bytes)
         return self.__hash_file
 
     def _do_verity(self) -> None:
@@ -87,23 +89,20 @@ class VerityContent(BinaryContent):
                 self.hash_file
             ], stdout=f, stderr=f, check=True)
 
-        self.size.bytes = self.content.size.bytes + self.hash_file.stat().st_size
+        _, block_counts, _ = self._hash_tree_layout()
+        if self.hash_file.stat().st_size != sum(block_counts) * self.hash_block_size.bytes:
+            raise Exception("The hash tree created by veritysetup has an unexpected size")
 
-    def _do_verity_py(self): #pylint: disable = too-many-locals
+    def _hash_tree_layout(self) -> Tuple[int, List[int], List[int]]:
         """
-        # Calculating the hash tree is not really hard:
-        #
-        # 1. Calculate sha256 over all each block (4096 byte by default) and concatenate them.
-        # 2. Extend the result with zeroes to align to a block
-        # 3. If the result is bigger than one block, do it again with the previously calculate blocks
-        #    and prepend the result, until it fits in one block
-        # 4. Calculate the sha256 hash of that last block -> this is the root hash
+        Calculate the layout of the hash tree.
+
+        Returns the number of data blocks, the number of hash blocks per level
+        and the start block of each level in the hash tree.
         """
         data_blocksize = self.data_block_size.bytes
         hash_blocksize = self.hash_block_size.bytes
-        salt = bytearray.fromhex(self.salt) if self.salt else random.randbytes(32)
-        hasher = hashlib.new(self.algorithm, salt, usedforsecurity=False)
-        hash_len = hasher.digest_size
+        hash_len = hashlib.new(self.algorithm, usedforsecurity=False).digest_size
 
         def get_hash_block_count(num_blocks: int) -> int:
             return math.ceil(num_blocks * hash_len / hash_blocksize)
@@ -115,7 +114,6 @@ class VerityContent(BinaryContent):
         while num_blocks != 1:
             num_blocks = get_hash_block_count(num_blocks)
             block_counts.append(num_blocks)
-        total_hash_blocks = sum(block_counts)
 
         level_start_block = []
         start = 0
@@ -124,7 +122,23 @@ class VerityContent(BinaryContent):
             start += block
         level_start_block.reverse()
 
-        self.size.bytes = self.content.size.bytes + self.__padding + total_hash_blocks *  hash_blocksize
+        return num_data_blocks, block_counts, level_start_block
+
+    def _do_verity_py(self): #pylint: disable = too-many-locals
+        """
+        # Calculating the hash tree is not really hard:
+        #
+        # 1. Calculate sha256 over all each block (4096 byte by default) and concatenate them.
+        # 2. Extend the result with zeroes to align to a block
+        # 3. If the result is bigger than one block, do it again with the previously calculate blocks
+        #    and prepend the result, until it fits in one block
+        # 4. Calculate the sha256 hash of that last block -> this is the root hash
+        """
+        data_blocksize = self.data_block_size.bytes
+        hash_blocksize = self.hash_block_size.bytes
+        salt = bytearray.fromhex(self.salt) if self.salt else random.randbytes(32)
+        hasher = hashlib.new(self.algorithm, salt, usedforsecurity=False)
+        num_data_blocks, block_counts, level_start_block = self._hash_tree_layout()
 
         cur_level = 0
         with open(self.hash_file, "wb") as out_file:
@@ -132,10 +146,13 @@ class VerityContent(BinaryContent):
             # Start with data blocks:
             out_file.seek(level_start_block[cur_level] * hash_blocksize)
             with self.content.result_file.open("rb") as in_file:
-                for _ in range(num_data_blocks):
+                in_cache = CacheDropper(in_file)
+                for block in range(num_data_blocks):
                     lhasher = hasher.copy()
                     lhasher.update(in_file.read(data_blocksize))
                     out_file.write(lhasher.digest())
+                    in_cache.advance((block + 1) * data_blocksize)
+                in_cache.finish(num_data_blocks * data_blocksize)
             cur_level += 1
             # Now condense levels
             while cur_level < len(level_start_block):
@@ -168,14 +185,13 @@ Root hash:              {root_hash}
 
     def prepare(self) -> None:
         self.content.prepare()
+        self.content.acquire()
 
         if self.content.size.bytes % self.data_block_size.bytes != 0:
             raise Exception("Underlying data device must be block size-aligned")
 
-        if self.use_internal_implementation:
-            self._do_verity_py()
-        else:
-            self._do_verity()
+        _, block_counts, _ = self._hash_tree_layout()
+        self.size.bytes = self.content.size.bytes + sum(block_counts) * self.hash_block_size.bytes
 
         self.__padding = math.ceil(
                 self.content.size.bytes / self.hash_block_size.bytes
@@ -183,6 +199,32 @@ Root hash:              {root_hash}
         self.size.bytes += self.__padding
 
 
+    def estimate(self) -> ResourceEstimate:
+        content = self.content.estimate()
+        _, block_counts, _ = self._hash_tree_layout()
+        return ResourceEstimate(
+            data=self.size.bytes,
+            # The hashes are calculated from the result file of the content
+            temp_files=(content.temp_files or [self.content.size.bytes]) +
+                       [sum(block_counts) * self.hash_block_size.bytes],
+            temp_other=content.temp_other,
+            memory=content.memory
+        )
+
+    def do_materialize(self) -> None:
+        self.content.materialize()
+        if self.use_internal_implementation:
+            self._do_verity_py()
+        else:
+            self._do_verity()
+
+    def do_release(self) -> None:
+        super().do_release()
+        if self.__hash_file:
+            self.__hash_file.unlink(missing_ok=True)
+            self.__hash_file = None
+        self.content.release()
+
     def do_write(self, file: BufferedIOBase):
         self.content.write(file)
         file.seek(self.__padding, io.SEEK_CUR)
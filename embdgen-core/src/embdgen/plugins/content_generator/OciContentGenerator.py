@@ -0,0 +1,139 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+from tempfile import TemporaryDirectory
+import threading
+from typing import Dict, List, Optional
+from pathlib import Path
+
+from embdgen.core.content.BaseContent import BaseContent
+from embdgen.core.content.FilesContentProvider import FilesContentProvider
+from embdgen.core.content.ResourceEstimate import ResourceEstimate
+from embdgen.core.content_generator.BaseContentGenerator import BaseContentGenerator
+from embdgen.core.utils import oci
+from embdgen.core.utils.class_factory import Config
+from embdgen.core.utils.image import BuildLocation
+from embdgen.plugins.content.ArchiveContent import ArchiveContent
+from embdgen.plugins.content_generator.SplitArchiveContentGenerator import Split, split_contents
+
+
+@Config("layout")
+@Config("reference", optional=True)
+@Config("platform", optional=True)
+@Config("threads", optional=True)
+@Config("splits", optional=True)
+@Config("remaining", optional=True)
+class OciContentGenerator(BaseContentGenerator, FilesContentProvider):
+    """Files of an image in an OCI image layout
+
+    The layers of the image are applied in a single pass, starting with the top-most layer.
+    Files, that are replaced or removed (by whiteouts) in an upper layer, are never unpacked.
+    The ownership and device nodes recorded in the layers are preserved.
+
+    Like in the split archive content generator, the files can be split into multiple contents.
+    The content named by ``remaining`` contains all files, that are not part of a split
+    (i.e. all files, if there are no splits).
+    """
+    CONTENT_TYPE = "oci"
+
+    layout: Path
+    """Directory containing the OCI image layout"""
+
+    reference: Optional[str] = None
+    """Reference name of the image (required, if the layout contains multiple images)"""
+
+    platform: Optional[str] = None
+    """Platform of the image (os/architecture[/variant], e.g. linux/arm64) in a multi-platform image"""
+
+    _threads: int = 0
+    _splits: List[Split]
+
+    remaining: Optional[str] = None
+    """Name of the remaining content"""
+
+    _files: List[Path]
+    _tmpDir: Optional[TemporaryDirectory] = None
+    _lock: threading.Lock
+    _extracted: bool = False
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.splits = []
+        self._files = []
+        # The image is unpacked by the first split, that is materialized
+        self._lock = threading.Lock()
+
+    @property
+    def threads(self) -> int:
+        """Number of threads used for decompressing layers (defaults to the number of CPUs)"""
+        return self._threads or os.cpu_count() or 1
+
+    @threads.setter
+    def threads(self, value: int) -> None:
+        if value < 0:
+            raise Exception("The number of threads must not be negative")
+        self._threads = value
+
+    @property
+    def splits(self) -> List[Split]:
+        """List of splits"""
+        return self._splits
+
+    @splits.setter
+    def splits(self, splits: List[Split]):
+        for s in splits:
+            s.init(self, self._fakeroot)
+        self._splits = splits
+
+    @property
+    def files(self) -> List[Path]:
+        return self._files
+
+    def get_contents(self) -> Dict[str, BaseContent]:
+        return split_contents(self.name, self.splits, self.remaining, self)
+
+    def estimate(self) -> ResourceEstimate:
+        size = 0
+        for layer in oci.read_layers(self.layout, self.reference, self.platform):
+            blob = oci.blob_path(self.layout, layer.digest)
+            if oci.is_compressed(blob):
+                # The decompressed layer is stored temporarily as well
+                size += 2 * ArchiveContent.COMPRESSION_RATIO * blob.stat().st_size
+            else:
+                size += blob.stat().st_size
+        # The image is unpacked only once, so every split and the remaining content
+        # are accounted for a share of it
+        parts = len(self.splits) + (1 if self.remaining else 0)
+        return ResourceEstimate(temp_other=size // max(parts, 1))
+
+    def prepare(self) -> None:
+        with self._lock:
+            self._prepare()
+
+    def _prepare(self) -> None:
+        if self._extracted:
+            return
+        layers = oci.read_layers(self.layout, self.reference, self.platform)
+        self._tmpDir = TemporaryDirectory(  # pylint: disable=consider-using-with
+            dir=BuildLocation().path
+        )
+        tmpDir = Path(self._tmpDir.name)
+        oci.extract(self._fakeroot, self.layout, layers, tmpDir, self.threads)
+
+        for s in self.splits:
+            s.take(tmpDir, f"image {self.layout}")
+
+        self._files = list(tmpDir.iterdir())
+        self._extracted = True
+        if not self.remaining:
+            # Nothing uses the remaining content of the image
+            self.do_release()
+
+    def do_release(self) -> None:
+        if self._tmpDir:
+            self._tmpDir.cleanup()
+            self._tmpDir = None
+            self._files = []
+
+    def __repr__(self) -> str:
+        return f"OciContentGenerator({self.name}: {self.layout}, {', '.join(map(repr, self.splits))})"
@@ -1,11 +1,13 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 from tempfile import TemporaryDirectory
+import threading
 from typing import Dict, List, Optional
 from pathlib import Path
 
 from embdgen.core.content.BaseContent import BaseContent
 from embdgen.core.content.FilesContentProvider import FilesContentProvider
+from embdgen.core.content.ResourceEstimate import ResourceEstimate
 from embdgen.core.utils.FakeRoot import FakeRoot
 
 from embdgen.core.utils.class_factory import Config
@@ -31,7 +33,7 @@ class Split(FilesContentProvider):
     remove_root: bool = False
     """If set to true, the root directory of the split is removed from the remaining tree"""
 
-    base: ArchiveContent
+    base: FilesContentProvider
     _tmpDir: Optional[TemporaryDirectory] = None
 
     @property
@@ -42,20 +44,54 @@ class Split(FilesContentProvider):
             )
         return self._tmpDir
 
-    def init(self, base: "SplitArchiveContentGenerator", fakeroot: FakeRoot):
+    def init(self, base: FilesContentProvider, fakeroot: FakeRoot):
         self._fakeroot = fakeroot
         self.base = base
 
+    def take(self, directory: Path, source: str) -> None:
+        """Move the content of the root directory of this split in directory (unpacked from source) to this split"""
+        if not (directory / self.root).is_dir():
+            raise Exception(f"Path {self.root} is not in {source}")
+        for entry in (directory / self.root).iterdir():
+            self.fakeroot.run([
+                "mv",
+                entry,
+                self.tmpDir.name
+            ], check=True)
+        if self.remove_root:
+            self.fakeroot.run([
+                "rmdir", directory / self.root
+            ], check=True)
+
     def prepare(self) -> None:
         self.base.prepare()
 
+    def estimate(self) -> ResourceEstimate:
+        return self.base.estimate()
+
     @property
     def files(self) -> List[Path]:
         return list(Path(self.tmpDir.name).iterdir())
 
+    def do_release(self) -> None:
+        if self._tmpDir:
+            self._tmpDir.cleanup()
+            self._tmpDir = None
+
     def __repr__(self) -> str:
         return f"Split({self.name}, {self.root})"
 
+def split_contents(name: str, splits: List[Split], remaining: Optional[str],
+                   rest: BaseContent) -> Dict[str, BaseContent]:
+    """Contents of a content generator named name, with the content rest named remaining"""
+    out: Dict[str, BaseContent] = {
+        f"{name}.{s.name}": s for s in splits
+    }
+
+    if remaining:
+        out[f"{name}.{remaining}"] = rest
+    return out
+
 @Config("archive")
 @Config("splits")
 @Config("remaining", optional=True)
@@ -76,40 +112,43 @@ class SplitArchiveContentGenerator(BaseContentGenerator, ArchiveContent):
     remaining: Optional[str] = None
     """Name of the remaining content"""
 
+    _lock: threading.Lock
+    _extracted: bool = False
+
     def __init__(self) -> None:
         super().__init__()
         self.splits = []
+        # The archive is unpacked by the first split, that is materialized,
+        # which may happen concurrently for different regions
+        self._lock = threading.Lock()
 
     def get_contents(self) -> Dict[str, BaseContent]:
-        out: Dict[str, BaseContent] = {
-            f"{self.name}.{s.name}": s for s in self.splits
-        }
+        return split_contents(self.name, self.splits, self.remaining, self)
 
-        if self.remaining:
-            out[f"{self.name}.{self.remaining}"] = self
-        return out
+    def estimate(self) -> ResourceEstimate:
+        # The archive is unpacked only once, so every split and the remaining content
+        # are accounted for a share of it
+        parts = len(self.splits) + (1 if self.remaining else 0)
+        return ResourceEstimate(temp_other=super().estimate().temp_other // max(parts, 1))
 
     def prepare(self) -> None:
-        if self._tmpDir:
+        with self._lock:
+            self._prepare()
+
+    def _prepare(self) -> None:
+        if self._extracted:
             return
         super().prepare()
         tmpDir = Path(self._tmpDir.name) # type: ignore[union-attr]
 
         for s in self.splits:
-            if not (tmpDir / s.root).is_dir():
-                raise Exception(f"Path {s.root} is not in archive {self.archive}")
-            for entry in (tmpDir / s.root).iterdir():
-                s.fakeroot.run([
-                    "mv",
-                    entry,
-                    s.tmpDir.name
-                ], check=True)
-            if s.remove_root:
-                s.fakeroot.run([
-                    "rmdir", tmpDir / s.root
-                ], check=True)
+            s.take(tmpDir, f"archive {self.archive}")
 
         self._files = list(tmpDir.iterdir())
+        self._extracted = True
+        if not self.remaining:
+            # Nothing uses the remaining content of the archive
+            self.do_release()
 
     @property
     def splits(self) -> List[Split]:
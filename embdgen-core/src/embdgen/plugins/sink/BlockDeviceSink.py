@@ -0,0 +1,127 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import fcntl
+import mmap
+import os
+import struct
+from typing import BinaryIO, Optional
+
+from embdgen.core.sink.BaseSink import BaseSink
+from embdgen.core.utils.image import zero_range
+
+
+class BlockDeviceSink(BaseSink):
+    """Block device (e.g. an SD card or an USB stick)
+
+    The data is written with ``O_DIRECT`` in large aligned chunks, bypassing the page cache.
+    Larger ranges without data are deallocated with ``BLKDISCARD`` and zeroed with ``BLKZEROOUT``,
+    so no stale data of a previous image remains on the device.
+    The device is flushed once after everything is written.
+
+    This sink is used automatically, if the output file is a block device.
+    """
+    SINK_TYPE = "blockdev"
+
+    CHUNK_SIZE = 8 * 1024 * 1024
+    """Size of the chunks written to the device"""
+
+    ZERO_OUT_MIN_SIZE = 1024 * 1024
+    """Smaller ranges without data are written as zeros"""
+
+    BLKSSZGET = 0x1268
+    BLKDISCARD = 0x1277
+    BLKZEROOUT = 0x127f
+
+    _file: Optional[BinaryIO] = None
+    _direct_fd: int = -1
+    _alignment: int = 4096
+    _buffer: mmap.mmap
+    _buffer_offset: int = 0
+    _buffer_len: int = 0
+
+    def open(self, size: int) -> None:
+        super().open(size)
+        self._file = os.fdopen(os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o666), "rb+")
+        if not self.filename.is_block_device():
+            self._file.truncate(size)
+        device_size = os.lseek(self._file.fileno(), 0, os.SEEK_END)
+        if device_size < size:
+            raise Exception(f"The image ({size} B) does not fit on {self.filename} ({device_size} B)")
+        try:
+            logical_block_size = struct.unpack("i", fcntl.ioctl(self._file.fileno(), self.BLKSSZGET, bytes(4)))[0]
+            self._alignment = max(self._alignment, logical_block_size)
+        except OSError:
+            pass
+        self._direct_fd = os.open(self.filename, os.O_WRONLY | os.O_DIRECT)
+        # mmap'ed memory is page aligned, as required by O_DIRECT
+        self._buffer = mmap.mmap(-1, self.CHUNK_SIZE)
+        self._buffer_offset = 0
+        self._buffer_len = 0
+
+    def _append(self, data: memoryview) -> None:
+        while data:
+            length = min(len(data), self.CHUNK_SIZE - self._buffer_len)
+            self._buffer[self._buffer_len:self._buffer_len + length] = data[:length]
+            self._buffer_len += length
+            data = data[length:]
+            if self._buffer_len == self.CHUNK_SIZE:
+                self._flush()
+
+    def _flush(self) -> None:
+        """Write all complete aligned blocks of the buffer"""
+        aligned = self._buffer_len - self._buffer_len % self._alignment
+        if not aligned:
+            return
+        view = memoryview(self._buffer)
+        written = 0
+        while written < aligned:
+            written += os.pwrite(self._direct_fd, view[written:aligned], self._buffer_offset + written)
+        rest = self._buffer_len - aligned
+        self._buffer[:rest] = view[aligned:self._buffer_len]
+        view.release()
+        self._buffer_offset += aligned
+        self._buffer_len = rest
+
+    def _zero_out(self, offset: int, length: int) -> None:
+        fd = self._file.fileno() # type: ignore[union-attr]
+        arg = struct.pack("QQ", offset, length)
+        try:
+            fcntl.ioctl(fd, self.BLKDISCARD, arg)
+        except OSError:
+            pass # Discarding is only an optimization for flash devices
+        try:
+            fcntl.ioctl(fd, self.BLKZEROOUT, arg)
+        except OSError:
+            # Not a block device or not supported by the driver
+            zero_range(self._file, offset, length) # type: ignore[arg-type]
+
+    def write(self, offset: int, data: bytes) -> None:
+        self._append(memoryview(data))
+
+    def discard(self, offset: int, length: int) -> None:
+        if length < self.ZERO_OUT_MIN_SIZE:
+            self._append(memoryview(bytes(length)))
+            return
+        head = -(self._buffer_offset + self._buffer_len) % self._alignment
+        self._append(memoryview(bytes(head)))
+        self._flush()
+        length -= head
+        aligned = length - length % self._alignment
+        self._zero_out(self._buffer_offset, aligned)
+        self._buffer_offset += aligned
+        self._append(memoryview(bytes(length - aligned)))
+
+    def close(self) -> None:
+        if self._direct_fd >= 0:
+            self._flush()
+            if self._buffer_len:
+                # The unaligned end of the image cannot be written with O_DIRECT
+                os.pwrite(self._file.fileno(), self._buffer[:self._buffer_len], # type: ignore[union-attr]
+                          self._buffer_offset)
+            os.close(self._direct_fd)
+            self._direct_fd = -1
+            self._buffer.close()
+        if self._file:
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import hashlib
+from typing import List, Optional, Tuple
+
+from embdgen.core.sink.BlockSink import BlockSink
+
+
+class BmapSink(BlockSink):
+    """Block map file
+
+    Writes a block map (version 2.0) of the image, that can be used by ``bmaptool``
+    to only write the mapped blocks of the raw image to a device.
+    """
+    SINK_TYPE = "bmap"
+
+    _ranges: List[Tuple[int, int, str]]
+    _cur_block: int
+    _range_start: Optional[int] = None
+    _hasher: Optional["hashlib._Hash"] = None
+
+    def open(self, size: int) -> None:
+        super().open(size)
+        self._ranges = []
+        self._cur_block = 0
+        self._range_start = None
+        self._hasher = None
+
+    def _close_range(self) -> None:
+        if self._hasher and self._range_start is not None:
+            self._ranges.append((self._range_start, self._cur_block - 1, self._hasher.hexdigest()))
+        self._range_start = None
+        self._hasher = None
+
+    def mapped_blocks(self, data: bytes) -> None:
+        if self._hasher is None:
+            self._range_start = self._cur_block
+            self._hasher = hashlib.sha256()
+        self._hasher.update(data)
+        self._cur_block += (len(data) + self.BLOCK_SIZE - 1) // self.BLOCK_SIZE
+
+    def unmapped_blocks(self, count: int) -> None:
+        self._close_range()
+        self._cur_block += count
+
+    def _render(self, checksum: str) -> str:
+        blocks_count = (self.size + self.BLOCK_SIZE - 1) // self.BLOCK_SIZE
+        mapped_count = sum(last - first + 1 for first, last, _ in self._ranges)
+        ranges = []
+        for first, last, chksum in self._ranges:
+            block_range = f"{first}" if first == last else f"{first}-{last}"
+            ranges.append(f'        <Range chksum="{chksum}"> {block_range} </Range>\n')
+        return (
+            '<?xml version="1.0" ?>\n'
+            '<bmap version="2.0">\n'
+            f'    <ImageSize> {self.size} </ImageSize>\n'
+            f'    <BlockSize> {self.BLOCK_SIZE} </BlockSize>\n'
+            f'    <BlocksCount> {blocks_count} </BlocksCount>\n'
+            f'    <MappedBlocksCount> {mapped_count} </MappedBlocksCount>\n'
+            '    <ChecksumType> sha256 </ChecksumType>\n'
+            f'    <BmapFileChecksum> {checksum} </BmapFileChecksum>\n'
+            '    <BlockMap>\n'
+            f'{"".join(ranges)}'
+            '    </BlockMap>\n'
+            '</bmap>\n'
+        )
+
+    def close(self) -> None:
+        super().close()
+        self._close_range()
+        # The checksum of the bmap file is calculated with the checksum field set to zeros
+        checksum = hashlib.sha256(self._render("0" * 64).encode()).hexdigest()
+        self.filename.write_text(self._render(checksum), encoding="utf-8")
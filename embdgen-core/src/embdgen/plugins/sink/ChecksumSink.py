@@ -0,0 +1,36 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import hashlib
+from pathlib import Path
+
+from embdgen.core.sink.BaseSink import BaseSink
+
+
+class ChecksumSink(BaseSink):
+    """Checksum manifest
+
+    Writes the sha256 checksum of the image in the format of ``sha256sum``.
+    The name of the image in the manifest is the name of the manifest without
+    its suffix (e.g. ``image.raw`` for ``image.raw.sha256``).
+    """
+    SINK_TYPE = "checksum"
+
+    ZERO_BUFFER = bytes(1024 * 1024)
+
+    _hasher: "hashlib._Hash"
+
+    def __init__(self, filename: Path) -> None:
+        super().__init__(filename)
+        self._hasher = hashlib.sha256()
+
+    def write(self, offset: int, data: bytes) -> None:
+        self._hasher.update(data)
+
+    def discard(self, offset: int, length: int) -> None:
+        while length > 0:
+            chunk = min(length, len(self.ZERO_BUFFER))
+            self._hasher.update(memoryview(self.ZERO_BUFFER)[:chunk])
+            length -= chunk
+
+    def close(self) -> None:
+        self.filename.write_text(f"{self._hasher.hexdigest()}  {self.filename.stem}\n", encoding="utf-8")
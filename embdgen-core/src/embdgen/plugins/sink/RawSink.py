@@ -0,0 +1,43 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+from typing import BinaryIO, Optional
+
+from embdgen.core.sink.BaseSink import BaseSink
+from embdgen.core.utils.image import CacheDropper, zero_range
+
+
+class RawSink(BaseSink):
+    """Raw image file
+
+    The file is created sparse, i.e. discarded ranges do not allocate any space.
+    If ``CacheDropper.enabled`` is set, the written data is periodically
+    written back and dropped from the page cache.
+    """
+    SINK_TYPE = "raw"
+    SEQUENTIAL = False
+    STREAMABLE = False
+
+    _file: Optional[BinaryIO] = None
+    _unflushed: int = 0
+
+    def open(self, size: int) -> None:
+        super().open(size)
+        self._file = self.filename.open("wb")
+        self._file.truncate(size)
+        self._unflushed = 0
+
+    def write(self, offset: int, data: bytes) -> None:
+        os.pwrite(self._file.fileno(), data, offset) # type: ignore[union-attr]
+        self._unflushed += len(data)
+        if self._unflushed >= CacheDropper.INTERVAL:
+            self._unflushed = 0
+            CacheDropper.drop(self._file.fileno(), written=True) # type: ignore[union-attr]
+
+    def discard(self, offset: int, length: int) -> None:
+        zero_range(self._file, offset, length) # type: ignore[arg-type]
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,102 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import struct
+from typing import BinaryIO, List, Optional
+
+from embdgen.core.sink.BlockSink import BlockSink
+
+
+class SparseSink(BlockSink):
+    """Android sparse image
+
+    Blocks without data are stored as "don't care" chunks,
+    so the sparse image only contains the mapped blocks.
+    The image can be flashed e.g. with fastboot or converted back to a raw image with simg2img.
+
+    The number of chunks depends on the data, so the header is completed, when the sink
+    is closed. Therefore the output must be seekable (i.e. not a pipe or stdout).
+    """
+    SINK_TYPE = "sparse"
+    STREAMABLE = False
+
+    MAGIC = 0xED26FF3A
+    FILE_HEADER = struct.Struct("<IHHHHIIII")
+    CHUNK_HEADER = struct.Struct("<HHII")
+    CHUNK_TYPE_RAW = 0xCAC1
+    CHUNK_TYPE_DONT_CARE = 0xCAC3
+    MAX_RAW_CHUNK = 16 * 1024 * 1024
+
+    _file: Optional[BinaryIO] = None
+    _raw_data: List[bytes]
+    _raw_length: int
+    _skip_blocks: int
+    _total_blocks: int
+    _total_chunks: int
+
+    def open(self, size: int) -> None:
+        super().open(size)
+        self._raw_data = []
+        self._raw_length = 0
+        self._skip_blocks = 0
+        self._total_blocks = 0
+        self._total_chunks = 0
+        self._file = self.filename.open("wb")
+        self._write_header()
+
+    def _write_header(self) -> None:
+        self._file.seek(0) # type: ignore[union-attr]
+        self._file.write(self.FILE_HEADER.pack( # type: ignore[union-attr]
+            self.MAGIC,
+            1, 0, # Version
+            self.FILE_HEADER.size,
+            self.CHUNK_HEADER.size,
+            self.BLOCK_SIZE,
+            self._total_blocks,
+            self._total_chunks,
+            0 # No checksum
+        ))
+
+    def _write_chunk(self, chunk_type: int, blocks: int, data: List[bytes], data_length: int) -> None:
+        self._file.write(self.CHUNK_HEADER.pack( # type: ignore[union-attr]
+            chunk_type, 0, blocks, self.CHUNK_HEADER.size + data_length
+        ))
+        for d in data:
+            self._file.write(d) # type: ignore[union-attr]
+        self._total_blocks += blocks
+        self._total_chunks += 1
+
+    def _flush_raw(self) -> None:
+        if self._raw_length:
+            if self._raw_length % self.BLOCK_SIZE:
+                # Only the last block of the image can be shorter
+                padding = self.BLOCK_SIZE - self._raw_length % self.BLOCK_SIZE
+                self._raw_data.append(bytes(padding))
+                self._raw_length += padding
+            self._write_chunk(self.CHUNK_TYPE_RAW, self._raw_length // self.BLOCK_SIZE,
+                              self._raw_data, self._raw_length)
+            self._raw_data = []
+            self._raw_length = 0
+
+    def _flush_skip(self) -> None:
+        if self._skip_blocks:
+            self._write_chunk(self.CHUNK_TYPE_DONT_CARE, self._skip_blocks, [], 0)
+            self._skip_blocks = 0
+
+    def mapped_blocks(self, data: bytes) -> None:
+        self._flush_skip()
+        self._raw_data.append(data)
+        self._raw_length += len(data)
+        if self._raw_length >= self.MAX_RAW_CHUNK:
+            self._flush_raw()
+
+    def unmapped_blocks(self, count: int) -> None:
+        self._flush_raw()
+        self._skip_blocks += count
+
+    def close(self) -> None:
+        super().close()
+        self._flush_raw()
+        self._flush_skip()
+        self._write_header()
+        self._file.close() # type: ignore[union-attr]
+        self._file = None
@@ -0,0 +1,53 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import sys
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+from embdgen.core.sink.BaseSink import BaseSink
+
+
+class StreamSink(BaseSink):
+    """Raw image as a stream
+
+    The image is written strictly sequentially and without seeking,
+    so the output can be a pipe (e.g. to ``ssh``, ``zstd`` or a flashing tool).
+    Discarded ranges are written as zeros.
+    If the filename is ``-``, the image is written to stdout.
+    """
+    SINK_TYPE = "stream"
+
+    ZERO_BUFFER = bytes(1024 * 1024)
+
+    _stream: Optional[BinaryIO]
+    _owned: bool
+
+    def __init__(self, filename: Path, stream: Optional[BinaryIO] = None) -> None:
+        super().__init__(filename)
+        self._stream = stream
+        self._owned = False
+
+    def open(self, size: int) -> None:
+        super().open(size)
+        if self._stream is None:
+            if str(self.filename) == "-":
+                self._stream = sys.stdout.buffer
+            else:
+                self._stream = self.filename.open("wb")
+                self._owned = True
+
+    def write(self, offset: int, data: bytes) -> None:
+        self._stream.write(data) # type: ignore[union-attr]
+
+    def discard(self, offset: int, length: int) -> None:
+        while length > 0:
+            chunk = min(length, len(self.ZERO_BUFFER))
+            self._stream.write(memoryview(self.ZERO_BUFFER)[:chunk]) # type: ignore[union-attr]
+            length -= chunk
+
+    def close(self) -> None:
+        if self._stream:
+            self._stream.flush()
+            if self._owned:
+                self._stream.close()
+            self._stream = None
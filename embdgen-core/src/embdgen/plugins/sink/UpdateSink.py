@@ -0,0 +1,141 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import os
+from pathlib import Path
+from typing import BinaryIO, Deque, List, Optional, Tuple
+
+from embdgen.core.sink.BaseSink import BaseSink
+from embdgen.core.utils.image import data_ranges, zero_range
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateSink(BaseSink):
+    """Update an existing image or device in place
+
+    The existing content of the target is read in large batches and compared block by block
+    with the new image. Only blocks, that differ, are written.
+    Ranges without data are only zeroed (i.e. discarded), if they are not already zero.
+    The batches are compared in parallel by a pool of threads.
+
+    If the target does not exist, it is created.
+    """
+    SINK_TYPE = "update"
+    STREAMABLE = False
+
+    BLOCK_SIZE = 4096
+    BATCH_SIZE = 4 * 1024 * 1024
+    ZERO_BATCH = bytes(BATCH_SIZE)
+
+    jobs: int
+    """Number of threads used for the comparison"""
+
+    written: int
+    """Number of bytes, that were written or zeroed"""
+
+    _file: Optional[BinaryIO] = None
+    _is_device: bool = False
+    _executor: ThreadPoolExecutor
+    _pending: "Deque[Future[int]]"
+    _batch: bytearray
+    _batch_offset: int
+
+    def __init__(self, filename: Path, jobs: Optional[int] = None) -> None:
+        super().__init__(filename)
+        self.jobs = jobs or os.cpu_count() or 1
+        self.written = 0
+
+    def open(self, size: int) -> None:
+        super().open(size)
+        self._file = os.fdopen(os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o666), "rb+")
+        self._is_device = self.filename.is_block_device()
+        if self._is_device:
+            device_size = os.lseek(self._file.fileno(), 0, os.SEEK_END)
+            if device_size < size:
+                raise Exception(f"The image ({size} B) does not fit on {self.filename} ({device_size} B)")
+        else:
+            self._file.truncate(size)
+        self.written = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self._pending = deque()
+        self._batch = bytearray()
+        self._batch_offset = 0
+
+    def estimate_memory(self) -> int:
+        # Up to 2 * jobs batches are pending, each one is compared with the existing data
+        return (2 * self.jobs + 1) * 2 * self.BATCH_SIZE
+
+    def _submit(self, offset: int, data: Optional[bytes], length: int) -> None:
+        self._pending.append(self._executor.submit(self._update, offset, data, length))
+        while len(self._pending) > 2 * self.jobs:
+            self.written += self._pending.popleft().result()
+
+    def _submit_batch(self) -> None:
+        if self._batch:
+            self._submit(self._batch_offset, bytes(self._batch), len(self._batch))
+            self._batch_offset += len(self._batch)
+            self._batch = bytearray()
+
+    def _update(self, offset: int, data: Optional[bytes], length: int) -> int:
+        """
+        Compare a range of the target with data (or zeros, if data is None) and update it.
+        Returns the number of bytes written.
+        """
+        fd = self._file.fileno() # type: ignore[union-attr]
+        if data is None and not self._is_device and not any(True for _ in data_ranges(fd, offset, offset + length)):
+            return 0 # Already a hole
+        old = os.pread(fd, length, offset)
+        new = data if data is not None else self.ZERO_BATCH[:length]
+        if old == new:
+            return 0
+
+        runs: List[Tuple[int, int]] = []
+        for start in range(0, length, self.BLOCK_SIZE):
+            end = min(start + self.BLOCK_SIZE, length)
+            if old[start:end] == new[start:end]:
+                continue
+            if runs and runs[-1][1] == start:
+                runs[-1] = (runs[-1][0], end)
+            else:
+                runs.append((start, end))
+
+        for start, end in runs:
+            if data is None:
+                zero_range(self._file, offset + start, end - start) # type: ignore[arg-type]
+            else:
+                os.pwrite(fd, new[start:end], offset + start)
+        return sum(end - start for start, end in runs)
+
+    def write(self, offset: int, data: bytes) -> None:
+        self._batch += data
+        while len(self._batch) >= self.BATCH_SIZE:
+            self._submit(self._batch_offset, bytes(self._batch[:self.BATCH_SIZE]), self.BATCH_SIZE)
+            del self._batch[:self.BATCH_SIZE]
+            self._batch_offset += self.BATCH_SIZE
+
+    def discard(self, offset: int, length: int) -> None:
+        if length < self.BLOCK_SIZE:
+            self.write(offset, bytes(length))
+            return
+        self._submit_batch()
+        for batch_offset in range(offset, offset + length, self.BATCH_SIZE):
+            batch_length = min(self.BATCH_SIZE, offset + length - batch_offset)
+            self._submit(batch_offset, None, batch_length)
+        self._batch_offset = offset + length
+
+    def close(self) -> None:
+        if not self._file:
+            return
+        try:
+            self._submit_batch()
+            while self._pending:
+                self.written += self._pending.popleft().result()
+        finally:
+            self._executor.shutdown()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        logger.info("Updated %d of %d bytes in %s", self.written, self.size, self.filename)
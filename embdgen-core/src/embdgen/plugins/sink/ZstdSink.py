@@ -0,0 +1,51 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import subprocess
+from typing import IO, Optional
+
+from embdgen.core.sink.BaseSink import BaseSink
+
+
+class ZstdSink(BaseSink):
+    """Zstandard compressed raw image
+
+    The image is compressed by the ``zstd`` command line tool using all available cores.
+    """
+    SINK_TYPE = "zstd"
+
+    ZERO_BUFFER = bytes(1024 * 1024)
+    MEMORY_PER_THREAD = 16 * 1024 * 1024
+    """Approximate memory used by every compression thread of zstd at the default level"""
+
+    _process: Optional[subprocess.Popen] = None
+
+    def open(self, size: int) -> None:
+        super().open(size)
+        self._process = subprocess.Popen([ # pylint: disable=consider-using-with
+            "zstd", "-q", "-f", "-T0",
+            "-o", self.filename
+        ], stdin=subprocess.PIPE)
+
+    @property
+    def _stdin(self) -> IO[bytes]:
+        return self._process.stdin # type: ignore[union-attr,return-value]
+
+    def estimate_memory(self) -> int:
+        return (os.cpu_count() or 1) * self.MEMORY_PER_THREAD
+
+    def write(self, offset: int, data: bytes) -> None:
+        self._stdin.write(data)
+
+    def discard(self, offset: int, length: int) -> None:
+        while length > 0:
+            chunk = min(length, len(self.ZERO_BUFFER))
+            self._stdin.write(memoryview(self.ZERO_BUFFER)[:chunk])
+            length -= chunk
+
+    def close(self) -> None:
+        if self._process:
+            self._stdin.close()
+            if self._process.wait() != 0:
+                raise Exception(f"zstd failed with exit code {self._process.returncode}")
+            self._process = None
@@ -1,5 +1,7 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
+import logging
+import os
 from pathlib import Path
 import pytest
 from pytest_mock import MockerFixture
@@ -7,6 +9,7 @@ from embdgen.core.cli import cli
 
 from embdgen.core.config.Factory import Factory
 from embdgen.core.config.BaseConfig import BaseConfig
+from embdgen.core.utils.preflight import Preflight
 from embdgen.plugins.label.MBR import MBR
 
 Factory() # Instantiate to load class variables
@@ -89,6 +92,52 @@ def test_complete(mocker: MockerFixture, capsys: pytest.CaptureFixture[str], tmp
 
     capsys.readouterr() # suppress output
 
+def test_ram_budget(mocker: MockerFixture, caplog: pytest.LogCaptureFixture, tmp_path: Path):
+    output_file = tmp_path / "image"
+    mocker.patch.dict(Factory.class_map(), {'test': TestConfig}, clear=True)
+
+    cli([
+        "--output", str(output_file),
+        "--ram-budget", "1MB",
+        "--verbose",
+        str(Path(__file__).parent / "data/config.cfg")
+    ])
+
+    assert output_file.exists()
+    assert "Placing temporary files up to 1048576 B" in caplog.text
+
+def test_ram_budget_invalid(capsys: pytest.CaptureFixture[str]):
+    with pytest.raises(SystemExit):
+        cli(["--ram-budget", "foo", str(Path(__file__).parent / "data/config.cfg")])
+    assert "Invalid string: foo" in capsys.readouterr().err
+
+def test_preflight(mocker: MockerFixture, capsys: pytest.CaptureFixture[str], tmp_path: Path):
+    output_file = tmp_path / "image"
+    mocker.patch.dict(Factory.class_map(), {'test': TestConfig}, clear=True)
+    mocker.patch.object(Preflight, "_check_space", lambda self, _outputs: self.problems.append("Not enough space"))
+
+    with pytest.raises(SystemExit, match="FATAL: Not enough space"):
+        cli(["--output", str(output_file), str(Path(__file__).parent / "data/config.cfg")])
+    assert not output_file.exists()
+    assert "Estimated resources:" in capsys.readouterr().out
+
+    cli(["--output", str(output_file), "--no-preflight", str(Path(__file__).parent / "data/config.cfg")])
+    assert output_file.exists()
+    assert "Estimated resources:" not in capsys.readouterr().out
+
+def test_sync_cleanup(mocker: MockerFixture, capsys: pytest.CaptureFixture[str], tmp_path: Path):
+    mocker.patch.dict(Factory.class_map(), {'test': TestConfig}, clear=True)
+
+    cli([
+        "--output", str(tmp_path / "image"),
+        "--tempdir", str(tmp_path / "tmp"),
+        "--sync-cleanup",
+        str(Path(__file__).parent / "data/config.cfg")
+    ])
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["image"]
+    capsys.readouterr() # suppress output
+
 def test_complete_explit_format(mocker: MockerFixture, capsys: pytest.CaptureFixture[str], tmp_path: Path):
     mocker.patch.dict(Factory.class_map(), {'test': TestConfig, 'test2': TestConfig2}, clear=True)
 
@@ -108,3 +157,137 @@ def test_complete_explit_format(mocker: MockerFixture, capsys: pytest.CaptureFix
     assert not tmp_dir.exists()
 
     capsys.readouterr() # suppress output
+
+def test_delta(mocker: MockerFixture, capsys: pytest.CaptureFixture[str], tmp_path: Path):
+    mocker.patch.dict(Factory.class_map(), {'test': TestConfig}, clear=True)
+
+    base_file = tmp_path / "base"
+    base_file.write_bytes(b"\1" * 1024)
+    output_file = tmp_path / "image"
+    tmp_dir = tmp_path / "tmp"
+
+    cli([
+        "--output", str(output_file),
+        "--tempdir", str(tmp_dir),
+        "--delta-from", str(base_file),
+        str(Path(__file__).parent / "data/config.cfg")
+    ])
+
+    assert (tmp_path / "image.delta").exists()
+    assert (tmp_path / "image.fingerprints").exists()
+
+    capsys.readouterr() # suppress output
+
+def test_write_fingerprints(mocker: MockerFixture, capsys: pytest.CaptureFixture[str], tmp_path: Path):
+    mocker.patch.dict(Factory.class_map(), {'test': TestConfig}, clear=True)
+
+    output_file = tmp_path / "image"
+    cli([
+        "--output", str(output_file),
+        "--tempdir", str(tmp_path / "tmp"),
+        "--write-fingerprints",
+        str(Path(__file__).parent / "data/config.cfg")
+    ])
+
+    assert (tmp_path / "image.fingerprints").exists()
+    assert not (tmp_path / "image.delta").exists()
+
+    capsys.readouterr() # suppress output
+
+def test_stream_stdout(mocker: MockerFixture, capfdbinary: pytest.CaptureFixture[bytes], tmp_path: Path):
+    mocker.patch.dict(Factory.class_map(), {'test': TestConfig}, clear=True)
+
+    cli([
+        "--output", "-",
+        "--tempdir", str(tmp_path / "tmp"),
+        str(Path(__file__).parent / "data/config.cfg")
+    ])
+
+    captured = capfdbinary.readouterr()
+    assert len(captured.out) == 512
+    assert captured.out[510:] == b"\x55\xaa"
+    assert b"Writing image to stdout" in captured.err
+
+def test_stream_stdout_delta(mocker: MockerFixture, tmp_path: Path):
+    mocker.patch.dict(Factory.class_map(), {'test': TestConfig}, clear=True)
+
+    with pytest.raises(SystemExit, match="cannot be combined"):
+        cli([
+            "--output", "-",
+            "--delta-from", str(Path(__file__).parent / "data/config.cfg"),
+            str(Path(__file__).parent / "data/config.cfg")
+        ])
+
+def test_update_in_place(mocker: MockerFixture, caplog: pytest.LogCaptureFixture, tmp_path: Path):
+    mocker.patch.dict(Factory.class_map(), {'test': TestConfig}, clear=True)
+    caplog.set_level(logging.INFO, logger="embdgen")
+
+    output_file = tmp_path / "image"
+    output_file.write_bytes(b"\1" * 1024)
+
+    cli([
+        "--output", str(output_file),
+        "--tempdir", str(tmp_path / "tmp"),
+        "--update-in-place",
+        str(Path(__file__).parent / "data/config.cfg")
+    ])
+
+    data = output_file.read_bytes()
+    assert len(data) == 512
+    assert data[510:] == b"\x55\xaa"
+    assert "Updated 512 of 512 bytes" in caplog.text
+
+def test_multiple_outputs(mocker: MockerFixture, capsys: pytest.CaptureFixture[str], tmp_path: Path):
+    mocker.patch.dict(Factory.class_map(), {'test': TestConfig}, clear=True)
+
+    outputs = [tmp_path / f"image{i}" for i in range(3)]
+    invalid_output = tmp_path / "missing" / "image"
+
+    with pytest.raises(Exception, match=f"Writing to RawSink\\({invalid_output}\\) failed"):
+        cli([
+            "--output", str(outputs[0]),
+            "--output", str(invalid_output),
+            "--output", str(outputs[1]),
+            "--output", str(outputs[2]),
+            "--tempdir", str(tmp_path / "tmp"),
+            str(Path(__file__).parent / "data/config.cfg")
+        ])
+
+    # The failure of one output does not affect the others
+    for output in outputs:
+        assert output.read_bytes()[510:] == b"\x55\xaa"
+
+    capsys.readouterr() # suppress output
+
+@pytest.mark.parametrize("target", ["-", "fifo"])
+def test_sink_not_seekable(mocker: MockerFixture, tmp_path: Path, target: str):
+    mocker.patch.dict(Factory.class_map(), {'test': TestConfig}, clear=True)
+    if target == "fifo":
+        target = str(tmp_path / "fifo")
+        os.mkfifo(target)
+
+    with pytest.raises(SystemExit, match=f"The sparse sink cannot write to {target}, it requires a seekable file"):
+        cli([
+            "--output", str(tmp_path / "image"),
+            "--sink", f"sparse:{target}",
+            str(Path(__file__).parent / "data/config.cfg")
+        ])
+
+def test_output_sinks_created_once(mocker: MockerFixture, capsys: pytest.CaptureFixture[str], tmp_path: Path):
+    mocker.patch.dict(Factory.class_map(), {'test': TestConfig}, clear=True)
+    output_sink = mocker.patch.object(MBR, "output_sink", side_effect=MBR.output_sink)
+
+    outputs = [tmp_path / f"image{i}" for i in range(2)]
+    cli([
+        "--output", str(outputs[0]),
+        "--output", str(outputs[1]),
+        "--tempdir", str(tmp_path / "tmp"),
+        str(Path(__file__).parent / "data/config.cfg")
+    ])
+
+    # The sinks checked by the preflight are used for writing
+    assert [call.args[0] for call in output_sink.call_args_list] == outputs
+    for output in outputs:
+        assert output.read_bytes()[510:] == b"\x55\xaa"
+
+    capsys.readouterr() # suppress output
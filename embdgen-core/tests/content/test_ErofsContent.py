@@ -0,0 +1,77 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from pathlib import Path
+import subprocess
+
+import pytest
+
+from embdgen.plugins.content.ErofsContent import ErofsContent
+from embdgen.plugins.content.FilesContent import FilesContent
+from embdgen.plugins.content.VerityContent import VerityContent
+from embdgen.core.utils.image import BuildLocation
+from embdgen.core.utils.SizeType import SizeType
+
+
+def test_from_files(tmp_path: Path):
+    BuildLocation().set_path(tmp_path)
+    image = tmp_path / "image"
+    test_dir = tmp_path / "test_dir"
+    test_dir.mkdir()
+    (test_dir / "foobar").write_text("Hello world" * 1000)
+    (test_dir / "foobar.slnk").symlink_to("foobar")
+    (test_dir / "dir").mkdir()
+    (test_dir / "dir" / "a").write_text("Fooo")
+
+    obj = ErofsContent()
+    obj.content = FilesContent()
+    obj.content.files = [test_dir / "*"]
+    obj.compression = "lz4hc,12"
+    obj.prepare()
+
+    assert obj.size.bytes % ErofsContent.ALIGNMENT == 0
+    with image.open("wb") as out_file:
+        obj.write(out_file)
+    assert image.stat().st_size == obj.size.bytes
+
+    extract_dir = tmp_path / "extract"
+    subprocess.run(["fsck.erofs", f"--extract={extract_dir}", image], check=True)
+    assert (extract_dir / "foobar").read_text() == "Hello world" * 1000
+    assert (extract_dir / "foobar.slnk").readlink() == Path("foobar")
+    assert (extract_dir / "dir" / "a").read_text() == "Fooo"
+
+
+def test_verity(tmp_path: Path):
+    BuildLocation().set_path(tmp_path)
+    (tmp_path / "foobar").write_bytes(b"1" * 10000)
+
+    erofs = ErofsContent()
+    erofs.content = FilesContent()
+    erofs.content.files = [tmp_path / "foobar"]
+
+    obj = VerityContent()
+    obj.metadata = tmp_path / "metadata.txt"
+    obj.content = erofs
+    obj.prepare()
+    assert obj.size.bytes > erofs.size.bytes
+
+    with (tmp_path / "image").open("wb") as out_file:
+        obj.write(out_file)
+    assert "Root hash:" in obj.metadata.read_text()
+
+
+def test_mkfs_command(tmp_path: Path):
+    obj = ErofsContent()
+    obj.threads = 4
+    obj.compression = "zstd"
+    obj.extended_options = ["dedupe", "fragments"]
+    assert obj._mkfs_command(tmp_path / "dir", tmp_path / "image") == [
+        "mkfs.erofs", "--quiet", "--workers=4", "-zzstd", "-Ededupe,fragments", tmp_path / "image", tmp_path / "dir"
+    ]
+
+
+def test_invalid_options():
+    obj = ErofsContent()
+    with pytest.raises(Exception, match="Invalid compression 'gzip'"):
+        obj.compression = "gzip"
+    with pytest.raises(Exception, match="Invalid erofs extended option 'a b'"):
+        obj.extended_options = ["a b"]
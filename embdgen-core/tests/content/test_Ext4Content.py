@@ -8,9 +8,11 @@ from typing import List
 import re
 import stat
 import pytest
+from pytest_mock import MockerFixture
 
 from ..test_utils import SimpleCommandParser
 
+from embdgen.plugins.content import Ext4Content as ext4_content_module
 from embdgen.plugins.content.Ext4Content import Ext4Content
 from embdgen.plugins.content.FilesContent import FilesContent
 from embdgen.plugins.content.ArchiveContent import ArchiveContent
@@ -131,12 +133,24 @@ class Tune2Fs(SimpleCommandParser):
     ATTRIBUTE_MAP = {
         "Block count": ("block_count", int),
         "Block size":  ("block_size", int),
-        "Filesystem magic number": ("magic", lambda x: int(x, 16))
+        "Filesystem magic number": ("magic", lambda x: int(x, 16)),
+        "Filesystem features": ("features", str.split),
+        "Inode count": ("inode_count", int),
+        "Reserved block count": ("reserved_block_count", int),
+        "Filesystem volume name": ("label", str),
+        "Filesystem UUID": ("uuid", str),
+        "Free blocks": ("free_blocks", int)
     }
 
     block_count: int = -1
     block_size: int = -1
     magic: int = -1
+    features: List[str] = []
+    inode_count: int = -1
+    reserved_block_count: int = -1
+    label: str = ""
+    uuid: str = ""
+    free_blocks: int = -1
 
     def __init__(self, image: Path) -> None:
         super().__init__(["tune2fs", "-l", image])
@@ -163,9 +177,6 @@ def test_from_files(tmp_path: Path):
     obj.content = FilesContent()
     obj.content.files = [test_dir / "*"]
 
-    with pytest.raises(Exception, match="Ext4 content requires a fixed size at the moment"):
-        obj.prepare()
-
     obj.size = SizeType.parse("10MB")
     obj.prepare()
 
@@ -283,6 +294,30 @@ def test_from_archive_fakeroot(tmp_path: Path):
     assert link_stat.is_lnk
     assert link_stat.link_to == "/var/run"
 
+def test_release(tmp_path: Path) -> None:
+    BuildLocation().set_path(tmp_path)
+    archive = tmp_path / "archive.tar"
+    test_dir = tmp_path / "test_dir"
+    test_dir.mkdir()
+    (test_dir / "foo").write_text("foo")
+    subprocess.run(["tar", "-cf", archive, "."], cwd=test_dir, check=True)
+
+    obj = Ext4Content()
+    obj.content = ArchiveContent()
+    obj.content.archive = archive
+    obj.size = SizeType.parse("10MB")
+    obj.prepare()
+    obj.acquire()
+
+    obj.materialize()
+    # The unpacked archive is removed, as soon as the filesystem was created
+    assert obj.content._tmpDir is None
+    result_file = obj.result_file
+    assert result_file.exists()
+
+    obj.release()
+    assert not result_file.exists()
+
 def test_empty_ext4(tmp_path: Path) -> None:
     BuildLocation().set_path(tmp_path)
     image = tmp_path / "image"
@@ -298,3 +333,215 @@ def test_empty_ext4(tmp_path: Path) -> None:
     assert tune2fs.ok
     assert tune2fs.size == SizeType.parse("100 MB").bytes
     assert tune2fs.magic == 0xEF53
+
+def test_shrink_to_fit(tmp_path: Path) -> None:
+    BuildLocation().set_path(tmp_path)
+    image = tmp_path / "image"
+    test_dir = tmp_path / "test_dir"
+    test_dir.mkdir()
+    (test_dir / "big").write_bytes(os.urandom(4 * 1024 * 1024))
+    (test_dir / "dir").mkdir()
+    for i in range(100):
+        (test_dir / "dir" / f"small{i}").write_text(str(i))
+
+    obj = Ext4Content()
+    obj.content = FilesContent()
+    obj.content.files = [test_dir / "*"]
+    obj.headroom = SizeType.parse("2 MB")
+    obj.prepare()
+
+    # The layout is based on the real size of the filesystem
+    assert SizeType.parse("6 MB").bytes < obj.size.bytes < SizeType.parse("12 MB").bytes
+    with image.open("wb") as f:
+        obj.write(f)
+    assert image.stat().st_size == obj.size.bytes
+
+    tune2fs = Tune2Fs(image)
+    assert tune2fs.size == obj.size.bytes
+    assert tune2fs.free_blocks * tune2fs.block_size >= SizeType.parse("2 MB").bytes
+    subprocess.run(["e2fsck", "-fn", image], check=True)
+    DebugFs(image).ls().assert_entry(["big", "dir"])
+    DebugFs(image).ls("dir").assert_entry(["small0", "small99"])
+
+
+def test_shrink_to_fit_empty(tmp_path: Path) -> None:
+    BuildLocation().set_path(tmp_path)
+    obj = Ext4Content()
+    obj.prepare()
+    assert obj.size.bytes < SizeType.parse("8 MB").bytes
+    assert Tune2Fs(obj.result_file).size == obj.size.bytes
+
+
+def test_mkfs_options(tmp_path: Path) -> None:
+    BuildLocation().set_path(tmp_path)
+    obj = Ext4Content()
+    obj.size = SizeType.parse("10 MB")
+    obj.features = ["^has_journal"]
+    obj.inode_count = 128
+    obj.block_size = SizeType(1024)
+    obj.reserved_percent = 0
+    obj.extended_options = ["nodiscard", "root_owner=1000:1000"]
+    obj.label = "rootfs"
+    obj.uuid = "6e4c8b43-41b8-4b2e-9a3a-6b7a3c4a1d2e"
+    obj.prepare()
+
+    image = tmp_path / "image"
+    with image.open("wb") as f:
+        obj.write(f)
+
+    tune2fs = Tune2Fs(image)
+    assert "has_journal" not in tune2fs.features
+    assert tune2fs.inode_count == 128
+    assert tune2fs.block_size == 1024
+    assert tune2fs.reserved_block_count == 0
+    assert tune2fs.label == "rootfs"
+    assert tune2fs.uuid == "6e4c8b43-41b8-4b2e-9a3a-6b7a3c4a1d2e"
+    assert DebugFs(image).stat("/").uid == 1000
+
+
+def test_mkfs_options_invalid() -> None:
+    obj = Ext4Content()
+    with pytest.raises(Exception, match="Invalid ext4 feature 'has journal'"):
+        obj.features = ["has journal"]
+    with pytest.raises(Exception, match="Invalid ext4 block size 512"):
+        obj.block_size = SizeType(512)
+    with pytest.raises(Exception, match="The reserved percentage must be between 0 and 50"):
+        obj.reserved_percent = 51
+    with pytest.raises(Exception, match="Invalid ext4 extended option 'a=b,c'"):
+        obj.extended_options = ["a=b,c"]
+    with pytest.raises(Exception, match="The ext4 label must not be longer than 16 bytes"):
+        obj.label = "a" * 17
+    with pytest.raises(Exception, match="Invalid ext4 UUID 'foo'"):
+        obj.uuid = "foo"
+
+    obj.size = SizeType.parse("10 MB")
+    obj.inode_count = 128
+    obj.inode_ratio = SizeType(4096)
+    with pytest.raises(Exception, match="Only one of inode_count and inode_ratio can be set"):
+        obj.prepare()
+
+
+def build_from_dir(directory: Path, image: Path, base: Path = None, size: str = "16 MB",
+                   max_update_percent: int = 50, compare_content: bool = False) -> Ext4Content:
+    obj = Ext4Content()
+    obj.content = FilesContent()
+    obj.content.files = [directory / "*"]
+    obj.size = SizeType.parse(size)
+    obj.base = base
+    obj.max_update_percent = max_update_percent
+    obj.compare_content = compare_content
+    obj.prepare()
+    with image.open("wb") as f:
+        obj.write(f)
+    return obj
+
+
+def mkfs_called(run) -> bool:
+    return any("mkfs.ext4" in call.args[0] for call in run.call_args_list)
+
+
+def test_update_base(tmp_path: Path, mocker: MockerFixture) -> None:
+    BuildLocation().set_path(tmp_path)
+    test_dir = tmp_path / "test_dir"
+    test_dir.mkdir()
+    (test_dir / "keep").write_bytes(os.urandom(1024 * 1024))
+    (test_dir / "change").write_text("old")
+    (test_dir / "remove").write_text("remove")
+    (test_dir / "dir").mkdir()
+    (test_dir / "dir" / "sub").mkdir()
+    (test_dir / "dir" / "sub" / "a").write_text("a")
+    (test_dir / "link").symlink_to("keep")
+    base = tmp_path / "base"
+    build_from_dir(test_dir, base)
+
+    (test_dir / "change").write_text("new content")
+    os.utime(test_dir / "change", (1000, 1000))
+    (test_dir / "remove").unlink()
+    (test_dir / "dir" / "sub" / "a").unlink()
+    (test_dir / "dir" / "sub").rmdir()
+    (test_dir / "dir" / "added").write_text("added")
+    (test_dir / "link").unlink()
+    (test_dir / "link").symlink_to("change")
+    (test_dir / "keep").chmod(0o600)
+
+    run = mocker.spy(subprocess, "run")
+    image = tmp_path / "image"
+    build_from_dir(test_dir, image, base, size="20 MB")
+    assert not mkfs_called(run), "The filesystem was created from scratch"
+
+    subprocess.run(["e2fsck", "-fn", image], check=True)
+    assert Tune2Fs(image).size == SizeType.parse("20 MB").bytes
+    dfs = DebugFs(image)
+    root_dir = dfs.ls()
+    assert sorted(x.name for x in root_dir) == ["change", "dir", "keep", "link", "lost+found"]
+    assert [x.name for x in dfs.ls("dir")] == ["added"]
+    assert dfs.stat("keep").mode == stat.S_IFREG | 0o600
+    assert dfs.stat("link").link_to == "change"
+    res = subprocess.run(["debugfs", "-R", "cat /change", image], stdout=subprocess.PIPE, check=True)
+    assert res.stdout == b"new content"
+    # Unchanged files are not rewritten
+    assert dfs.stat("keep").size == 1024 * 1024
+    res = subprocess.run(["debugfs", "-R", "stat /keep", image], stdout=subprocess.PIPE, check=True, encoding="utf8")
+    base_res = subprocess.run(["debugfs", "-R", "stat /keep", base], stdout=subprocess.PIPE, check=True, encoding="utf8")
+    assert re.search(r"EXTENTS:\n.*", res.stdout).group(0) == re.search(r"EXTENTS:\n.*", base_res.stdout).group(0)
+
+
+def test_update_base_fallback(tmp_path: Path, mocker: MockerFixture) -> None:
+    BuildLocation().set_path(tmp_path)
+    test_dir = tmp_path / "test_dir"
+    test_dir.mkdir()
+    (test_dir / "a").write_text("a")
+    base = tmp_path / "base"
+    build_from_dir(test_dir, base)
+    (test_dir / "a").write_text("b" * 100)
+
+    run = mocker.spy(subprocess, "run")
+    build_from_dir(test_dir, tmp_path / "image", base, max_update_percent=10)
+    assert mkfs_called(run), "The filesystem was updated"
+
+    run.reset_mock()
+    build_from_dir(test_dir, tmp_path / "image", base, size="8 MB")
+    assert mkfs_called(run), "The larger base filesystem was updated"
+
+
+def test_update_base_compare_content(tmp_path: Path, mocker: MockerFixture) -> None:
+    BuildLocation().set_path(tmp_path)
+    test_dir = tmp_path / "test_dir"
+    test_dir.mkdir()
+    (test_dir / "keep").write_bytes(os.urandom(1024 * 1024))
+    (test_dir / "clamped").write_text("old")
+    os.utime(test_dir / "clamped", (1000, 1000))
+    base = tmp_path / "base"
+    build_from_dir(test_dir, base)
+    # The modification time is clamped, e.g. to SOURCE_DATE_EPOCH
+    (test_dir / "clamped").write_text("new")
+    os.utime(test_dir / "clamped", (1000, 1000))
+
+    run = mocker.spy(subprocess, "run")
+    image = tmp_path / "image"
+    for compare_content, expected in [(False, b"old"), (True, b"new")]:
+        build_from_dir(test_dir, image, base, compare_content=compare_content)
+        assert not mkfs_called(run), "The filesystem was created from scratch"
+        res = subprocess.run(["debugfs", "-R", "cat /clamped", image], stdout=subprocess.PIPE, check=True)
+        assert res.stdout == expected
+
+
+def test_write_skips_free_blocks(tmp_path: Path, mocker: MockerFixture) -> None:
+    BuildLocation().set_path(tmp_path)
+    test_dir = tmp_path / "test_dir"
+    test_dir.mkdir()
+    (test_dir / "keep").write_text("keep")
+    (test_dir / "remove").write_bytes(b"REMOVED!" * 128 * 1024)
+    base = tmp_path / "base"
+    build_from_dir(test_dir, base)
+    (test_dir / "remove").unlink()
+
+    copy_used = mocker.spy(ext4_content_module, "copy_used")
+    image = tmp_path / "image"
+    obj = build_from_dir(test_dir, image, base)
+
+    assert copy_used.call_count == 1
+    # The blocks of the removed file are freed and deallocated in the result file as well
+    assert b"REMOVED!" not in obj.result_file.read_bytes()
+    assert b"REMOVED!" not in image.read_bytes()
+    subprocess.run(["e2fsck", "-fn", image], check=True)
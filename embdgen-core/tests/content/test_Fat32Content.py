@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 from pathlib import Path
+import re
 import subprocess
 
 import pytest
@@ -16,11 +17,15 @@ from embdgen.core.utils.SizeType import SizeType
 class MInfo(SimpleCommandParser):
     ATTRIBUTE_MAP =  {
         "sector size": ("sector_size", lambda x: int(x.split()[0])),
-        "big size": ("sectors", lambda x: int(x.split()[0]))
+        "big size": ("sectors", lambda x: int(x.split()[0])),
+        "cluster size": ("cluster_sectors", lambda x: int(x.split()[0])),
+        "disk type": ("disk_type", lambda x: x.strip('"').strip())
     }
 
     sectors: int = -1
     sector_size: int = -1
+    cluster_sectors: int = -1
+    disk_type: str = ""
 
     def __init__(self, image: Path) -> None:
         super().__init__(["minfo", "-i", image])
@@ -31,7 +36,8 @@ class MInfo(SimpleCommandParser):
 
 
 class TestFat32Content:
-    def test_files(self, tmp_path: Path):
+    @pytest.mark.parametrize("internal", [True, False])
+    def test_files(self, tmp_path: Path, internal: bool):
         BuildLocation().set_path(tmp_path)
 
         image = tmp_path / "image"
@@ -45,10 +51,7 @@ class TestFat32Content:
         obj = Fat32Content()
         obj.content = FilesContent()
         obj.content.files = test_files
-
-        with pytest.raises(Exception, match="Fat32 content requires a fixed size at the moment"):
-            obj.prepare()
-        assert obj.size.is_undefined
+        obj.use_internal_implementation = internal
 
         obj.size = SizeType.parse("10MB")
         obj.prepare()
@@ -79,3 +82,69 @@ class TestFat32Content:
         minfo = MInfo(image)
         assert minfo.ok, minfo.error
 
+
+    @pytest.mark.parametrize("internal", [True, False])
+    def test_auto_size(self, tmp_path: Path, internal: bool) -> None:
+        BuildLocation().set_path(tmp_path)
+        image = tmp_path / "image"
+        test_file = tmp_path / "A Long File Name.bin"
+        test_file.write_bytes(b"1" * 1024 * 1024)
+
+        obj = Fat32Content()
+        obj.content = FilesContent()
+        obj.content.files = [test_file]
+        obj.cluster_size = SizeType(2048)
+        obj.headroom = SizeType.parse("1 MB")
+        obj.use_internal_implementation = internal
+        obj.prepare()
+
+        assert not obj.size.is_undefined
+        with image.open("wb") as out_file:
+            obj.write(out_file)
+        assert image.stat().st_size == obj.size.bytes
+
+        minfo = MInfo(image)
+        assert minfo.ok, minfo.error
+        assert minfo.size == obj.size.bytes
+        assert minfo.cluster_sectors * minfo.sector_size == 2048
+        assert minfo.disk_type == "FAT16"
+
+        res = subprocess.run(["mdir", "-i", image, "-b"], stdout=subprocess.PIPE, check=True, encoding="ascii")
+        assert res.stdout.splitlines() == ["::/A Long File Name.bin"]
+
+    def test_too_small(self, tmp_path: Path) -> None:
+        BuildLocation().set_path(tmp_path)
+        test_file = tmp_path / "test_file"
+        test_file.write_bytes(b"1" * 2 * 1024 * 1024)
+
+        obj = Fat32Content()
+        obj.content = FilesContent()
+        obj.content.files = [test_file]
+        obj.size = SizeType.parse("1 MB")
+        obj.prepare()
+
+        with pytest.raises(Exception, match=re.escape("The files (2097152 B) do not fit into the fat filesystem (1048576 B)")):
+            obj.materialize()
+
+    def test_too_small_clusters(self, tmp_path: Path) -> None:
+        BuildLocation().set_path(tmp_path)
+        files = []
+        for i in range(300):
+            files.append(tmp_path / f"F{i}")
+            files[-1].write_bytes(b"1" * 100)
+
+        obj = Fat32Content()
+        obj.content = FilesContent()
+        obj.content.files = files
+        obj.use_internal_implementation = True
+        obj.size = SizeType.parse("1 MB")
+        obj.prepare()
+
+        # The files fit into 512 B clusters, but the writer uses 4096 B clusters by default
+        with pytest.raises(Exception, match=re.escape("The files (1228800 B) do not fit into the fat filesystem (1048576 B)")):
+            obj.materialize()
+
+    def test_invalid_cluster_size(self) -> None:
+        obj = Fat32Content()
+        with pytest.raises(Exception, match="Invalid FAT cluster size 1536"):
+            obj.cluster_size = SizeType(1536)
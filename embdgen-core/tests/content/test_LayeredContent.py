@@ -0,0 +1,87 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import stat
+import subprocess
+from pathlib import Path
+
+from embdgen.plugins.content.ArchiveContent import ArchiveContent
+from embdgen.plugins.content.FilesContent import FilesContent
+from embdgen.plugins.content.LayeredContent import LayeredContent
+from embdgen.core.utils.image import BuildLocation
+from embdgen.core.utils.FakeRoot import FakeRoot
+
+
+def create_layers(tmp_path: Path) -> LayeredContent:
+    lower = tmp_path / "lower"
+    (lower / "etc").mkdir(parents=True)
+    (lower / "etc" / "a").write_text("lower")
+    (lower / "etc" / "b").write_text("lower")
+    (lower / "var" / "x").mkdir(parents=True)
+    (lower / "var" / "x" / "y").write_text("lower")
+    (lower / "opt").mkdir()
+    (lower / "opt" / "keep").write_text("lower")
+
+    upper = tmp_path / "upper"
+    (upper / "etc").mkdir(parents=True)
+    (upper / "etc" / "a").write_text("upper")
+    (upper / "etc" / ".wh.b").touch()
+    (upper / "var").mkdir()
+    (upper / "var" / ".wh..wh..opq").touch()
+    (upper / "var" / "new").write_text("upper")
+    fr = FakeRoot(tmp_path / "upper.save")
+    fr.run(["chown", "123:456", upper / "etc" / "a"])
+    fr.run(["mknod", upper / "node", "c", str(0x12), str(0x34)])
+    fr.run(["tar", "-cf", tmp_path / "upper.tar", "."], cwd=upper)
+
+    lower_layer = FilesContent()
+    lower_layer.files = [lower / "*"]
+    upper_layer = ArchiveContent()
+    upper_layer.archive = tmp_path / "upper.tar"
+
+    obj = LayeredContent()
+    obj.layers = [lower_layer, upper_layer]
+    return obj
+
+
+def test_stage(tmp_path: Path):
+    BuildLocation().set_path(tmp_path)
+    obj = create_layers(tmp_path)
+    obj.acquire()
+    obj.prepare()
+    obj.materialize()
+
+    staged = tmp_path / "staged"
+    staged.mkdir()
+    fr = obj.stage(staged)
+    tree = fr.stat_tree(staged)
+
+    assert sorted(tree) == ["", "etc", "etc/a", "node", "opt", "opt/keep", "var", "var/new"]
+    assert (staged / "etc" / "a").read_text() == "upper"
+    assert (staged / "opt" / "keep").read_text() == "lower"
+    assert (staged / "var" / "new").read_text() == "upper"
+
+    # The ownership recorded in the archive is preserved
+    assert tree["etc/a"][1:3] == [123, 456]
+    assert tree["opt/keep"][1:3] == [os.getuid(), os.getgid()]
+    assert stat.S_ISCHR(tree["node"][0])
+    assert (os.major(tree["node"][5]), os.minor(tree["node"][5])) == (0x12, 0x34)
+
+    obj.release()
+    assert not obj.layers[1].files
+
+
+def test_files(tmp_path: Path):
+    BuildLocation().set_path(tmp_path)
+    obj = create_layers(tmp_path)
+    obj.acquire()
+    obj.prepare()
+    obj.materialize()
+
+    assert sorted(file.name for file in obj.files) == ["etc", "node", "opt", "var"]
+    merged = obj.files[0].parent
+    res = obj.fakeroot.run(["stat", "-c", "%u:%g", merged / "etc" / "a"], stdout=subprocess.PIPE, encoding="utf8")
+    assert res.stdout.strip() == "123:456"
+
+    obj.release()
+    assert not merged.exists()
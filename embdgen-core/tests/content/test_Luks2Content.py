@@ -0,0 +1,203 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import base64
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Dict, Tuple
+
+import pytest
+from pytest_mock import MockerFixture
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.kdf.argon2 import Argon2id
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+from embdgen.core.utils import luks2
+from embdgen.core.utils.image import BuildLocation
+from embdgen.core.utils.SizeType import SizeType
+from embdgen.plugins.content.Luks2Content import Luks2Content
+from embdgen.plugins.content.RawContent import RawContent
+
+
+def decrypt_sectors(key: bytes, data: bytes, first_sector: int, sector_size: int) -> bytes:
+    out = []
+    for offset in range(0, len(data), sector_size):
+        tweak = (first_sector + offset // sector_size).to_bytes(16, "little")
+        out.append(Cipher(algorithms.AES(key), modes.XTS(tweak)).decryptor().update(data[offset:offset + sector_size]))
+    return b"".join(out)
+
+
+def unlock(image: Path, passphrase: bytes) -> Tuple[Dict, bytes]:
+    """Check the headers and get the metadata and the volume key"""
+    data = image.read_bytes()[:luks2.DATA_OFFSET]
+    json_areas = []
+    for offset, magic in [(0, luks2.MAGIC), (luks2.HDR_SIZE, luks2.MAGIC_SECONDARY)]:
+        header = data[offset:offset + luks2.HDR_SIZE]
+        assert header[:6] == magic
+        assert int.from_bytes(header[6:8], "big") == 2
+        assert int.from_bytes(header[8:16], "big") == luks2.HDR_SIZE
+        assert int.from_bytes(header[256:264], "big") == offset
+        assert header[72:80] == b"sha256\0\0"
+        assert hashlib.sha256(header[:448] + bytes(64) + header[512:]).digest() == header[448:480]
+        json_areas.append(header[luks2.BIN_HDR_SIZE:])
+    assert json_areas[0] == json_areas[1]
+    metadata = json.loads(json_areas[0].rstrip(b"\0"))
+
+    keyslot = metadata["keyslots"]["0"]
+    kdf = keyslot["kdf"]
+    salt = base64.b64decode(kdf["salt"])
+    if kdf["type"] == "pbkdf2":
+        key = PBKDF2HMAC(hashes.SHA256(), keyslot["key_size"], salt, kdf["iterations"]).derive(passphrase)
+    else:
+        key = Argon2id(salt=salt, length=keyslot["key_size"], iterations=kdf["time"], lanes=kdf["cpus"],
+                       memory_cost=kdf["memory"]).derive(passphrase)
+    area_offset = int(keyslot["area"]["offset"])
+    stripes = keyslot["af"]["stripes"]
+    key_size = keyslot["key_size"]
+    material = decrypt_sectors(key, data[area_offset:area_offset + key_size * stripes], 0, 512)
+
+    buffer = bytes(key_size)
+    for i in range(stripes - 1):
+        buffer = luks2._diffuse(bytes(a ^ b for a, b in zip(buffer, material[i * key_size:(i + 1) * key_size])))
+    volume_key = bytes(a ^ b for a, b in zip(buffer, material[-key_size:]))
+
+    digest = metadata["digests"]["0"]
+    assert PBKDF2HMAC(hashes.SHA256(), 32, base64.b64decode(digest["salt"]), digest["iterations"]).derive(
+        volume_key) == base64.b64decode(digest["digest"])
+    return metadata, volume_key
+
+
+def create_content(tmp_path: Path, data: bytes, **kwargs) -> Luks2Content:
+    BuildLocation().set_path(tmp_path)
+    (tmp_path / "data").write_bytes(data)
+    raw = RawContent()
+    raw.file = tmp_path / "data"
+
+    obj = Luks2Content()
+    obj.content = raw
+    obj.passphrase = "secret"
+    obj.kdf = "pbkdf2"
+    obj.kdf_iterations = 1000
+    for key, value in kwargs.items():
+        setattr(obj, key, value)
+    obj.prepare()
+    obj.materialize()
+    return obj
+
+
+@pytest.mark.parametrize("sector_size, threads", [(512, 1), (4096, 1), (4096, 4)])
+def test_encrypt(tmp_path: Path, mocker: MockerFixture, sector_size: int, threads: int):
+    executor = mocker.spy(luks2, "ProcessPoolExecutor")
+    # Multiple chunks, that are encrypted in parallel
+    data = os.urandom(luks2.CHUNK_SIZE + 8 * 4096)
+    obj = create_content(tmp_path, data, sector_size=SizeType(sector_size), threads=threads,
+                         uuid="01234567-89ab-cdef-0123-456789abcdef", label="data")
+    assert obj.size.bytes == luks2.DATA_OFFSET + len(data)
+
+    image = tmp_path / "image"
+    with image.open("wb") as f:
+        obj.write(f)
+    assert image.stat().st_size == obj.size.bytes
+
+    metadata, volume_key = unlock(image, b"secret")
+    assert metadata["segments"]["0"]["sector_size"] == sector_size
+    with image.open("rb") as f:
+        assert f.read(512)[168:204] == b"01234567-89ab-cdef-0123-456789abcdef"
+        f.seek(luks2.DATA_OFFSET)
+        assert decrypt_sectors(volume_key, f.read(), 0, sector_size) == data
+    # The calling process is not forked
+    assert [call.kwargs["mp_context"].get_start_method() for call in executor.call_args_list] == \
+        ["forkserver"] * (threads > 1)
+
+
+def test_key_file_and_argon2id(tmp_path: Path):
+    (tmp_path / "key").write_bytes(b"\0binary\nkey")
+    obj = create_content(tmp_path, bytes(4096), passphrase=None, key_file=tmp_path / "key",
+                         kdf="argon2id", kdf_iterations=4, kdf_memory=64)
+
+    metadata, _ = unlock(obj.result_file, b"\0binary\nkey")
+    assert metadata["keyslots"]["0"]["kdf"]["type"] == "argon2id"
+
+
+def test_sparse(tmp_path: Path):
+    data = os.urandom(4096) + bytes(4096 * 2) + os.urandom(4096)
+    obj = create_content(tmp_path, data, sparse=True)
+    _, volume_key = unlock(obj.result_file, b"secret")
+
+    with obj.result_file.open("rb") as f:
+        f.seek(luks2.DATA_OFFSET)
+        encrypted = f.read()
+    assert encrypted[4096:3 * 4096] == bytes(2 * 4096)
+    assert decrypt_sectors(volume_key, encrypted[:4096], 0, 4096) == data[:4096]
+    assert decrypt_sectors(volume_key, encrypted[3 * 4096:], 3, 4096) == data[3 * 4096:]
+
+    # Without sparse, zeros are encrypted
+    obj = create_content(tmp_path, data)
+    with obj.result_file.open("rb") as f:
+        f.seek(luks2.DATA_OFFSET + 4096)
+        assert f.read(4096) != bytes(4096)
+
+
+def test_invalid(tmp_path: Path):
+    with pytest.raises(Exception, match="Exactly one of passphrase and key_file must be set"):
+        create_content(tmp_path, bytes(4096), passphrase=None)
+    with pytest.raises(Exception, match="Underlying data device must be sector size-aligned"):
+        create_content(tmp_path, bytes(1024))
+    with pytest.raises(Exception, match="Invalid sector size 8192"):
+        create_content(tmp_path, bytes(8192), sector_size=SizeType(8192))
+    with pytest.raises(Exception, match="pbkdf2 requires at least 1000 iterations"):
+        create_content(tmp_path, bytes(4096), kdf_iterations=10)
+
+
+@pytest.mark.skipif(not ctypes.util.find_library("cryptsetup"), reason="libcryptsetup is not installed")
+@pytest.mark.parametrize("kdf", ["pbkdf2", "argon2id"])
+def test_libcryptsetup(tmp_path: Path, kdf: str):
+    obj = create_content(tmp_path, bytes(4096), kdf=kdf, kdf_iterations=4 if kdf == "argon2id" else 1000,
+                         kdf_memory=64, label="data")
+    _, volume_key = unlock(obj.result_file, b"secret")
+
+    lib = ctypes.CDLL(ctypes.util.find_library("cryptsetup"))
+    lib.crypt_get_label.restype = ctypes.c_char_p
+    lib.crypt_get_data_offset.restype = ctypes.c_uint64
+    cd = ctypes.c_void_p()
+    assert lib.crypt_init(ctypes.byref(cd), str(obj.result_file).encode()) == 0
+    try:
+        assert lib.crypt_load(cd, b"LUKS2", None) == 0
+        assert lib.crypt_get_label(cd) == b"data"
+        assert lib.crypt_get_data_offset(cd) * 512 == luks2.DATA_OFFSET
+        assert lib.crypt_get_sector_size(cd) == 4096
+        key = ctypes.create_string_buffer(luks2.KEY_SIZE)
+        key_size = ctypes.c_size_t(luks2.KEY_SIZE)
+        assert lib.crypt_volume_key_get(cd, -1, key, ctypes.byref(key_size), b"secret", 6) == 0
+        assert key.raw[:key_size.value] == volume_key
+        assert lib.crypt_volume_key_get(cd, -1, key, ctypes.byref(key_size), b"wrong", 5) < 0
+    finally:
+        lib.crypt_free(cd)
+
+
+@pytest.mark.skipif(not shutil.which("cryptsetup"), reason="cryptsetup is not installed")
+def test_cryptsetup(tmp_path: Path):
+    data = os.urandom(1024 * 1024)
+    obj = create_content(tmp_path, data)
+
+    res = subprocess.run(["cryptsetup", "luksDump", obj.result_file],
+                         stdout=subprocess.PIPE, encoding="utf8", check=True)
+    assert "Version:       \t2" in res.stdout
+    subprocess.run(["cryptsetup", "open", "--test-passphrase", "--key-file", "-", obj.result_file],
+                   input="secret", encoding="utf8", check=True)
+
+    if os.geteuid() != 0:
+        pytest.skip("Opening the volume requires root")
+    name = f"embdgen-test-{os.getpid()}"
+    subprocess.run(["cryptsetup", "open", "--readonly", "--key-file", "-", obj.result_file, name],
+                   input="secret", encoding="utf8", check=True)
+    try:
+        assert Path(f"/dev/mapper/{name}").read_bytes() == data
+    finally:
+        subprocess.run(["cryptsetup", "close", name], check=True)
@@ -4,8 +4,12 @@ from pathlib import Path
 import subprocess
 import re
 import pytest
+from pytest_mock import MockerFixture
 
+from embdgen.plugins.content import ResizeExt4Content as resize_ext4_module
 from embdgen.plugins.content.ResizeExt4Content import ResizeExt4Content
+from embdgen.plugins.content.Ext4Content import Ext4Content
+from embdgen.plugins.content.FilesContent import FilesContent
 from embdgen.plugins.content.RawContent import RawContent
 from embdgen.core.utils.image import create_empty_image, BuildLocation
 from embdgen.core.utils.SizeType import SizeType
@@ -81,3 +85,84 @@ class TestResizeExt4:
         obj = ResizeExt4Content()
         with pytest.raises(Exception, match=re.escape("add_space must be a multiple of the sector size (512 B)")):
             obj.add_space = SizeType(511)
+
+    def test_resize_ext4(self, tmp_path: Path, mocker: MockerFixture):
+        BuildLocation().set_path(tmp_path)
+        run = mocker.spy(subprocess, "run")
+
+        obj = ResizeExt4Content()
+        obj.content = Ext4Content()
+        obj.content.size = SizeType.parse("10MB")
+        obj.add_space = SizeType.parse("10MB")
+
+        obj.prepare()
+
+        output = tmp_path / "image.img"
+
+        with output.open("wb") as f:
+            obj.write(f)
+
+        assert not any(call.args[0][0] == "e2fsck" for call in run.call_args_list), \
+            "The freshly created filesystem was checked"
+        assert output.stat().st_size == 20 * 1024 * 1024
+        assert get_ext4_size(output) == 20 * 1024 * 1024, "Filesystem was resized"
+        subprocess.run(["e2fsck", "-fn", str(output)], check=True)
+
+    def test_resize_checks_modified(self, tmp_path: Path, mocker: MockerFixture):
+        BuildLocation().set_path(tmp_path)
+        files = tmp_path / "files"
+        files.mkdir()
+        (files / "a").write_text("a")
+        (files / "keep").write_bytes(b"keep" * 1024)
+        base = tmp_path / "base"
+        subprocess.run(["mkfs.ext4", "-q", "-d", str(files), str(base), "10M"], check=True)
+        (files / "a").write_text("changed")
+
+        updated = Ext4Content()
+        updated.content = FilesContent()
+        updated.content.files = [files / "*"]
+        updated.size = SizeType.parse("10MB")
+        updated.base = base
+        nested = ResizeExt4Content()
+        nested.content = Ext4Content()
+        nested.content.size = SizeType.parse("10MB")
+
+        for content in (updated, nested):
+            obj = ResizeExt4Content()
+            obj.content = content
+            obj.add_space = SizeType.parse("1MB")
+            obj.prepare()
+            run = mocker.spy(subprocess, "run")
+            with (tmp_path / "image.img").open("wb") as f:
+                obj.write(f)
+            if content is updated:
+                assert not updated.created, "The base image was not updated"
+            # Filesystems updated from a base image or resized are checked
+            assert any(call.args[0][0] == "e2fsck" for call in run.call_args_list)
+            mocker.stop(run)
+
+    def test_write_skips_free_blocks(self, tmp_path: Path, mocker: MockerFixture):
+        BuildLocation().set_path(tmp_path)
+        test_dir = tmp_path / "test_dir"
+        test_dir.mkdir()
+        (test_dir / "remove").write_bytes(b"REMOVED!" * 128 * 1024)
+        test_fs = tmp_path / "ext4.img"
+        create_empty_image(str(test_fs), 10 * 1024 * 1024)
+        subprocess.run(['mkfs.ext4', '-d', str(test_dir), str(test_fs)], check=True)
+        subprocess.run(['debugfs', '-w', '-R', 'rm /remove', str(test_fs)], check=True)
+        assert b"REMOVED!" in test_fs.read_bytes()
+
+        obj = ResizeExt4Content()
+        obj.content = RawContent()
+        obj.content.file = test_fs
+        obj.add_space = SizeType.parse("1MB")
+        obj.prepare()
+
+        copy_used = mocker.spy(resize_ext4_module, "copy_used")
+        output = tmp_path / "image.img"
+        with output.open("wb") as f:
+            obj.write(f)
+
+        assert copy_used.call_count == 1
+        assert b"REMOVED!" not in output.read_bytes()
+        subprocess.run(['e2fsck', '-fn', str(output)], check=True)
@@ -0,0 +1,118 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from pathlib import Path
+import subprocess
+from typing import Dict, List
+
+import pytest
+
+from embdgen.plugins.content.ArchiveContent import ArchiveContent
+from embdgen.plugins.content.FilesContent import FilesContent
+from embdgen.plugins.content.SquashFSContent import SquashFSContent
+from embdgen.plugins.content.VerityContent import VerityContent
+from embdgen.core.utils.FakeRoot import FakeRoot
+from embdgen.core.utils.image import BuildLocation, get_temp_file
+from embdgen.core.utils.SizeType import SizeType
+
+
+def list_squashfs(image: Path) -> Dict[str, List[str]]:
+    """Map the paths in the filesystem to the fields listed by unsquashfs"""
+    res = subprocess.run(["unsquashfs", "-lln", image], stdout=subprocess.PIPE, check=True, encoding="utf8")
+    entries = {}
+    for line in res.stdout.splitlines():
+        parts = line.split()
+        if parts and parts[-1].startswith("squashfs-root/"):
+            entries[parts[-1].split("/", 1)[1]] = parts
+    return entries
+
+
+def test_from_archive_fakeroot(tmp_path: Path):
+    BuildLocation().set_path(tmp_path)
+    image = tmp_path / "image"
+    archive = tmp_path / "archive.tar"
+    test_dir = tmp_path / "test_dir"
+    test_dir.mkdir()
+    (test_dir / "foobar").write_text("Hello world" * 1000)
+
+    fr = FakeRoot(get_temp_file())
+    fr.run(["mknod", test_dir / "node", "c", str(0x12), str(0x34)])
+    fr.run(["chown", "123:456", test_dir / "node"])
+    fr.run(["chown", "567:890", test_dir / "foobar"])
+    fr.run(["tar", "-cf", archive, "."], cwd=test_dir)
+
+    obj = SquashFSContent()
+    obj.content = ArchiveContent()
+    obj.content.archive = archive
+    obj.compression = "zstd"
+    obj.prepare()
+
+    assert obj.size.bytes % SquashFSContent.ALIGNMENT == 0
+    with image.open("wb") as out_file:
+        obj.write(out_file)
+    assert image.stat().st_size == obj.size.bytes
+
+    entries = list_squashfs(image)
+    assert entries["foobar"][1] == "567/890"
+    assert entries["node"][0].startswith("c")
+    assert entries["node"][1:4] == ["123/456", "18,", "52"]
+
+
+def test_fixed_size(tmp_path: Path):
+    BuildLocation().set_path(tmp_path)
+    (tmp_path / "foobar").write_bytes(b"1" * 100)
+
+    obj = SquashFSContent()
+    obj.content = FilesContent()
+    obj.content.files = [tmp_path / "foobar"]
+    obj.size = SizeType.parse("1 MB")
+    obj.prepare()
+    assert obj.size.bytes == SizeType.parse("1 MB").bytes
+    assert obj.result_file.stat().st_size == obj.size.bytes
+
+    obj = SquashFSContent()
+    obj.content = FilesContent()
+    obj.content.files = [tmp_path / "foobar"]
+    obj.size = SizeType(512)
+    with pytest.raises(Exception, match=r"The filesystem \(\d+ B\) does not fit into the content \(512 B\)"):
+        obj.prepare()
+
+
+def test_verity(tmp_path: Path):
+    BuildLocation().set_path(tmp_path)
+    (tmp_path / "foobar").write_bytes(b"1" * 10000)
+
+    squashfs = SquashFSContent()
+    squashfs.content = FilesContent()
+    squashfs.content.files = [tmp_path / "foobar"]
+
+    obj = VerityContent()
+    obj.metadata = tmp_path / "metadata.txt"
+    obj.content = squashfs
+    obj.prepare()
+    assert obj.size.bytes > squashfs.size.bytes
+
+    with (tmp_path / "image").open("wb") as out_file:
+        obj.write(out_file)
+    assert "Root hash:" in obj.metadata.read_text()
+
+
+def test_mkfs_command(tmp_path: Path):
+    obj = SquashFSContent()
+    obj.threads = 3
+    assert obj._mkfs_command(tmp_path / "dir", tmp_path / "image") == [
+        "mksquashfs", tmp_path / "dir", tmp_path / "image", "-noappend", "-no-progress", "-processors", "3"
+    ]
+
+    obj.compression = "xz"
+    obj.block_size = SizeType.parse("128 kB")
+    assert obj._mkfs_command(tmp_path / "dir", tmp_path / "image")[-4:] == ["-comp", "xz", "-b", "131072"]
+
+
+def test_invalid_options():
+    obj = SquashFSContent()
+    with pytest.raises(Exception, match="Invalid compression 'foo'"):
+        obj.compression = "foo"
+    with pytest.raises(Exception, match="Invalid squashfs block size 12288"):
+        obj.block_size = SizeType(12288)
+    with pytest.raises(Exception, match="must not be negative"):
+        obj.threads = -1
@@ -1,10 +1,14 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
+import os
 import pytest
+import subprocess
 from pathlib import Path
 
 from embdgen.core.utils.SizeType import SizeType
 from embdgen.core.utils.image import create_empty_image, BuildLocation
+from embdgen.plugins.content.Ext4Content import Ext4Content
+from embdgen.plugins.content.FilesContent import FilesContent
 from embdgen.plugins.content.RawContent import RawContent
 from embdgen.plugins.content.VerityContent import VerityContent
 
@@ -63,6 +67,9 @@ class TestVerityContent():
 
         obj.use_internal_implementation = use_internal_implementation
         obj.prepare()
+        assert obj.size.bytes == size + expected_hashtable_size
+        assert obj.estimate().temp_files == [size, expected_hashtable_size]
+        obj.materialize()
 
         assert metadata_file.exists() and metadata_file.stat().st_size > 200
 
@@ -92,3 +99,39 @@ class TestVerityContent():
         obj.metadata = "meta"
         with pytest.raises(Exception, match=r"block size-aligned"):
             obj.prepare()
+
+    def test_ext4_with_base(self, tmp_path: Path):
+        BuildLocation().set_path(tmp_path)
+        files = tmp_path / "files"
+        files.mkdir()
+        (files / "keep").write_text("keep")
+        (files / "remove").write_bytes(os.urandom(1024 * 1024))
+        base = tmp_path / "base"
+        subprocess.run(["mkfs.ext4", "-q", "-d", files, base, "8M"], check=True)
+        (files / "remove").unlink()
+
+        ext4 = Ext4Content()
+        ext4.content = FilesContent()
+        ext4.content.files = [files / "*"]
+        ext4.size = SizeType.parse("8MB")
+        ext4.base = base
+        obj = VerityContent()
+        obj.content = ext4
+        obj.metadata = tmp_path / "metadata.txt"
+        obj.salt = "deadbeef"
+        obj.prepare()
+        image_file = tmp_path / "image"
+        with image_file.open("wb") as f:
+            obj.write(f)
+
+        # Hashing the written data results in the same root hash
+        written = tmp_path / "written"
+        written.write_bytes(image_file.read_bytes()[:ext4.size.bytes])
+        check = VerityContent()
+        check.content = RawContent()
+        check.content.file = written
+        check.metadata = tmp_path / "check.txt"
+        check.salt = "deadbeef"
+        check.prepare()
+        check.materialize()
+        assert check.metadata.read_text() == obj.metadata.read_text()
@@ -5,3 +5,4 @@ from  embdgen.core.content_generator import Factory
 def test_factory():
     f_types = Factory().types()
     assert 'split_archive' in f_types
+    assert 'oci' in f_types
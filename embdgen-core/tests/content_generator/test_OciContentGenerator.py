@@ -0,0 +1,91 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from embdgen.core.utils.image import BuildLocation
+from embdgen.plugins.content_generator.OciContentGenerator import OciContentGenerator
+from embdgen.plugins.content_generator.SplitArchiveContentGenerator import Split
+
+from ..test_utils.oci import create_layer, write_image, write_index
+
+
+def create_split(name: str, root: str) -> Split:
+    s = Split()
+    s.name = name
+    s.root = root
+    return s
+
+
+def create_layout(tmp_path: Path) -> Path:
+    layout = tmp_path / "layout"
+    write_index(layout, [write_image(layout, [
+        create_layer([
+            ("etc", None, {}),
+            ("etc/passwd", b"lower", {}),
+            ("home", None, {}),
+            ("home/user", None, {}),
+            ("home/user/file", b"lower", {}),
+        ]),
+        create_layer([
+            ("etc", None, {}),
+            ("etc/passwd", b"upper", {"uid": 12, "gid": 34}),
+            ("home", None, {}),
+            ("home/.wh.user", b"", {}),
+            ("home/other", b"upper", {}),
+        ]),
+    ])])
+    return layout
+
+
+def test_get_contents() -> None:
+    obj = OciContentGenerator()
+    obj.name = "oci"
+    obj.remaining = "root"
+    obj.splits = [create_split("home", "home")]
+    assert list(obj.get_contents().keys()) == ["oci.home", "oci.root"]
+
+
+def test_splits(tmp_path: Path) -> None:
+    BuildLocation().set_path(tmp_path)
+
+    obj = OciContentGenerator()
+    obj.name = "oci"
+    obj.layout = create_layout(tmp_path)
+    obj.remaining = "root"
+    obj.splits = [create_split("home", "home")]
+    obj.threads = 2
+
+    obj.splits[0].prepare()
+    obj.prepare() # This should do nothing
+
+    assert [file.name for file in obj.splits[0].files] == ["other"]
+    assert sorted(file.name for file in obj.files) == ["etc", "home"]
+    assert not list((Path(obj._tmpDir.name) / "home").iterdir())
+    passwd = Path(obj._tmpDir.name) / "etc" / "passwd"
+    assert passwd.read_text() == "upper"
+    res = obj.fakeroot.run(["stat", "-c", "%u:%g", passwd], stdout=subprocess.PIPE, encoding="utf8")
+    assert res.stdout.strip() == "12:34"
+    assert obj.estimate().temp_other > 0
+
+    obj.do_release()
+    assert not obj.files
+
+
+def test_non_existing_split(tmp_path: Path) -> None:
+    BuildLocation().set_path(tmp_path)
+
+    obj = OciContentGenerator()
+    obj.name = "oci"
+    obj.layout = create_layout(tmp_path)
+    obj.splits = [create_split("user", "home/user")]
+
+    with pytest.raises(Exception, match="Path home/user is not in image .*layout"):
+        obj.splits[0].prepare()
+
+
+def test_invalid_threads() -> None:
+    with pytest.raises(Exception, match="must not be negative"):
+        OciContentGenerator().threads = -1
@@ -1,5 +1,6 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
+import io
 from pathlib import Path
 import pytest
 
@@ -15,6 +16,8 @@ from embdgen.plugins.region.RawRegion import RawRegion
 from embdgen.plugins.content.RawContent import RawContent
 from embdgen.plugins.content.FilesContent import FilesContent
 from embdgen.plugins.content.Fat32Content import Fat32Content
+from embdgen.plugins.sink.RawSink import RawSink
+from embdgen.plugins.sink.StreamSink import StreamSink
 
 from ..test_utils.FdiskParser import FdiskParser, FdiskRegion
 
@@ -99,6 +102,36 @@ class TestGPT:
         output = capsys.readouterr().out
         assert output == "The location for the GPT Partition Table is used by another region. Table will be relocated\n"
 
+    def test_stream(self, tmp_path):
+        BuildLocation().set_path(tmp_path)
+
+        image = tmp_path / "image"
+        obj = GPT()
+
+        empty = EmptyRegion()
+        empty.name = "empty region"
+        empty.start = SizeType(512 * 2)
+        empty.size = SizeType(512)
+
+        raw_file = tmp_path / "raw"
+        raw_file.write_bytes(b"1" * 512 * 2)
+        raw = PartitionRegion()
+        raw.fstype = "ext4"
+        raw.name = "raw region"
+        raw.content = RawContent()
+        raw.content.file = raw_file
+
+        obj.parts = [empty, raw]
+        obj.prepare()
+
+        # The relocated partition table requires reading back the written table,
+        # which must also work, when the output is not seekable
+        stream = io.BytesIO()
+        obj.create(None, sinks=[RawSink(image), StreamSink(Path("-"), stream)])
+
+        assert stream.getvalue() == image.read_bytes()
+        assert FdiskParser(image).is_valid
+
     def test_overlap_GPT_table_withParts(self, tmp_path, capsys: pytest.CaptureFixture[str]):
         BuildLocation().set_path(tmp_path)
 
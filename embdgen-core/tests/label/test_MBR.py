@@ -2,11 +2,17 @@
 
 from pathlib import Path
 import subprocess
+import threading
+import time
+from typing import List
+
+import pytest
 
 from embdgen.core.utils.image import BuildLocation
 from embdgen.core.utils.SizeType import SizeType
 
 from embdgen.plugins.content.EmptyContent import EmptyContent
+from embdgen.plugins.content.Ext4Content import Ext4Content
 from embdgen.plugins.label.MBR import MBR
 from embdgen.plugins.region.EmptyRegion import EmptyRegion
 from embdgen.plugins.region.PartitionRegion import PartitionRegion
@@ -15,9 +21,73 @@ from embdgen.plugins.content.RawContent import RawContent
 from embdgen.plugins.content.FilesContent import FilesContent
 from embdgen.plugins.content.Fat32Content import Fat32Content
 
+from embdgen.plugins.sink.RawSink import RawSink
+
+from ..sink.test_TeeWriter import RecordingSink
 from ..test_utils.FdiskParser import FdiskParser, FdiskRegion
 
 
+class FailingRawSink(RawSink):
+    def write(self, offset: int, data: bytes) -> None:
+        raise Exception("sink failed")
+
+
+class BlockingContent(RawContent):
+    """Content, that can only be materialized after another content was written"""
+    written: threading.Event
+    wait_for: threading.Event
+    waited: bool = False
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.written = threading.Event()
+        self.wait_for = threading.Event()
+
+    def do_materialize(self) -> None:
+        self.waited = self.wait_for.wait(10)
+
+    def do_write(self, file) -> None:
+        super().do_write(file)
+        self.written.set()
+
+
+class TrackingContent(RawContent):
+    """Content, that tracks how many contents are materialized at the same time"""
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+    materialized = 0
+
+    def do_materialize(self) -> None:
+        with self.lock:
+            TrackingContent.active += 1
+            TrackingContent.max_active = max(TrackingContent.max_active, TrackingContent.active)
+            TrackingContent.materialized += 1
+        time.sleep(0.05)
+
+    def do_release(self) -> None:
+        with self.lock:
+            TrackingContent.active -= 1
+
+
+def tracking_mbr(tmp_path: Path, contents: List[TrackingContent]) -> MBR:
+    BuildLocation().set_path(tmp_path)
+    raw_file = tmp_path / "raw"
+    raw_file.write_bytes(b"1" * 4096)
+    TrackingContent.active = TrackingContent.max_active = TrackingContent.materialized = 0
+
+    obj = MBR()
+    for i, content in enumerate(contents):
+        content.file = raw_file
+        raw = PartitionRegion()
+        raw.fstype = "ext4"
+        raw.name = f"raw{i}"
+        raw.content = content
+        obj.parts.append(raw)
+    obj.prepare()
+    return obj
+
+
 class TestMBR:
     def test_empty(self, tmp_path: Path):
         image = tmp_path / "image"
@@ -51,6 +121,149 @@ class TestMBR:
         assert fdisk.is_valid
         assert fdisk.diskid == "0xdeadbeef"
 
+    def test_export_partitions(self, tmp_path: Path):
+        BuildLocation().set_path(tmp_path)
+
+        image = tmp_path / "image"
+        partition_dir = tmp_path / "parts"
+        obj = MBR()
+
+        raw_file = tmp_path / "raw"
+        raw_file.write_bytes(b"1" * 512 + b"\0" * 4096 * 4 + b"2" * 512)
+        raw = PartitionRegion()
+        raw.fstype = "ext4"
+        raw.name = "raw"
+        raw.start = SizeType(4096)
+        raw.content = RawContent()
+        raw.content.file = raw_file
+
+        empty = PartitionRegion()
+        empty.fstype = "ext4"
+        empty.name = "empty"
+        empty.start = SizeType.parse("1MB")
+        empty.size = SizeType.parse("1MB")
+        empty.content = EmptyContent()
+
+        obj.parts = [raw, empty]
+        obj.prepare()
+        obj.create(image, partition_dir)
+
+        assert sorted(p.name for p in partition_dir.iterdir()) == ["empty.img", "raw.img"]
+        assert (partition_dir / "raw.img").read_bytes() == raw_file.read_bytes()
+        assert (partition_dir / "empty.img").stat().st_size == SizeType.parse("1MB").bytes
+        assert (partition_dir / "empty.img").stat().st_blocks == 0
+
+    def test_parallel(self, tmp_path: Path):
+        BuildLocation().set_path(tmp_path)
+
+        obj = MBR()
+        obj.diskid = 0x12345678
+        for i in range(4):
+            raw_file = tmp_path / f"raw{i}"
+            raw_file.write_bytes(bytes([i + 1]) * 4096 * (i + 1))
+            raw = PartitionRegion()
+            raw.fstype = "ext4"
+            raw.name = f"raw{i}"
+            raw.content = RawContent()
+            raw.content.file = raw_file
+            obj.parts.append(raw)
+        obj.prepare()
+
+        obj.create(tmp_path / "sequential")
+        obj.create(tmp_path / "parallel", jobs=4)
+
+        assert (tmp_path / "parallel").read_bytes() == (tmp_path / "sequential").read_bytes()
+
+    def test_parallel_sink_error(self, tmp_path: Path):
+        BuildLocation().set_path(tmp_path)
+
+        obj = MBR()
+        for i in range(4):
+            raw_file = tmp_path / f"raw{i}"
+            raw_file.write_bytes(bytes([i + 1]) * 4096)
+            raw = PartitionRegion()
+            raw.fstype = "ext4"
+            raw.name = f"raw{i}"
+            raw.content = RawContent()
+            raw.content.file = raw_file
+            obj.parts.append(raw)
+        obj.prepare()
+
+        obj.create(tmp_path / "sequential")
+        with pytest.raises(Exception, match="Writing to FailingRawSink.* failed: sink failed"):
+            obj.create(tmp_path / "parallel", sinks=[FailingRawSink(tmp_path / "failing")], jobs=4)
+
+        # A failing additional output does not stop writing the image
+        assert (tmp_path / "parallel").read_bytes() == (tmp_path / "sequential").read_bytes()
+
+    def test_pipeline(self, tmp_path: Path):
+        BuildLocation().set_path(tmp_path)
+
+        raw_file = tmp_path / "raw"
+        raw_file.write_bytes(b"1" * 4096)
+
+        obj = MBR()
+        contents = [BlockingContent(), BlockingContent()]
+        contents[0].wait_for.set()
+        contents[1].wait_for = contents[0].written
+        for i, content in enumerate(contents):
+            content.file = raw_file
+            raw = PartitionRegion()
+            raw.fstype = "ext4"
+            raw.name = f"raw{i}"
+            raw.content = content
+            obj.parts.append(raw)
+        obj.prepare()
+
+        # The second region is materialized, while the first region is written
+        obj.create(None, sinks=[RecordingSink()], jobs=2)
+        assert contents[1].waited
+
+    def test_pipeline_lookahead(self, tmp_path: Path):
+        obj = tracking_mbr(tmp_path, [TrackingContent() for _ in range(6)])
+
+        # Only up to jobs regions are materialized and not yet written
+        obj.create(None, sinks=[RecordingSink()], jobs=2)
+        assert TrackingContent.materialized == 6
+        assert TrackingContent.max_active == 2
+        assert TrackingContent.active == 0
+
+    def test_shared_content(self, tmp_path: Path):
+        content = TrackingContent()
+        obj = tracking_mbr(tmp_path, [content, content])
+
+        # Both regions materialize the content concurrently, but it is only generated once
+        obj.create(tmp_path / "image", jobs=2)
+        assert TrackingContent.materialized == 1
+        assert TrackingContent.active == 0
+
+    def test_release(self, tmp_path: Path):
+        build_dir = tmp_path / "build"
+        BuildLocation().set_path(build_dir)
+
+        obj = MBR()
+        obj.diskid = 0x12345678
+        content = Ext4Content()
+        content.size = SizeType.parse("1MB")
+        for i in range(2):
+            part = PartitionRegion()
+            part.fstype = "ext4"
+            part.name = f"part{i}"
+            part.content = content
+            obj.parts.append(part)
+        obj.prepare()
+
+        obj.create(tmp_path / "image")
+
+        # The shared content is only removed after it was written by both regions
+        data = (tmp_path / "image").read_bytes()
+        first, second = (
+            data[part.start.bytes:(part.start + part.size).bytes]
+            for part in obj.parts if isinstance(part, PartitionRegion)
+        )
+        assert first == second
+        assert not list(build_dir.glob("*.Ext4Content"))
+
     def test_withParts(self, tmp_path):
         BuildLocation().set_path(tmp_path)
 
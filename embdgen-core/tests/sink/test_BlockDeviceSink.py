@@ -0,0 +1,46 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import fcntl
+from pathlib import Path
+import struct
+
+from embdgen.core.sink import TeeWriter
+from embdgen.plugins.sink.BlockDeviceSink import BlockDeviceSink
+
+
+def test_stale_data(tmp_path: Path, mocker):
+    device = tmp_path / "device"
+    device.write_bytes(b"\xff" * 8 * 1024 * 1024) # Data of a previous image
+    size = 4 * 1024 * 1024 + 512
+
+    ioctl = mocker.spy(fcntl, "ioctl")
+    with TeeWriter([BlockDeviceSink(device)], size) as writer:
+        writer.seek(100)
+        writer.write(b"a" * 5000)
+        writer.seek(8192)
+        writer.write(b"b" * 100)
+        writer.seek(3 * 1024 * 1024 + 10)
+        writer.write(b"c" * 10)
+        writer.seek(size - 10)
+        writer.write(b"d" * 10)
+
+    data = device.read_bytes()
+    assert len(data) == size
+    assert data == (bytes(100) + b"a" * 5000 + bytes(8192 - 5100) + b"b" * 100 +
+                    bytes(3 * 1024 * 1024 + 10 - 8292) + b"c" * 10 +
+                    bytes(size - 3 * 1024 * 1024 - 30) + b"d" * 10)
+
+    # The large holes are zeroed as a whole (aligned to 4096 bytes)
+    zero_calls = [c.args[2] for c in ioctl.call_args_list if c.args[1] == BlockDeviceSink.BLKZEROOUT]
+    assert zero_calls == [
+        struct.pack("QQ", 12288, 3 * 1024 * 1024 - 12288),
+        struct.pack("QQ", 3 * 1024 * 1024 + 4096, 1024 * 1024 - 4096)
+    ]
+
+
+def test_large(tmp_path: Path):
+    device = tmp_path / "device"
+    data = bytes(range(256)) * 4096 * 20
+    with TeeWriter([BlockDeviceSink(device)], len(data)) as writer:
+        writer.write(data)
+    assert device.read_bytes() == data
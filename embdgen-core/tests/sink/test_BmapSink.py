@@ -0,0 +1,35 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import hashlib
+from pathlib import Path
+import re
+
+from embdgen.core.sink import TeeWriter
+from embdgen.plugins.sink.BmapSink import BmapSink
+
+
+def test_bmap(tmp_path: Path):
+    bmap = tmp_path / "image.bmap"
+    size = 10 * 4096 + 100
+
+    with TeeWriter([BmapSink(bmap)], size) as writer:
+        writer.write(b"a" * 100)
+        writer.seek(4096 * 2)
+        writer.write(b"b" * 8192)
+        writer.seek(4096 * 10 + 10)
+        writer.write(b"c" * 10)
+
+    content = bmap.read_text(encoding="utf-8")
+    assert "<ImageSize> 41060 </ImageSize>" in content
+    assert "<BlocksCount> 11 </BlocksCount>" in content
+    assert "<MappedBlocksCount> 4 </MappedBlocksCount>" in content
+
+    ranges = re.findall(r'<Range chksum="([0-9a-f]+)"> ([0-9-]+) </Range>', content)
+    assert ranges == [
+        (hashlib.sha256(b"a" * 100 + bytes(4096 - 100)).hexdigest(), "0"),
+        (hashlib.sha256(b"b" * 8192).hexdigest(), "2-3"),
+        (hashlib.sha256(bytes(10) + b"c" * 10 + bytes(80)).hexdigest(), "10")
+    ]
+
+    checksum = re.search(r"<BmapFileChecksum> ([0-9a-f]+) </BmapFileChecksum>", content).group(1)
+    assert hashlib.sha256(content.replace(checksum, "0" * 64).encode()).hexdigest() == checksum
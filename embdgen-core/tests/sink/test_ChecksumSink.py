@@ -0,0 +1,19 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import hashlib
+from pathlib import Path
+
+from embdgen.core.sink import TeeWriter
+from embdgen.plugins.sink.ChecksumSink import ChecksumSink
+
+
+def test_checksum(tmp_path: Path):
+    manifest = tmp_path / "image.raw.sha256"
+    size = 3 * 1024 * 1024 + 5
+
+    with TeeWriter([ChecksumSink(manifest)], size) as writer:
+        writer.seek(1000)
+        writer.write(b"data")
+
+    expected = bytes(1000) + b"data" + bytes(size - 1004)
+    assert manifest.read_text(encoding="utf-8") == f"{hashlib.sha256(expected).hexdigest()}  image.raw\n"
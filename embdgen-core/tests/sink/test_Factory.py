@@ -0,0 +1,12 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from  embdgen.core.sink import Factory
+
+
+def test_factory():
+    f_types = Factory().types()
+    assert 'raw' in f_types
+    assert 'sparse' in f_types
+    assert 'bmap' in f_types
+    assert 'checksum' in f_types
+    assert 'zstd' in f_types
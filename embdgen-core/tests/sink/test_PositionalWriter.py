@@ -0,0 +1,79 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from embdgen.core.sink import PositionalSinks, PositionalWriter
+from embdgen.plugins.sink.RawSink import RawSink
+
+from .test_TeeWriter import FailingCloseSink, FailingSink, RecordingSink
+
+
+def test_concurrent(tmp_path: Path):
+    image = tmp_path / "image.raw"
+    sinks = PositionalSinks([RawSink(image)])
+    size = 16 * 1024 * 1024
+    sinks.open(size)
+
+    def write_range(index: int) -> None:
+        with PositionalWriter(sinks, size) as writer:
+            writer.seek(index * 1024 * 1024)
+            for _ in range(256):
+                writer.write(bytes([index + 1]) * 4096)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(write_range, range(16)))
+    sinks.close()
+
+    assert image.read_bytes() == b"".join(bytes([i + 1]) * 1024 * 1024 for i in range(16))
+
+
+def test_operations():
+    sink = RecordingSink(sequential=False)
+    sinks = PositionalSinks([sink])
+    sinks.open(100)
+    with PositionalWriter(sinks, 100) as writer:
+        writer.seek(50)
+        writer.write(b"a" * 10)
+        writer.write(b"b" * 10)
+        writer.punch_hole(70, 10)
+        writer.punch_hole(80, 10)
+        writer.seek(0)
+        writer.write(b"c")
+    assert sink.operations == [("write", 50, 20), ("discard", 70, 20), ("write", 0, 1)]
+
+
+def test_sequential_sink():
+    with pytest.raises(Exception, match="Positional writes are not supported by RecordingSink"):
+        PositionalSinks([RecordingSink()])
+
+
+def test_sink_error():
+    sink = RecordingSink(sequential=False)
+    failing = [FailingSink(sequential=False), FailingCloseSink(sequential=False)]
+    sinks = PositionalSinks([failing[0], sink, failing[1]])
+    sinks.open(100)
+    for offset in (0, 50):
+        with PositionalWriter(sinks, 100) as writer:
+            writer.seek(offset)
+            writer.write(b"a")
+    with pytest.raises(Exception, match="Writing to FailingSink\\(recording\\) failed: sink failed\n" +
+                                        "Writing to FailingCloseSink\\(recording\\) failed: sink failed"):
+        sinks.close()
+
+    # The failed sinks are closed, the remaining sink is still written completely
+    assert all(s.closed for s in failing)
+    assert sink.closed
+    assert sink.operations == [("write", 0, 1), ("write", 50, 1)]
+
+
+def test_all_sinks_failed():
+    sinks = PositionalSinks([FailingSink(sequential=False)])
+    sinks.open(100)
+    with PositionalWriter(sinks, 100) as writer:
+        writer.write(b"a")
+    with pytest.raises(Exception, match="Writing to FailingSink\\(recording\\) failed: sink failed"):
+        with PositionalWriter(sinks, 100) as writer:
+            writer.write(b"b")
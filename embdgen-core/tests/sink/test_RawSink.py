@@ -0,0 +1,22 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from pathlib import Path
+
+from embdgen.core.sink import TeeWriter
+from embdgen.plugins.sink.RawSink import RawSink
+
+
+def test_raw(tmp_path: Path):
+    image = tmp_path / "image.raw"
+    image.write_bytes(b"\1" * 1024 * 1024) # Existing content is replaced
+
+    with TeeWriter([RawSink(image)], 512 * 1024) as writer:
+        writer.seek(4096)
+        writer.write(b"a" * 100)
+        writer.seek(256 * 1024)
+        writer.write(b"b" * 100)
+
+    data = image.read_bytes()
+    assert len(data) == 512 * 1024
+    assert data == bytes(4096) + b"a" * 100 + bytes(256 * 1024 - 4196) + b"b" * 100 + bytes(256 * 1024 - 100)
+    assert image.stat().st_blocks < 512 * 1024 / 512 / 2, "The file is sparse"
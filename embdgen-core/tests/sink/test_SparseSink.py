@@ -0,0 +1,48 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from pathlib import Path
+import struct
+
+from embdgen.core.sink import TeeWriter
+from embdgen.plugins.sink.SparseSink import SparseSink
+
+
+def unsparse(filename: Path) -> bytes:
+    data = filename.read_bytes()
+    magic, major, _, file_hdr_sz, chunk_hdr_sz, blk_sz, total_blks, total_chunks, _ = \
+        struct.unpack_from("<IHHHHIIII", data)
+    assert magic == 0xED26FF3A
+    assert major == 1
+    out = bytearray()
+    pos = file_hdr_sz
+    for _ in range(total_chunks):
+        chunk_type, _, chunk_sz, total_sz = struct.unpack_from("<HHII", data, pos)
+        if chunk_type == 0xCAC1:
+            assert total_sz == chunk_hdr_sz + chunk_sz * blk_sz
+            out += data[pos + chunk_hdr_sz:pos + total_sz]
+        else:
+            assert chunk_type == 0xCAC3
+            assert total_sz == chunk_hdr_sz
+            out += bytes(chunk_sz * blk_sz)
+        pos += total_sz
+    assert pos == len(data)
+    assert len(out) == total_blks * blk_sz
+    return bytes(out)
+
+
+def test_sparse(tmp_path: Path):
+    sparse = tmp_path / "image.simg"
+    size = 10 * 4096 + 100
+
+    with TeeWriter([SparseSink(sparse)], size) as writer:
+        writer.write(b"a" * 100)
+        writer.seek(4096 * 2 + 10)
+        writer.write(b"b" * 8192)
+        writer.seek(4096 * 10 + 10)
+        writer.write(b"c" * 10)
+
+    expected = (b"a" * 100 + bytes(4096 * 2 + 10 - 100) + b"b" * 8192 +
+                bytes(4096 * 10 + 10 - (4096 * 2 + 10 + 8192)) + b"c" * 10)
+    expected += bytes(4096 * 11 - len(expected))
+    assert unsparse(sparse) == expected
+    assert sparse.stat().st_size < 6 * 4096
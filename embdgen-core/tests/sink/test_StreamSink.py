@@ -0,0 +1,39 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+from pathlib import Path
+import threading
+
+from embdgen.core.sink import TeeWriter
+from embdgen.plugins.sink.StreamSink import StreamSink
+
+
+def test_pipe(tmp_path: Path):
+    fifo = tmp_path / "fifo"
+    os.mkfifo(fifo)
+    size = 3 * 1024 * 1024
+
+    received = []
+    def reader():
+        with fifo.open("rb") as f:
+            received.append(f.read())
+    thread = threading.Thread(target=reader)
+    thread.start()
+
+    with TeeWriter([StreamSink(fifo)], size) as writer:
+        writer.seek(4096)
+        writer.write(b"a" * 100)
+        writer.seek(2 * 1024 * 1024)
+        writer.write(b"b" * 100)
+    thread.join()
+
+    assert received[0] == bytes(4096) + b"a" * 100 + bytes(2 * 1024 * 1024 - 4196) + b"b" * 100 + \
+        bytes(size - 2 * 1024 * 1024 - 100)
+
+
+def test_stdout(capfdbinary):
+    with TeeWriter([StreamSink(Path("-"))], 10) as writer:
+        writer.seek(5)
+        writer.write(b"data")
+
+    assert capfdbinary.readouterr().out == bytes(5) + b"data" + bytes(1)
@@ -0,0 +1,118 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import io
+from pathlib import Path
+from typing import List, Tuple
+
+import pytest
+
+from embdgen.core.sink import BaseSink, TeeWriter
+from embdgen.core.utils.image import copy_sparse
+
+
+class RecordingSink(BaseSink):
+    operations: List[Tuple[str, int, int]]
+    data: bytearray
+
+    def __init__(self, sequential: bool = True) -> None:
+        super().__init__(Path("recording"))
+        self.SEQUENTIAL = sequential
+        self.operations = []
+        self.closed = False
+
+    def open(self, size: int) -> None:
+        super().open(size)
+        self.data = bytearray(size)
+
+    def write(self, offset: int, data: bytes) -> None:
+        self.operations.append(("write", offset, len(data)))
+        self.data[offset:offset + len(data)] = data
+
+    def discard(self, offset: int, length: int) -> None:
+        self.operations.append(("discard", offset, length))
+        self.data[offset:offset + length] = bytes(length)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class FailingSink(RecordingSink):
+    def write(self, offset: int, data: bytes) -> None:
+        raise Exception("sink failed")
+
+
+class FailingCloseSink(FailingSink):
+    def close(self) -> None:
+        super().close()
+        raise Exception("close failed")
+
+
+class TestTeeWriter:
+    def test_gaps(self):
+        sinks = [RecordingSink(), RecordingSink()]
+        with TeeWriter(sinks, 100) as writer:
+            writer.seek(10)
+            writer.write(b"a" * 10)
+            writer.write(b"b" * 10)
+            writer.seek(50)
+            writer.write(b"c" * 10)
+
+        for sink in sinks:
+            assert sink.closed
+            assert sink.operations == [
+                ("discard", 0, 10),
+                ("write", 10, 20),
+                ("discard", 30, 20),
+                ("write", 50, 10),
+                ("discard", 60, 40)
+            ]
+            assert sink.data == bytes(10) + b"a" * 10 + b"b" * 10 + bytes(20) + b"c" * 10 + bytes(40)
+
+    def test_copy_sparse(self):
+        sink = RecordingSink()
+        data = b"1" * 4096 + bytes(4096 * 3) + b"2" * 4096
+        with TeeWriter([sink], len(data) + 4096) as writer:
+            copy_sparse(writer, io.BytesIO(data))
+        assert sink.operations == [
+            ("write", 0, 4096),
+            ("discard", 4096, 4096 * 3),
+            ("write", 4096 * 4, 4096),
+            ("discard", 4096 * 5, 4096)
+        ]
+        assert sink.data == data + bytes(4096)
+
+    def test_non_sequential(self):
+        writer = TeeWriter([RecordingSink()], 100)
+        writer.seek(50)
+        writer.write(b"a")
+        writer.seek(0)
+        writer.write(b"b")
+        with pytest.raises(Exception, match="Non-sequential write at offset 0"):
+            writer.flush()
+        writer.close()
+
+    def test_random_access(self):
+        sink = RecordingSink(sequential=False)
+        with TeeWriter([sink], 100) as writer:
+            writer.seek(50)
+            writer.write(b"a")
+            writer.seek(0)
+            writer.write(b"b")
+        assert sink.data == b"b" + bytes(49) + b"a" + bytes(49)
+
+    def test_sink_error(self):
+        sink = RecordingSink()
+        failing = [FailingSink(), FailingCloseSink()]
+        writer = TeeWriter([failing[0], sink, failing[1]], 100)
+        writer.write(b"a")
+        with pytest.raises(Exception, match="Writing to FailingSink\\(recording\\) failed: sink failed\n" +
+                                            "Writing to FailingCloseSink\\(recording\\) failed: sink failed"):
+            writer.close()
+
+        # The failed sinks are closed, errors while closing them are not reported
+        assert all(s.closed for s in failing)
+
+        # The remaining sink is still written completely
+        assert sink.closed
+        assert sink.data == b"a" + bytes(99)
+
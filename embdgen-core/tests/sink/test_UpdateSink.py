@@ -0,0 +1,44 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+from pathlib import Path
+
+from embdgen.core.sink import TeeWriter
+from embdgen.plugins.sink.UpdateSink import UpdateSink
+
+
+def write_image(sink: UpdateSink, size: int, data: bytes) -> None:
+    with TeeWriter([sink], size) as writer:
+        writer.seek(4096)
+        writer.write(data)
+
+
+def test_update(tmp_path: Path, mocker):
+    target = tmp_path / "image.raw"
+    size = 10 * 1024 * 1024
+    data = os.urandom(6 * 1024 * 1024)
+
+    write_image(UpdateSink(target, jobs=2), size, data)
+    assert target.read_bytes() == bytes(4096) + data + bytes(size - len(data) - 4096)
+
+    with target.open("rb+") as f:
+        f.seek(9 * 1024 * 1024)
+        f.write(b"stale data")
+
+    data = data[:5 * 1024 * 1024] + b"changed" + data[5 * 1024 * 1024 + 7:]
+    pwrite = mocker.spy(os, "pwrite")
+    sink = UpdateSink(target, jobs=2)
+    write_image(sink, size, data)
+
+    assert target.read_bytes() == bytes(4096) + data + bytes(size - len(data) - 4096)
+    assert sink.written == 2 * 4096
+    assert [len(c.args[1]) for c in pwrite.call_args_list] == [4096]
+
+
+def test_resize(tmp_path: Path):
+    target = tmp_path / "image.raw"
+    target.write_bytes(b"\1" * 1024 * 1024)
+
+    sink = UpdateSink(target)
+    write_image(sink, 8192, b"new")
+    assert target.read_bytes() == bytes(4096) + b"new" + bytes(4093)
@@ -0,0 +1,20 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from pathlib import Path
+import subprocess
+
+from embdgen.core.sink import TeeWriter
+from embdgen.plugins.sink.ZstdSink import ZstdSink
+
+
+def test_zstd(tmp_path: Path):
+    compressed = tmp_path / "image.raw.zst"
+    size = 2 * 1024 * 1024
+
+    with TeeWriter([ZstdSink(compressed)], size) as writer:
+        writer.seek(1024 * 1024)
+        writer.write(b"data")
+
+    assert compressed.stat().st_size < 4096
+    res = subprocess.run(["zstd", "-dc", compressed], stdout=subprocess.PIPE, check=True)
+    assert res.stdout == bytes(1024 * 1024) + b"data" + bytes(1024 * 1024 - 4)
@@ -0,0 +1,69 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import gzip
+import hashlib
+import io
+import json
+import subprocess
+import tarfile
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+# Entries of a layer: (name, content or symlink target or None for directories, attributes)
+LayerEntry = Tuple[str, Union[bytes, str, None], Dict]
+
+
+def create_layer(entries: List[LayerEntry]) -> bytes:
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        for name, content, attrs in entries:
+            info = tarfile.TarInfo(name)
+            info.mtime = 1000000
+            info.mode = 0o755 if content is None else 0o644
+            if content is None:
+                info.type = tarfile.DIRTYPE
+            elif isinstance(content, str):
+                info.type = attrs.pop("type", tarfile.SYMTYPE)
+                info.linkname = content
+            for key, value in attrs.items():
+                setattr(info, key, value)
+            if isinstance(content, bytes):
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+            else:
+                tar.addfile(info)
+    return data.getvalue()
+
+
+def write_blob(layout: Path, data: bytes, media_type: str, **kwargs) -> Dict:
+    digest = hashlib.sha256(data).hexdigest()
+    (layout / "blobs" / "sha256").mkdir(parents=True, exist_ok=True)
+    (layout / "blobs" / "sha256" / digest).write_bytes(data)
+    return {"mediaType": media_type, "digest": f"sha256:{digest}", "size": len(data), **kwargs}
+
+
+def write_image(layout: Path, layers: List[bytes], compression: Optional[str] = "gzip", **kwargs) -> Dict:
+    """Write an image with the layers (lowest first) and return its manifest descriptor"""
+    descriptors = []
+    for layer in layers:
+        media_type = "application/vnd.oci.image.layer.v1.tar"
+        if compression == "gzip":
+            layer = gzip.compress(layer)
+            media_type += "+gzip"
+        elif compression == "zstd":
+            layer = subprocess.run(["zstd", "-cq"], input=layer, stdout=subprocess.PIPE, check=True).stdout
+            media_type += "+zstd"
+        descriptors.append(write_blob(layout, layer, media_type))
+    config = write_blob(layout, b"{}", "application/vnd.oci.image.config.v1+json")
+    manifest = {"schemaVersion": 2, "config": config, "layers": descriptors}
+    return write_blob(layout, json.dumps(manifest).encode(), "application/vnd.oci.image.manifest.v1+json", **kwargs)
+
+
+def write_image_index(layout: Path, manifests: List[Dict], **kwargs) -> Dict:
+    index = {"schemaVersion": 2, "manifests": manifests}
+    return write_blob(layout, json.dumps(index).encode(), "application/vnd.oci.image.index.v1+json", **kwargs)
+
+
+def write_index(layout: Path, manifests: List[Dict]) -> None:
+    (layout / "oci-layout").write_text('{"imageLayoutVersion": "1.0.0"}')
+    (layout / "index.json").write_text(json.dumps({"schemaVersion": 2, "manifests": manifests}))
@@ -0,0 +1,146 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import stat
+import subprocess
+from pathlib import Path
+
+import pytest
+from pytest_mock import MockerFixture
+
+from embdgen.core.utils import debugfs
+from embdgen.core.utils.debugfs import Inode, apply_update, changed_files, fragmentation, local_tree, plan_update, read_tree
+from embdgen.core.utils.image import BuildLocation
+from embdgen.core.utils.FakeRoot import FakeRoot
+
+DIR = stat.S_IFDIR | 0o755
+FILE = stat.S_IFREG | 0o644
+LINK = stat.S_IFLNK | 0o777
+
+
+def test_plan_update(tmp_path: Path):
+    old = {
+        "lost+found": Inode(DIR, 0, 0),
+        "keep": Inode(FILE, 0, 0, 10, 100),
+        "change": Inode(FILE, 0, 0, 10, 100),
+        "chmod": Inode(FILE, 0, 0, 10, 100),
+        "dir": Inode(DIR, 0, 0, 0, 100),
+        "dir/remove": Inode(FILE, 0, 0, 10, 100),
+        "link": Inode(LINK, 0, 0, 1, 100, link="a"),
+    }
+    new = {
+        "keep": Inode(FILE, 0, 0, 10, 100),
+        "change": Inode(FILE, 0, 0, 20, 100),
+        "chmod": Inode(stat.S_IFREG | 0o600, 1, 2, 10, 100),
+        "dir": Inode(DIR, 0, 0, 0, 100),
+        "link": Inode(LINK, 0, 0, 1, 100, link="b"),
+    }
+    update = plan_update(old, new, tmp_path)
+    assert update.written == 20
+    assert update.total == 40
+    assert update.script == [
+        'rm "/dir/remove"',
+        'rm "/change"',
+        'rm "/link"',
+        'cd "/"',
+        f'write "{tmp_path / "change"}" "change"',
+        'cd /',
+        'sif "/change" mode 0100644',
+        'sif "/change" uid 0',
+        'sif "/change" gid 0',
+        'sif "/change" mtime @100',
+        'sif "/chmod" mode 0100600',
+        'sif "/chmod" uid 1',
+        'sif "/chmod" gid 2',
+        'sif "/chmod" mtime @100',
+        'symlink "/link" "b"',
+        'sif "/link" mode 0120777',
+        'sif "/link" uid 0',
+        'sif "/link" gid 0',
+        'sif "/link" mtime @100',
+        'sif "/dir" mode 040755',
+        'sif "/dir" uid 0',
+        'sif "/dir" gid 0',
+        'sif "/dir" mtime @100',
+    ]
+
+
+def test_update(tmp_path: Path):
+    src = tmp_path / "src"
+    (src / "dir").mkdir(parents=True)
+    (src / "dir" / "a").write_text("a")
+    image = tmp_path / "image"
+    subprocess.run(["mkfs.ext4", "-q", "-d", src, image, "8M"], check=True)
+
+    (src / "dir" / "a").unlink()
+    (src / "b c").write_text("bc")
+    fr = FakeRoot(tmp_path / "fakeroot")
+    fr.run(["chown", "12:34", src / "b c"])
+    fr.run(["mknod", src / "dev", "c", "1", "2"])
+
+    new = local_tree(fr, src)
+    old = read_tree(image)
+    assert new is not None and old is not None
+    assert new["b c"].uid == 12
+    assert new["dev"].rdev == (1, 2)
+    assert set(old) == {"dir", "dir/a", "lost+found"}
+
+    apply_update(image, plan_update(old, new, src))
+    updated = read_tree(image)
+    assert updated is not None
+    assert set(updated) == {"dir", "b c", "dev", "lost+found"}
+    assert updated["b c"] == new["b c"]
+    assert updated["dev"] == new["dev"]
+    assert updated["dir"].mtime == new["dir"].mtime
+    assert 0 <= fragmentation(image) < 100
+
+
+def test_changed_files(tmp_path: Path, mocker: MockerFixture):
+    BuildLocation().set_path(tmp_path / "build")
+    src = tmp_path / "src"
+    src.mkdir()
+    for name in ("same", "clamped", "resized", "empty"):
+        (src / name).write_text(name if name != "empty" else "")
+    image = tmp_path / "image"
+    subprocess.run(["mkfs.ext4", "-q", "-d", src, image, "8M"], check=True)
+
+    # The size and modification time are unchanged, e.g. with SOURCE_DATE_EPOCH
+    mtime = os.stat(src / "clamped").st_mtime
+    (src / "clamped").write_text("CLAMPED")
+    os.utime(src / "clamped", (mtime, mtime))
+    (src / "resized").write_text("resized!")
+
+    fr = FakeRoot(tmp_path / "fakeroot")
+    new = local_tree(fr, src)
+    old = read_tree(image)
+    assert new is not None and old is not None
+    assert new["clamped"].same_file(old["clamped"])
+
+    mocker.patch.object(debugfs, "_COMPARE_BATCH", 4)
+    # Only files with the same size and modification time are compared
+    assert changed_files(image, old, new, src) == {"clamped"}
+
+    update = plan_update(old, new, src, image)
+    assert 'rm "/clamped"' in update.script
+    assert 'rm "/same"' not in update.script
+    assert update.written == len("CLAMPED") + len("resized!")
+    assert 'rm "/clamped"' not in plan_update(old, new, src).script
+
+    apply_update(image, update)
+    res = subprocess.run(["debugfs", "-R", "cat /clamped", image], stdout=subprocess.PIPE, check=True)
+    assert res.stdout == b"CLAMPED"
+
+
+def test_local_tree_hardlinks(tmp_path: Path):
+    (tmp_path / "a").write_text("a")
+    (tmp_path / "b").hardlink_to(tmp_path / "a")
+    assert local_tree(FakeRoot(tmp_path / "fakeroot"), tmp_path) is None
+
+
+def test_apply_update_error(tmp_path: Path):
+    image = tmp_path / "image"
+    subprocess.run(["mkfs.ext4", "-q", image, "8M"], check=True)
+    old = read_tree(image)
+    assert old is not None
+    with pytest.raises(Exception, match="debugfs failed"):
+        apply_update(image, plan_update(old, {"a": Inode(FILE, 0, 0, 1, 0)}, tmp_path / "missing"))
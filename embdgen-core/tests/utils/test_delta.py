@@ -0,0 +1,115 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import json
+import os
+from pathlib import Path
+import shutil
+
+import pytest
+
+from embdgen.core.utils.SizeType import SizeType
+from embdgen.core.utils.delta import create_delta, apply_delta, fingerprint_file, write_fingerprints, CHUNK_SIZE
+from embdgen.core.utils import delta as delta_module
+from embdgen.core.utils.image import create_empty_image
+from embdgen.plugins.region.EmptyRegion import EmptyRegion
+
+
+def make_region(name: str, start: int, size: int) -> EmptyRegion:
+    region = EmptyRegion()
+    region.name = name
+    region.start = SizeType(start)
+    region.size = SizeType(size)
+    return region
+
+def write_at(image: Path, offset: int, data: bytes) -> None:
+    with image.open("rb+") as f:
+        f.seek(offset)
+        f.write(data)
+
+
+class TestDelta:
+    SIZE = 3 * CHUNK_SIZE
+
+    def create_images(self, tmp_path: Path):
+        base = tmp_path / "base.raw"
+        image = tmp_path / "image.raw"
+        create_empty_image(base, self.SIZE)
+        write_at(base, 0, b"header")
+        write_at(base, CHUNK_SIZE, os.urandom(CHUNK_SIZE))
+        write_at(base, 2 * CHUNK_SIZE + 8192, b"removed")
+        shutil.copyfile(base, image)
+
+        regions = [
+            make_region("a", 4096, CHUNK_SIZE - 4096),
+            make_region("b", CHUNK_SIZE, CHUNK_SIZE),
+            make_region("c", 2 * CHUNK_SIZE, CHUNK_SIZE)
+        ]
+        return base, image, regions
+
+    def test_roundtrip(self, tmp_path: Path):
+        base, image, regions = self.create_images(tmp_path)
+        write_at(image, 0, b"HEADER")
+        write_at(image, CHUNK_SIZE + 4096 * 3 + 5, b"changed")
+        write_at(image, 2 * CHUNK_SIZE + 8192, b"\0" * 7)
+        with image.open("rb+") as f:
+            f.truncate(self.SIZE + 4096)
+        write_at(image, self.SIZE, b"appended")
+
+        delta = tmp_path / "image.delta"
+        create_delta(regions, image, base, delta, jobs=2)
+
+        assert delta.stat().st_size < 5 * 4096
+
+        target = tmp_path / "target.raw"
+        shutil.copyfile(base, target)
+        apply_delta(delta, target)
+
+        assert target.read_bytes() == image.read_bytes()
+
+    def test_fingerprints(self, tmp_path: Path, mocker):
+        base, image, regions = self.create_images(tmp_path)
+        create_delta(regions, base, base, tmp_path / "base.delta")
+
+        fingerprints = json.loads(fingerprint_file(base).read_text(encoding="utf-8"))
+        assert [e["name"] for e in fingerprints["extents"]] == ["a", "b", "c"]
+
+        write_at(image, 2 * CHUNK_SIZE, b"changed")
+
+        pread = mocker.spy(os, "pread")
+        delta = tmp_path / "image.delta"
+        create_delta(regions, image, base, delta)
+
+        reads = [c.args[2] for c in pread.call_args_list]
+        # The unchanged region b is only read from the new image,
+        # the changed region c is read from both images
+        assert reads.count(CHUNK_SIZE) == 1
+        assert reads.count(2 * CHUNK_SIZE) == 2
+
+        target = tmp_path / "target.raw"
+        shutil.copyfile(base, target)
+        apply_delta(delta, target)
+        assert target.read_bytes() == image.read_bytes()
+
+    def test_write_fingerprints(self, tmp_path: Path, mocker):
+        base, image, regions = self.create_images(tmp_path)
+        write_fingerprints(regions, base, jobs=2)
+
+        # The same fingerprints as written when creating a delta
+        fingerprints = fingerprint_file(base).read_text(encoding="utf-8")
+        create_delta(regions, base, base, tmp_path / "base.delta")
+        assert fingerprint_file(base).read_text(encoding="utf-8") == fingerprints
+
+        fingerprint_file(base).unlink()
+        write_fingerprints(regions, base)
+        read_old = mocker.spy(delta_module._Differ, "_read_old")
+        create_delta(regions, image, base, tmp_path / "image.delta")
+        # Only the gap before region a (without fingerprints) is read from the base image
+        assert [c.args[1:] for c in read_old.call_args_list] == [(0, 4096)]
+
+    def test_invalid(self, tmp_path: Path):
+        delta = tmp_path / "invalid.delta"
+        delta.write_bytes(b"\0" * 100)
+        image = tmp_path / "image.raw"
+        create_empty_image(image, 4096)
+        with pytest.raises(Exception, match="is not an embdgen delta file"):
+            apply_delta(delta, image)
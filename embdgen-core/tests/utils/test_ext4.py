@@ -0,0 +1,78 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import subprocess
+from pathlib import Path
+
+from embdgen.core.utils.ext4 import copy_used, discard_unused, used_ranges
+
+MB = 1024 * 1024
+
+
+def create_ext4(tmp_path: Path) -> Path:
+    image = tmp_path / "image.ext4"
+    data = tmp_path / "data"
+    data.write_bytes(b"\xAA" * MB)
+    subprocess.run(["mkfs.ext4", "-q", "-F", image, "8M"], check=True)
+    subprocess.run(["debugfs", "-w", "-R", f"write {data} data", image], check=True, capture_output=True)
+    subprocess.run(["debugfs", "-w", "-R", f"write {data} deleted", image], check=True, capture_output=True)
+    subprocess.run(["debugfs", "-w", "-R", "rm deleted", image], check=True, capture_output=True)
+    return image
+
+
+def test_used_ranges(tmp_path: Path):
+    image = create_ext4(tmp_path)
+    with image.open("rb") as f:
+        ranges = used_ranges(f)
+        assert f.tell() == 0
+    assert ranges is not None
+    assert ranges[0][0] == 0
+    assert all(start < end <= 8 * MB for start, end in ranges)
+    assert sum(end - start for start, end in ranges) < 8 * MB
+
+
+def test_used_ranges_no_ext4(tmp_path: Path):
+    image = tmp_path / "image"
+    image.write_bytes(b"1" * 4096)
+    with image.open("rb") as f:
+        assert used_ranges(f) is None
+
+
+def test_copy_used(tmp_path: Path):
+    image = create_ext4(tmp_path)
+    assert image.read_bytes().count(b"\xAA" * 4096) >= 2 * MB // 4096
+
+    out = tmp_path / "out"
+    with out.open("wb") as out_file, image.open("rb") as in_file:
+        out_file.write(b"X" * 4096)
+        copy_used(out_file, in_file, 8 * MB)
+        assert out_file.tell() == 4096 + 8 * MB
+
+    copy = tmp_path / "copy.ext4"
+    copy.write_bytes(out.read_bytes()[4096:])
+    assert out.stat().st_size == 4096 + 8 * MB
+    # Only the data of the deleted file is dropped
+    assert copy.read_bytes().count(b"\xAA" * 4096) == MB // 4096
+    subprocess.run(["e2fsck", "-fn", copy], check=True, capture_output=True)
+    dump = tmp_path / "dump"
+    subprocess.run(["debugfs", "-R", f"dump data {dump}", copy], check=True, capture_output=True)
+    assert dump.read_bytes() == b"\xAA" * MB
+
+
+def test_copy_used_no_ext4(tmp_path: Path):
+    image = tmp_path / "image"
+    image.write_bytes(b"1" * 4096)
+    out = tmp_path / "out"
+    with out.open("wb") as out_file, image.open("rb") as in_file:
+        copy_used(out_file, in_file, 4096)
+    assert out.read_bytes() == b"1" * 4096
+
+
+def test_discard_unused(tmp_path: Path):
+    image = create_ext4(tmp_path)
+    with image.open("rb+") as f:
+        discard_unused(f)
+
+    assert image.stat().st_size == 8 * MB
+    # Only the data of the deleted file is dropped
+    assert image.read_bytes().count(b"\xAA" * 4096) == MB // 4096
+    subprocess.run(["e2fsck", "-fn", image], check=True, capture_output=True)
@@ -0,0 +1,173 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import struct
+from pathlib import Path
+from typing import Dict, Tuple
+
+import pytest
+
+from embdgen.core.utils.fat import (MIN_CLUSTERS_16, MIN_CLUSTERS_32, FatLayout, FatWriter, clusters_required,
+                                    dir_entries, minimum_layout, short_name_checksum, short_names)
+
+
+class FatReader:
+    """Minimal reader for the root directory of FAT images (short names only)"""
+
+    def __init__(self, image: bytes) -> None:
+        self.image = image
+        (self.bytes_per_sector, self.cluster_sectors, reserved, fats, self.root_entries,
+         sectors16, _, fat_sectors16) = struct.unpack_from("<HBHBHHBH", image, 11)
+        sectors32, = struct.unpack_from("<I", image, 32)
+        self.sectors = sectors16 or sectors32
+        self.fat_bits = int(image[54 if self.root_entries else 82:][3:5])
+        fat_sectors = fat_sectors16 or struct.unpack_from("<I", image, 36)[0]
+        self.fat_offset = reserved * self.bytes_per_sector
+        root_offset = self.fat_offset + fats * fat_sectors * self.bytes_per_sector
+        self.data_offset = root_offset + self.root_entries * 32
+        if self.fat_bits == 32:
+            root = self.read_chain(struct.unpack_from("<I", image, 44)[0], None)
+        else:
+            root = image[root_offset:self.data_offset]
+        self.root: Dict[bytes, Tuple[int, int, int]] = {}
+        for offset in range(0, len(root), 32):
+            name, attr = struct.unpack_from("<11sB", root, offset)
+            if name[0] == 0:
+                break
+            if attr & 0x0F != 0x0F:
+                high, low, size = struct.unpack_from("<H4xHI", root, offset + 20)
+                self.root[name] = (attr, high << 16 | low, size)
+
+    @property
+    def cluster_size(self) -> int:
+        return self.bytes_per_sector * self.cluster_sectors
+
+    def next_cluster(self, cluster: int) -> int:
+        if self.fat_bits == 32:
+            return struct.unpack_from("<I", self.image, self.fat_offset + cluster * 4)[0] & 0x0FFFFFFF
+        if self.fat_bits == 16:
+            return struct.unpack_from("<H", self.image, self.fat_offset + cluster * 2)[0]
+        entry, = struct.unpack_from("<H", self.image, self.fat_offset + cluster * 3 // 2)
+        entry = entry >> 4 if cluster & 1 else entry & 0xFFF
+        return entry | 0xF000 if entry >= 0xFF8 else entry
+
+    def read_chain(self, cluster: int, size: int) -> bytes:
+        data = b""
+        end = 0x0FFFFFF8 if self.fat_bits == 32 else 0xFFF8
+        while 2 <= cluster < end:
+            offset = self.data_offset + (cluster - 2) * self.cluster_size
+            data += self.image[offset:offset + self.cluster_size]
+            cluster = self.next_cluster(cluster)
+        return data if size is None else data[:size]
+
+    def read(self, short_name: bytes) -> bytes:
+        _, cluster, size = self.root[short_name]
+        return self.read_chain(cluster, size)
+
+
+def test_dir_entries():
+    assert dir_entries("BOOT.BIN") == 1
+    assert dir_entries("boot.bin") == 2
+    assert dir_entries("a" * 13) == 2
+    assert dir_entries("a" * 14) == 3
+
+
+def test_clusters_required(tmp_path: Path):
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "A").write_bytes(b"1" * 5000)
+    (tmp_path / "B").write_bytes(b"")
+    (tmp_path / "c").write_bytes(b"1")
+
+    clusters, root_entries = clusters_required([tmp_path / "dir", tmp_path / "B", tmp_path / "c"], 4096)
+    # dir: 2 clusters for A, 1 for the directory entries, c: 1 cluster
+    assert clusters == 4
+    # Volume label, B and dir and c (with a long file name entry each)
+    assert root_entries == 6
+
+
+def test_minimum_layout_fat16(tmp_path: Path):
+    (tmp_path / "A").write_bytes(b"1" * 4096 * 10)
+
+    layout = minimum_layout([tmp_path / "A"], 4096)
+    assert layout.fat_bits == 16
+    assert layout.clusters == MIN_CLUSTERS_16
+    assert layout.root_entries == 512
+    assert layout.mkfs_clusters(layout.size // 512) >= MIN_CLUSTERS_16
+    assert layout.mkfs_clusters(layout.size // 512 - 8) < MIN_CLUSTERS_16
+    assert layout.mkfs_options() == ["-F", "16", "-S", "512", "-s", "8", "-R", "1", "-f", "2", "-a", "-r", "512"]
+
+    layout = minimum_layout([tmp_path / "A"], 512, headroom=4 * 1024 * 1024)
+    assert layout.fat_bits == 16
+    assert layout.clusters == 10 * 8 + 8192
+
+
+def test_minimum_layout_fat32(tmp_path: Path):
+    layout = minimum_layout([], 512, headroom=40 * 1024 * 1024)
+    assert layout.fat_bits == 32
+    assert layout.clusters == 81920 + 1
+
+    layout = FatLayout(32, 512, MIN_CLUSTERS_32)
+    size = layout.size
+    assert layout.mkfs_clusters(size // 512) >= MIN_CLUSTERS_32
+    assert layout.mkfs_clusters(size // 512 - 1) < MIN_CLUSTERS_32
+    assert "-r" not in layout.mkfs_options()
+
+
+def test_minimum_layout_invalid():
+    with pytest.raises(Exception, match="Invalid FAT cluster size 1000"):
+        minimum_layout([], 1000)
+    with pytest.raises(Exception, match="FAT32 supports only"):
+        minimum_layout([], 512, headroom=512 * 0x10000000)
+
+
+def test_short_names():
+    names = short_names(["BOOT.BIN", "boot.bin2", "Long File Name.txt", "Long File Name 2.txt", ".hidden"])
+    assert names["BOOT.BIN"] == b"BOOT    BIN"
+    assert names["boot.bin2"] == b"BOOT~1  BIN"
+    assert names["Long File Name.txt"] == b"LONGFI~1TXT"
+    assert names["Long File Name 2.txt"] == b"LONGFI~2TXT"
+    assert names[".hidden"] == b"HIDDEN~1   "
+    assert short_name_checksum(b"BOOT    BIN") == short_name_checksum(b"BOOT    BIN")
+
+    with pytest.raises(Exception, match="FAT file names are case insensitive"):
+        short_names(["a.txt", "A.TXT"])
+
+
+@pytest.mark.parametrize("layout,size", [
+    (FatLayout(12, 512, 0, 512), 2 * 1024 * 1024),
+    (FatLayout(16, 2048, 0, 512), 16 * 1024 * 1024),
+    (FatLayout(32, 512, 0), 40 * 1024 * 1024),
+])
+def test_fat_writer(tmp_path: Path, layout: FatLayout, size: int):
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "a").write_bytes(b"a" * 3000)
+    (tmp_path / "BOOT.BIN").write_bytes(bytes(range(256)) * 40)
+    (tmp_path / "EMPTY").write_bytes(b"")
+    files = [tmp_path / "dir", tmp_path / "BOOT.BIN", tmp_path / "EMPTY"]
+
+    writer = FatWriter(layout, size, files)
+    images = []
+    for i in range(2):
+        image = tmp_path / f"image{i}"
+        with image.open("wb") as out_file:
+            writer.write(out_file)
+        images.append(image.read_bytes())
+    assert images[0] == images[1]
+    assert len(images[0]) == size
+
+    reader = FatReader(images[0])
+    assert reader.sectors * reader.bytes_per_sector == size
+    assert reader.cluster_size == layout.cluster_size
+    assert reader.fat_bits == layout.fat_bits
+    assert reader.read(b"BOOT    BIN") == (tmp_path / "BOOT.BIN").read_bytes()
+    assert reader.root[b"EMPTY      "] == (0x20, 0, 0)
+    attr, _, _ = reader.root[b"DIR~1      "]
+    assert attr == 0x10
+
+
+def test_fat_writer_too_small(tmp_path: Path):
+    (tmp_path / "A").write_bytes(b"1" * 4 * 1024 * 1024)
+    (tmp_path / "b").write_bytes(b"1")
+    with pytest.raises(Exception, match="The files require 8192 clusters"):
+        FatWriter(FatLayout(12, 512, 0, 512), 2 * 1024 * 1024, [tmp_path / "A"])
+    with pytest.raises(Exception, match=r"Too many entries in the root directory \(2 > 1\)"):
+        FatWriter(FatLayout(12, 512, 0, 1), 2 * 1024 * 1024, [tmp_path / "b"])
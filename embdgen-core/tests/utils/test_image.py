@@ -1,12 +1,16 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 import gc
+import os
+import time
 import pytest
+from pytest_mock import MockerFixture
 
 from pathlib import Path
 from io import BytesIO
 
-from embdgen.core.utils.image import create_empty_image, copy_sparse, BuildLocation
+from embdgen.core.utils.image import create_empty_image, copy_sparse, copy_range_sparse, BuildLocation, CacheDropper
+from embdgen.core.utils import image
 
 
 def test_create_empty_image(tmp_path: Path):
@@ -88,6 +92,23 @@ def test_copy_spares_after_end(tmp_path: Path):
         copy_sparse(out_file, in_file)
     assert file_path.stat().st_size == 4096 * 3
 
+def test_copy_range_sparse(tmp_path: Path):
+    in_path = tmp_path / "in.img"
+    out_path = tmp_path / "out.img"
+    create_empty_image(in_path, 1024 * 1024)
+    with in_path.open("rb+") as f:
+        f.seek(4096)
+        f.write(b"\1" * 4096)
+        f.seek(512 * 1024)
+        f.write(b"\2" * 4096)
+
+    create_empty_image(out_path, 1024 * 1024 - 4096)
+    with in_path.open("rb") as in_file, out_path.open("rb+") as out_file:
+        copy_range_sparse(in_file.fileno(), out_file.fileno(), 4096, 0, 1024 * 1024 - 4096)
+
+    assert out_path.read_bytes() == in_path.read_bytes()[4096:]
+    assert out_path.stat().st_blocks < (1024 * 1024) / 512 / 2, "The file is still sparse"
+
 
 def test_BuildLocation_remove(tmp_path: Path):
     BuildLocation().remove() # Reset to known state
@@ -109,3 +130,126 @@ def test_BuildLocation_remove(tmp_path: Path):
     assert (tmp_path / "foo").exists()
     BuildLocation().remove()
     assert not (tmp_path / "foo").exists()
+
+
+def test_BuildLocation_ram(tmp_path: Path):
+    ram_dir = tmp_path / "ram"
+    ram_dir.mkdir()
+    BuildLocation().set_path(tmp_path / "disk")
+    BuildLocation().set_ram_budget(8192, 4096, ram_dir)
+    ram_path = BuildLocation().ram_path
+    assert ram_path and ram_path.parent == ram_dir
+
+    first = BuildLocation().temp_file(size_hint=4096)
+    second = BuildLocation().temp_file(size_hint=4096)
+    assert first.parent == ram_path and second.parent == ram_path
+    # The budget is exhausted
+    assert BuildLocation().temp_file(size_hint=4096).parent == tmp_path / "disk"
+    # Deleted files do not count anymore
+    first.unlink()
+    assert BuildLocation().temp_file(size_hint=4096).parent == ram_path
+    # Above the threshold or without a size hint, files are placed on disk
+    second.unlink()
+    assert BuildLocation().temp_file(size_hint=8192).parent == tmp_path / "disk"
+    assert BuildLocation().temp_file().parent == tmp_path / "disk"
+
+    BuildLocation().remove()
+    assert not ram_path.exists()
+    assert not (tmp_path / "disk").exists()
+
+
+def test_BuildLocation_remove_background(tmp_path: Path):
+    old_trash = tmp_path / f"{BuildLocation.TRASH_PREFIX}old"
+    old_trash.mkdir()
+    (old_trash / "file").touch()
+
+    BuildLocation().set_path(tmp_path / "build")
+    (tmp_path / "build" / "file").touch()
+    BuildLocation().remove(background=True)
+    assert not (tmp_path / "build").exists()
+
+    # The trash (including trash of previous runs) is removed by a background process
+    for _ in range(100):
+        if not list(tmp_path.iterdir()):
+            break
+        time.sleep(0.1)
+    assert not list(tmp_path.iterdir())
+
+
+def test_BuildLocation_remove_background_race(tmp_path: Path, mocker: MockerFixture):
+    # Trash directory of another run, that is just moving its build directory
+    other_trash = tmp_path / f"{BuildLocation.TRASH_PREFIX}other"
+    other_trash.mkdir()
+    popen = mocker.patch("embdgen.core.utils.image.subprocess.Popen")
+
+    BuildLocation().set_path(tmp_path / "build")
+    BuildLocation().remove(background=True)
+    removed = popen.call_args.args[0][3:]
+    assert len(removed) == 1 and removed[0].name.startswith(BuildLocation.TRASH_PREFIX)
+    assert other_trash not in removed
+
+    # The new trash directory is removed by another run, before the build directory is moved there
+    def remove_trash(path: Path, target: Path) -> None:
+        target.parent.rmdir()
+        raise FileNotFoundError(target)
+    mocker.patch.object(Path, "rename", remove_trash)
+    BuildLocation().set_path(tmp_path / "build2")
+    BuildLocation().remove(background=True)
+    assert not (tmp_path / "build2").exists()
+    assert popen.call_count == 1
+
+
+def test_CacheDropper(tmp_path: Path, mocker: MockerFixture):
+    in_path = tmp_path / "in"
+    out_path = tmp_path / "out"
+    in_path.write_bytes(b"\1" * 4 * 8192)
+    mocker.patch.object(CacheDropper, "INTERVAL", 8192)
+    mocker.patch.object(CacheDropper, "enabled", True)
+    fadvise = mocker.spy(os, "posix_fadvise")
+    write_back = mocker.spy(CacheDropper, "_write_back")
+
+    with in_path.open("rb") as in_file, out_path.open("wb") as out_file:
+        copy_sparse(out_file, in_file)
+        in_fd, out_fd = in_file.fileno(), out_file.fileno()
+
+    assert out_path.read_bytes() == in_path.read_bytes()
+    dropped = [call.args[1:3] for call in fadvise.call_args_list if call.args[3] == os.POSIX_FADV_DONTNEED]
+    # The output is dropped up to the written range, which is still being written back
+    assert dropped == [r for i in range(4) for r in ((i * 8192, 8192), (0, (i + 1) * 8192))]
+    assert [call.args for call in write_back.call_args_list] == [(out_fd, i * 8192, 8192) for i in range(4)]
+
+
+def test_CacheDropper_write_back(mocker: MockerFixture):
+    sync = mocker.patch("embdgen.core.utils.image._sync_file_range", return_value=0)
+    fdatasync = mocker.patch("os.fdatasync")
+
+    CacheDropper._write_back(3, 8192, 4096)
+    # Wait for the previous range, then start the write-back of the new range only
+    assert [call.args for call in sync.call_args_list] == [
+        (3, 0, 8192, image.SYNC_FILE_RANGE_WAIT_BEFORE),
+        (3, 8192, 4096, image.SYNC_FILE_RANGE_WAIT_BEFORE | image.SYNC_FILE_RANGE_WRITE)
+    ]
+    fdatasync.assert_not_called()
+
+
+def test_CacheDropper_write_back_fallback(mocker: MockerFixture):
+    mocker.patch("embdgen.core.utils.image._sync_file_range", None)
+    fdatasync = mocker.patch("os.fdatasync")
+
+    CacheDropper._write_back(3, 8192, 4096)
+    fdatasync.assert_called_once_with(3)
+
+
+def test_CacheDropper_disabled(tmp_path: Path, mocker: MockerFixture):
+    in_path = tmp_path / "in"
+    in_path.write_bytes(b"\1" * 4 * 8192)
+    mocker.patch.object(CacheDropper, "INTERVAL", 8192)
+    fadvise = mocker.spy(os, "posix_fadvise")
+    write_back = mocker.spy(CacheDropper, "_write_back")
+
+    with in_path.open("rb") as in_file:
+        copy_sparse(BytesIO(), in_file)
+
+    # Only the input is read ahead
+    assert {call.args[3] for call in fadvise.call_args_list} == {os.POSIX_FADV_SEQUENTIAL, os.POSIX_FADV_WILLNEED}
+    write_back.assert_not_called()
@@ -0,0 +1,175 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import shutil
+import stat
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from embdgen.core.utils import oci
+from embdgen.core.utils.FakeRoot import FakeRoot
+from embdgen.core.utils.image import BuildLocation
+
+from ..test_utils.oci import create_layer, write_image, write_image_index, write_index
+
+LOWER = create_layer([
+    ("etc", None, {}),
+    ("etc/a", b"lower", {}),
+    ("etc/b", b"lower", {}),
+    ("etc/link", "a", {}),
+    ("var", None, {}),
+    ("var/x", None, {}),
+    ("var/x/y", b"lower", {}),
+    ("opt", None, {}),
+    ("opt/keep", b"lower", {}),
+    ("opt/hard", "opt/keep", {"type": tarfile.LNKTYPE}),
+    ("implicit", None, {"mode": 0o750}),
+    ("file", b"lower", {}),
+])
+
+MIDDLE = create_layer([
+    ("etc", None, {"mode": 0o700}),
+    ("etc/a", b"middle", {"uid": 123, "gid": 456}),
+    ("etc/.wh.b", b"", {}),
+    ("var", None, {}),
+    ("var/.wh..wh..opq", b"", {}),
+    ("var/new", b"middle", {}),
+    ("opt", None, {"mode": 0o555}),
+    ("null", "", {"type": tarfile.CHRTYPE, "devmajor": 1, "devminor": 3, "mode": 0o666}),
+])
+
+UPPER = create_layer([
+    ("implicit/dir/file", b"upper", {}),
+    ("file/sub", b"upper", {}),
+])
+
+
+def extract(tmp_path: Path, compression="gzip"):
+    BuildLocation().set_path(tmp_path)
+    layout = tmp_path / "layout"
+    write_index(layout, [write_image(layout, [LOWER, MIDDLE, UPPER], compression)])
+    directory = tmp_path / "out"
+    directory.mkdir()
+    fr = FakeRoot(tmp_path / "fakeroot.save")
+    oci.extract(fr, layout, oci.read_layers(layout), directory, 2)
+    return directory, fr.stat_tree(directory)
+
+
+@pytest.mark.parametrize("compression", [
+    None,
+    "gzip",
+    pytest.param("zstd", marks=pytest.mark.skipif(not shutil.which("zstd"), reason="zstd is not installed"))
+])
+def test_extract(tmp_path: Path, compression):
+    directory, tree = extract(tmp_path, compression)
+
+    assert sorted(tree) == [
+        "", "etc", "etc/a", "etc/link", "file", "file/sub", "implicit", "implicit/dir",
+        "implicit/dir/file", "null", "opt", "opt/hard", "opt/keep", "var", "var/new"
+    ]
+    assert (directory / "etc" / "a").read_text() == "middle"
+    assert tree["etc/a"][1:3] == [123, 456]
+    assert os.readlink(directory / "etc" / "link") == "a"
+    assert (directory / "opt" / "keep").read_text() == "lower"
+    assert tree["opt/hard"][6] == tree["opt/keep"][6]
+    assert (directory / "file" / "sub").read_text() == "upper"
+
+    # The directory attributes are taken from the upper-most layer defining them
+    assert stat.S_IMODE(tree["etc"][0]) == 0o700
+    assert stat.S_IMODE(tree["opt"][0]) == 0o555
+    assert stat.S_IMODE(tree["implicit"][0]) == 0o750
+    assert tree["etc"][4] == 1000000
+
+    assert stat.S_ISCHR(tree["null"][0])
+    assert stat.S_IMODE(tree["null"][0]) == 0o666
+    assert (os.major(tree["null"][5]), os.minor(tree["null"][5])) == (1, 3)
+
+    # The decompressed layers are removed
+    assert sorted(entry.name for entry in tmp_path.iterdir()) == ["fakeroot.save", "layout", "out"]
+
+
+def test_layer_index():
+    index = oci.LayerIndex()
+    assert not index.whiteout("etc")
+    index.add("etc/a", False)
+    assert index.whiteout("etc/.wh.b")
+    assert index.whiteout("var/.wh..wh..opq")
+    # Whiteouts only apply to lower layers
+    assert not index.hidden("etc/b", False)
+    index.next_layer()
+
+    assert index.hidden("etc/a", False)
+    assert index.hidden("etc/b", False)
+    assert index.hidden("etc/b/c", False)
+    assert not index.hidden("etc/c", False)
+    assert not index.hidden("etc", True)
+    assert index.hidden("etc", False)
+    assert not index.hidden("var", True)
+    assert index.hidden("var/x", True)
+
+
+def test_hardlink_to_replaced_file(tmp_path: Path):
+    BuildLocation().set_path(tmp_path)
+    layout = tmp_path / "layout"
+    write_index(layout, [write_image(layout, [
+        create_layer([("a", b"lower", {}), ("b", "a", {"type": tarfile.LNKTYPE})]),
+        create_layer([("a", b"upper", {})]),
+    ])])
+    directory = tmp_path / "out"
+    directory.mkdir()
+
+    with pytest.raises(Exception, match="The target of the hardlink b is replaced by an upper layer"):
+        oci.extract(FakeRoot(tmp_path / "fakeroot.save"), layout, oci.read_layers(layout), directory, 1)
+
+
+def test_invalid_path(tmp_path: Path):
+    BuildLocation().set_path(tmp_path)
+    layout = tmp_path / "layout"
+    write_index(layout, [write_image(layout, [create_layer([("../a", b"", {})])])])
+    directory = tmp_path / "out"
+    directory.mkdir()
+
+    with pytest.raises(Exception, match="Invalid path ../a in layer"):
+        oci.extract(FakeRoot(tmp_path / "fakeroot.save"), layout, oci.read_layers(layout), directory, 1)
+    assert not (tmp_path / "a").exists()
+
+
+def test_digest_mismatch(tmp_path: Path):
+    layout = tmp_path / "layout"
+    write_index(layout, [write_image(layout, [LOWER])])
+    layer, = oci.read_layers(layout)
+    oci.blob_path(layout, layer.digest).write_bytes(b"invalid")
+
+    with pytest.raises(Exception, match="does not match"):
+        oci.apply_layers([oci.blob_path(layout, layer.digest)], [layer.digest], tmp_path, tmp_path, 1)
+
+
+def test_read_layers(tmp_path: Path):
+    layout = tmp_path / "layout"
+    first = write_image(layout, [LOWER], annotations={oci.REF_NAME: "first"})
+    second = write_image(layout, [LOWER, MIDDLE], annotations={oci.REF_NAME: "second"})
+    write_index(layout, [first, second])
+
+    assert len(oci.read_layers(layout, "first")) == 1
+    assert len(oci.read_layers(layout, "second")) == 2
+    with pytest.raises(Exception, match="Expected exactly one image manifest matching no selection, found 2"):
+        oci.read_layers(layout)
+    with pytest.raises(Exception, match="Expected exactly one image manifest matching reference third, found 0"):
+        oci.read_layers(layout, "third")
+
+
+def test_read_layers_platform(tmp_path: Path):
+    layout = tmp_path / "layout"
+    amd64 = write_image(layout, [LOWER], platform={"os": "linux", "architecture": "amd64"})
+    arm64 = write_image(layout, [LOWER, MIDDLE], platform={"os": "linux", "architecture": "arm64", "variant": "v8"})
+    attestation = write_image(layout, [UPPER], platform={"os": "unknown", "architecture": "unknown"})
+    write_index(layout, [
+        write_image_index(layout, [amd64, arm64, attestation], annotations={oci.REF_NAME: "latest"})
+    ])
+
+    assert len(oci.read_layers(layout, platform="linux/amd64")) == 1
+    assert len(oci.read_layers(layout, "latest", "linux/arm64/v8")) == 2
+    with pytest.raises(Exception, match="found 2"):
+        oci.read_layers(layout)
@@ -0,0 +1,141 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from collections import namedtuple
+import os
+from pathlib import Path
+from typing import List
+
+from pytest_mock import MockerFixture
+
+from embdgen.core.content.BaseContent import BaseContent
+from embdgen.core.sink import TeeWriter
+from embdgen.core.utils.image import BuildLocation
+from embdgen.core.utils.preflight import Preflight, format_size
+from embdgen.core.utils.SizeType import SizeType
+from embdgen.plugins.content.EmptyContent import EmptyContent
+from embdgen.plugins.content.Ext4Content import Ext4Content
+from embdgen.plugins.content.Luks2Content import Luks2Content
+from embdgen.plugins.content.RawContent import RawContent
+from embdgen.plugins.label.MBR import MBR
+from embdgen.plugins.region.PartitionRegion import PartitionRegion
+from embdgen.plugins.sink.ZstdSink import ZstdSink
+
+DiskUsage = namedtuple("DiskUsage", ["total", "used", "free"])
+MB = 1024 * 1024
+
+
+def create_label(tmp_path: Path) -> MBR:
+    raw_file = tmp_path / "raw"
+    raw_file.write_bytes(b"1" * MB)
+
+    label = MBR()
+    for name, content in [("raw", RawContent()), ("ext4", Ext4Content()), ("empty", EmptyContent())]:
+        if isinstance(content, RawContent):
+            content.file = raw_file
+        else:
+            content.size = SizeType(4 * MB)
+        part = PartitionRegion()
+        part.fstype = "ext4"
+        part.name = name
+        part.content = content
+        label.parts.append(part)
+    label.prepare()
+    return label
+
+
+def create_parts(contents: List[BaseContent]) -> MBR:
+    label = MBR()
+    for i, content in enumerate(contents):
+        part = PartitionRegion()
+        part.fstype = "ext4"
+        part.name = f"part{i}"
+        part.content = content
+        label.parts.append(part)
+    label.prepare()
+    return label
+
+
+def test_format_size():
+    assert format_size(123) == "123 B"
+    assert format_size(1536) == "1.5 KiB"
+    assert format_size(3 * MB) == "3.0 MiB"
+    assert format_size(2048 * 1024 * MB) == "2048.0 GiB"
+
+
+def test_estimate(tmp_path: Path):
+    BuildLocation().set_path(tmp_path / "build")
+    label = create_label(tmp_path)
+
+    preflight = Preflight(label, [tmp_path / "image"])
+
+    assert [(r.name, r.estimate.data, r.estimate.temp) for r in preflight.regions] == [
+        ("raw", MB, 0),
+        ("ext4", 4 * MB, 4 * MB),
+        ("empty", 0, 0)
+    ]
+    assert preflight.size == (label.parts[-1].start + label.parts[-1].size).bytes
+    assert preflight.allocated == 5 * MB
+    assert preflight.peak_temp == 4 * MB
+    assert preflight.peak_ram == 0
+    assert preflight.peak_memory == TeeWriter.MAX_BUFFERED
+    assert not preflight.problems
+    assert "ext4" in preflight.report()
+
+
+def test_jobs(tmp_path: Path):
+    BuildLocation().set_path(tmp_path / "build")
+    contents = [Ext4Content() for _ in range(4)]
+    for i, content in enumerate(contents):
+        content.size = SizeType((i + 1) * MB)
+    # The last content is used by two regions, so it exists until both are written
+    label = create_parts(contents + [contents[-1]])
+
+    assert Preflight(label, []).peak_temp == 4 * MB + 3 * MB
+    assert Preflight(label, [], jobs=2).peak_temp == 4 * MB + 3 * MB + 2 * MB
+
+
+def test_memory(tmp_path: Path):
+    BuildLocation().set_path(tmp_path / "build")
+    raw_file = tmp_path / "raw"
+    raw_file.write_bytes(b"1" * MB)
+    luks = Luks2Content()
+    luks.content = RawContent()
+    luks.content.file = raw_file
+    luks.passphrase = "secret"
+    luks.kdf_memory = 128 * 1024
+    label = create_parts([luks])
+
+    preflight = Preflight(label, [], sinks=[ZstdSink(tmp_path / "image.zst")])
+
+    assert preflight.regions[0].estimate.memory == 128 * MB
+    assert preflight.buffers == TeeWriter.MAX_BUFFERED + (os.cpu_count() or 1) * ZstdSink.MEMORY_PER_THREAD
+    assert preflight.peak_memory == 128 * MB + preflight.buffers
+    assert "Peak memory: " in preflight.report()
+
+
+def test_ram(tmp_path: Path):
+    ram_dir = tmp_path / "ram"
+    ram_dir.mkdir()
+    BuildLocation().set_path(tmp_path / "build")
+    BuildLocation().set_ram_budget(8 * MB, ram_dir=ram_dir)
+    label = create_label(tmp_path)
+
+    preflight = Preflight(label, [])
+
+    assert preflight.peak_temp == 4 * MB
+    assert preflight.peak_ram == 4 * MB
+    BuildLocation().remove()
+
+
+def test_not_enough_space(tmp_path: Path, mocker: MockerFixture):
+    BuildLocation().set_path(tmp_path / "build")
+    label = create_label(tmp_path)
+    mocker.patch("embdgen.core.utils.preflight.shutil.disk_usage", return_value=DiskUsage(0, 0, 6 * MB))
+
+    # The temporary files and the image are on the same filesystem
+    preflight = Preflight(label, [tmp_path / "image"])
+
+    assert preflight.problems == [
+        f"Not enough space for temporary files in {tmp_path / 'build'}, {tmp_path / 'image'}: "
+        "9.0 MiB required, 6.0 MiB free"
+    ]